@@ -0,0 +1,6 @@
+"""
+負荷試験とベンチマーク
+    python -m app.bench.seed --scale 10000   MySQLに試験用のデータを入れる
+    python -m app.bench.run --scale 10000    アプリを起動して主な画面にリクエストを送り，結果をJSONで出す
+コミットごとに同じ条件で実行し，出力したJSONを比べる
+"""
@@ -0,0 +1,397 @@
+"""
+負荷試験
+main.py(python -m app.main)でアプリを起動し，ログイン，/articles，検索，ディスカッション，ユーザページ，
+/matching，チャットの配信にリクエストを送って，画面ごとのレイテンシ(p50/p95/p99)，スループット，
+１リクエストあたりのSQLの数をJSONで出力する
+
+    python -m app.bench.run --scale 10000 --duration 60 --concurrency 16 --output bench.json
+
+SQLの数はアプリの /metrics から取るので，アプリと同じマシンで実行する
+チャットの計測には websockets パッケージが必要(なければ飛ばす)
+"""
+import argparse
+import asyncio
+import datetime
+import http.client
+import json
+import logging
+import math
+import os
+import random
+import subprocess
+import sys
+import threading
+import time
+import urllib.parse
+import uuid
+from typing import Callable, Dict, List, Optional, Tuple
+
+from app.configs import Config
+from app.models.abstract import AbstractModel, ROW_TUPLE
+from app.bench.seed import BENCH_PASSWORD, BENCH_PREFIX, BenchSeeder, WORDS, bench_username
+
+logger = logging.getLogger(__name__)
+
+# main.pyが待ち受けるポート
+APP_PORT = 8000
+# 負荷をかける画面と，選ばれる割合
+FLOW_WEIGHTS = {
+    "login": 1,
+    "articles": 4,
+    "search": 2,
+    "discussion": 3,
+    "user": 3,
+    "matching": 1,
+}
+# 画面 -> /metrics のルート名
+FLOW_ROUTES = {
+    "login": "POST /login",
+    "articles": "GET /articles",
+    "search": "POST /articles",
+    "discussion": "GET /community/discussion/{id}",
+    "user": "GET /user/{username}",
+    "matching": "GET /matching",
+}
+# 対象として使うidの数
+TARGET_SAMPLE_SIZE = 1000
+
+
+def percentile(values: List[float], ratio: float) -> Optional[float]:
+    """
+    :param values: 昇順に並べた値
+    :param ratio: 0〜1
+    :return: nearest-rank法のパーセンタイル．値がなければNone
+    """
+    if not values:
+        return None
+    # 0.95 * 100 のような積の誤差で１つ上の順位にならないよう，丸めてから切り上げる
+    rank = max(1, math.ceil(round(ratio * len(values), 9)))
+    return values[min(rank, len(values)) - 1]
+
+
+def summarize(latencies: List[float], errors: int, duration: float) -> Dict[str, any]:
+    latencies = sorted(latencies)
+    count = len(latencies)
+    return {
+        "count": count,
+        "errors": errors,
+        "rps": count / duration if duration else 0.0,
+        "mean_ms": sum(latencies) / count * 1000 if count else None,
+        "p50_ms": percentile(latencies, 0.50) * 1000 if count else None,
+        "p95_ms": percentile(latencies, 0.95) * 1000 if count else None,
+        "p99_ms": percentile(latencies, 0.99) * 1000 if count else None,
+        "max_ms": latencies[-1] * 1000 if count else None,
+    }
+
+
+class BenchTargets(AbstractModel):
+    """
+    リクエストに使うディスカッションとPubのidを試験用のデータから選ぶ(ユーザ名は番号から作る)
+    """
+
+    def __init__(self, config):
+        super(BenchTargets, self).__init__(config)
+
+    def sample(self, sql: str) -> list:
+        rows = self.iter_rows(sql, BENCH_PREFIX + "%", TARGET_SAMPLE_SIZE, row_type=ROW_TUPLE)
+        return [row[0] for row in rows]
+
+    def load(self) -> Dict[str, list]:
+        return {
+            "discussions": self.sample("SELECT id FROM message WHERE username LIKE %s ORDER BY id DESC LIMIT %s"),
+            "pubs": self.sample("SELECT pub_id FROM pubs WHERE pub_id LIKE %s LIMIT %s"),
+        }
+
+
+class Client(object):
+    """
+    keep-aliveで１つの接続を使い回すHTTPクライアント．スレッドごとに１つ作る
+    リダイレクトはたどらず，session_idのクッキーだけを覚える
+    """
+
+    def __init__(self, host: str, port: int):
+        self.host = host
+        self.port = port
+        self.connection = http.client.HTTPConnection(host, port, timeout=30)
+        self.session_id: Optional[str] = None
+
+    def request(self, method: str, path: str, form: Optional[Dict[str, str]] = None) -> Tuple[int, bytes]:
+        headers = {}
+        body = None
+        if form is not None:
+            body = urllib.parse.urlencode(form)
+            headers["Content-Type"] = "application/x-www-form-urlencoded"
+        if self.session_id:
+            headers["Cookie"] = "session_id=%s" % self.session_id
+        try:
+            self.connection.request(method, path, body=body, headers=headers)
+            response = self.connection.getresponse()
+        except (http.client.HTTPException, OSError):
+            # サーバに切られた接続は作り直して１回だけやり直す
+            self.connection.close()
+            self.connection = http.client.HTTPConnection(self.host, self.port, timeout=30)
+            self.connection.request(method, path, body=body, headers=headers)
+            response = self.connection.getresponse()
+        data = response.read()
+        for header, value in response.getheaders():
+            if header.lower() == "set-cookie" and value.startswith("session_id="):
+                self.session_id = value.split(";", 1)[0].split("=", 1)[1]
+        return response.status, data
+
+    def close(self) -> None:
+        self.connection.close()
+
+
+class LoadTest(object):
+    def __init__(self, host: str, port: int, scale: int, concurrency: int, duration: float, seed: int,
+                 targets: Dict[str, list]):
+        self.host = host
+        self.port = port
+        self.scale = scale
+        self.concurrency = concurrency
+        self.duration = duration
+        self.seed = seed
+        self.targets = targets
+        self._lock = threading.Lock()
+        self.latencies: Dict[str, List[float]] = {flow: [] for flow in FLOW_WEIGHTS}
+        self.errors: Dict[str, int] = {flow: 0 for flow in FLOW_WEIGHTS}
+
+    def _user(self, rng: random.Random) -> str:
+        return bench_username(rng.randrange(self.scale))
+
+    def _login(self, client: Client, rng: random.Random) -> int:
+        client.session_id = None
+        status, _ = client.request("POST", "/login", {"username": self._user(rng), "password": BENCH_PASSWORD})
+        return status
+
+    def _flows(self) -> Dict[str, Callable[[Client, random.Random], int]]:
+        return {
+            "login": self._login,
+            "articles": lambda client, rng: client.request("GET", "/articles")[0],
+            "search": lambda client, rng: client.request(
+                "POST", "/articles", {"keyword": rng.choice(WORDS), "search_by": "titles"})[0],
+            "discussion": lambda client, rng: client.request(
+                "GET", "/community/discussion/%s" % rng.choice(self.targets["discussions"]))[0],
+            "user": lambda client, rng: client.request("GET", "/user/%s" % self._user(rng))[0],
+            "matching": lambda client, rng: client.request("GET", "/matching")[0],
+        }
+
+    def _worker(self, index: int, deadline: float) -> None:
+        rng = random.Random(self.seed * 1000 + index)
+        flows = self._flows()
+        names = list(FLOW_WEIGHTS)
+        weights = [FLOW_WEIGHTS[name] for name in names]
+        client = Client(self.host, self.port)
+        try:
+            self._login(client, rng)
+            while time.monotonic() < deadline:
+                name = rng.choices(names, weights)[0]
+                started = time.perf_counter()
+                try:
+                    status = flows[name](client, rng)
+                    ok = status in (200, 302)
+                except Exception:
+                    logger.exception("%s failed", name)
+                    ok = False
+                elapsed = time.perf_counter() - started
+                with self._lock:
+                    if ok:
+                        self.latencies[name].append(elapsed)
+                    else:
+                        self.errors[name] += 1
+                if not client.session_id:
+                    self._login(client, rng)
+        finally:
+            client.close()
+
+    def run(self) -> Tuple[Dict[str, any], float]:
+        deadline = time.monotonic() + self.duration
+        started = time.perf_counter()
+        threads = [threading.Thread(target=self._worker, args=(index, deadline), daemon=True)
+                   for index in range(self.concurrency)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - started
+        flows = {name: summarize(self.latencies[name], self.errors[name], elapsed) for name in FLOW_WEIGHTS}
+        everything = [latency for latencies in self.latencies.values() for latency in latencies]
+        flows["total"] = summarize(everything, sum(self.errors.values()), elapsed)
+        return flows, elapsed
+
+
+async def chat_broadcast(host: str, port: int, pub_id: str, listeners: int, messages: int) -> Dict[str, any]:
+    """
+    listeners個の接続を同じルームに入れ，１つの接続からmessages件送って全員に届くまでの時間を計る
+    """
+    try:
+        import websockets
+    except ImportError:
+        return {"skipped": "websockets is not installed"}
+    url = "ws://%s:%d/community/%s/chat" % (host, port, urllib.parse.quote(pub_id))
+    latencies: List[float] = []
+    expected = listeners * messages
+    run_id = uuid.uuid4().hex
+
+    async def listen(connection, ready: asyncio.Event):
+        ready.set()
+        received = 0
+        while received < messages:
+            data = json.loads(await connection.recv())
+            # 入室時に届く履歴(前回の計測のものも含む)や他の人のメッセージは数えない
+            if not isinstance(data, dict) or data.get("bench_run") != run_id:
+                continue
+            latencies.append(time.time() - data["bench_sent_at"])
+            received += 1
+
+    connections = [await websockets.connect(url + "?nickname=listener%d" % index) for index in range(listeners)]
+    sender = await websockets.connect(url + "?nickname=sender")
+    try:
+        events = [asyncio.Event() for _ in connections]
+        tasks = [asyncio.ensure_future(listen(connection, event)) for connection, event in zip(connections, events)]
+        await asyncio.gather(*(event.wait() for event in events))
+        started = time.perf_counter()
+        for index in range(messages):
+            await sender.send(json.dumps({"message": "bench %d" % index, "bench_run": run_id,
+                                          "bench_sent_at": time.time()}))
+        try:
+            await asyncio.wait_for(asyncio.gather(*tasks), timeout=60)
+        except asyncio.TimeoutError:
+            for task in tasks:
+                task.cancel()
+        elapsed = time.perf_counter() - started
+    finally:
+        for connection in connections + [sender]:
+            await connection.close()
+    result = summarize(latencies, expected - len(latencies), elapsed)
+    result["deliveries_per_second"] = result.pop("rps")
+    result["listeners"] = listeners
+    return result
+
+
+def fetch_metrics(host: str, port: int) -> Dict[str, any]:
+    connection = http.client.HTTPConnection(host, port, timeout=30)
+    try:
+        connection.request("GET", "/metrics")
+        response = connection.getresponse()
+        data = response.read()
+        if response.status != 200:
+            return {}
+        return json.loads(data)
+    finally:
+        connection.close()
+
+
+def query_counts(before: Dict[str, any], after: Dict[str, any]) -> Dict[str, Dict[str, float]]:
+    """
+    ２回の /metrics の差から，画面ごとの１リクエストあたりのSQLの数とDBの時間を求める
+    """
+    before_routes = before.get("requests", {}).get("routes", {})
+    after_routes = after.get("requests", {}).get("routes", {})
+    result = {}
+    for flow, route in FLOW_ROUTES.items():
+        old, new = before_routes.get(route), after_routes.get(route)
+        if new is None:
+            continue
+        old = old or {"count": 0, "queries_avg": 0.0, "db_avg_ms": 0.0}
+        count = new["count"] - old["count"]
+        if count <= 0:
+            continue
+        queries = new["queries_avg"] * new["count"] - old["queries_avg"] * old["count"]
+        db_ms = new["db_avg_ms"] * new["count"] - old["db_avg_ms"] * old["count"]
+        result[flow] = {"queries_per_request": queries / count, "db_ms_per_request": db_ms / count,
+                        "queries_max": new["queries_max"]}
+    return result
+
+
+def start_app(app_dir: str, port: int) -> subprocess.Popen:
+    """
+    main.pyでアプリを起動し，応答するまで待つ
+    :param app_dir: appパッケージのあるディレクトリ(python -m app.main を実行する場所)
+    """
+    process = subprocess.Popen([sys.executable, "-m", "app.main"], cwd=app_dir)
+    deadline = time.monotonic() + 60
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError("app exited with code %s" % process.returncode)
+        try:
+            connection = http.client.HTTPConnection("127.0.0.1", port, timeout=1)
+            connection.request("GET", "/")
+            connection.getresponse().read()
+            connection.close()
+            return process
+        except OSError:
+            time.sleep(0.5)
+    process.terminate()
+    raise RuntimeError("app did not start within 60 seconds")
+
+
+def git_commit(path: str) -> Optional[str]:
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=path, stderr=subprocess.DEVNULL) \
+            .decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    package_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    parser = argparse.ArgumentParser(description="負荷試験を行い，結果をJSONで出力する")
+    parser.add_argument("--scale", type=int, default=10000, help="試験用のデータのユーザ数")
+    parser.add_argument("--seed", type=int, default=0, help="乱数のシード")
+    parser.add_argument("--duration", type=float, default=60, help="負荷をかける秒数")
+    parser.add_argument("--warmup", type=float, default=10, help="計測の前に負荷をかける秒数")
+    parser.add_argument("--concurrency", type=int, default=16, help="同時にリクエストを送る数")
+    parser.add_argument("--chat-listeners", type=int, default=100, help="チャットの計測で接続する数")
+    parser.add_argument("--chat-messages", type=int, default=100, help="チャットの計測で送るメッセージの数")
+    parser.add_argument("--no-start", action="store_true", help="起動済みのアプリ(127.0.0.1:8000)を使う")
+    parser.add_argument("--no-seed", action="store_true", help="試験用のデータを入れない")
+    parser.add_argument("--output", help="結果を書き込むファイル．省略すると標準出力")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(message)s")
+
+    config = Config()
+    if not args.no_seed:
+        BenchSeeder(config, args.scale, args.seed).seed()
+    targets = BenchTargets(config).load()
+    process = None if args.no_start else start_app(os.path.dirname(package_dir), APP_PORT)
+    try:
+        host = "127.0.0.1"
+        if args.warmup:
+            logger.info("warming up for %.0fs", args.warmup)
+            LoadTest(host, APP_PORT, args.scale, args.concurrency, args.warmup, args.seed + 1, targets).run()
+        before = fetch_metrics(host, APP_PORT)
+        logger.info("running for %.0fs with %d clients", args.duration, args.concurrency)
+        flows, elapsed = LoadTest(host, APP_PORT, args.scale, args.concurrency, args.duration, args.seed,
+                                  targets).run()
+        after = fetch_metrics(host, APP_PORT)
+        for flow, counts in query_counts(before, after).items():
+            flows[flow].update(counts)
+        chat = asyncio.run(chat_broadcast(host, APP_PORT, targets["pubs"][0], args.chat_listeners,
+                                          args.chat_messages)) if targets["pubs"] else {"skipped": "no pubs"}
+    finally:
+        if process is not None:
+            process.terminate()
+            process.wait()
+
+    result = {
+        "commit": git_commit(package_dir),
+        "started_at": datetime.datetime.utcnow().isoformat() + "Z",
+        "scale": args.scale,
+        "seed": args.seed,
+        "concurrency": args.concurrency,
+        "duration": elapsed,
+        "flows": flows,
+        "chat": chat,
+        "pool": after.get("pool"),
+    }
+    output = json.dumps(result, indent=2, ensure_ascii=False)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,196 @@
+"""
+ベンチマーク用のデータを入れる
+ユーザ名は bench0000001 のように bench から始まり，パスワードは全員 BENCH_PASSWORD
+乱数のシードが同じなら，何度作っても同じデータになる
+
+--scale はユーザ数．他のテーブルはユーザ数に対する割合(RATIOS)で決まり，
+ユーザ１人あたり約17.5行なので，scale=1000 で約1.7万行，scale=60000 で約100万行になる
+"""
+import argparse
+import datetime
+import logging
+import random
+from typing import Iterator, List
+
+from app.configs import Config
+from app.models.abstract import AbstractModel, ROW_TUPLE
+from app.models.auth import AuthModel
+from app.models.follow import FollowGraphModel, make_follow_id
+from app.models.migration import MigrationModel
+
+logger = logging.getLogger(__name__)
+
+BENCH_PREFIX = "bench"
+BENCH_PASSWORD = "bench-password"
+# 一度にINSERTする行数
+INSERT_BATCH_SIZE = 1000
+
+# ユーザ１人あたりの行数
+RATIOS = {
+    "pubs": 0.01,
+    "articles": 2,
+    "comments": 3,
+    "discussions": 0.5,
+    "discussion_comments": 2,
+    "discussion_replies": 1,
+    "follows": 5,
+    "pub_follows": 2,
+}
+
+CLUBS = ["Arsenal", "Chelsea", "Liverpool", "Manchester City", "Manchester United", "Tottenham",
+         "Real Madrid", "Barcelona", "Atletico Madrid", "Bayern Munich", "Borussia Dortmund",
+         "Juventus", "Inter", "AC Milan", "Napoli", "Paris Saint-Germain", "Ajax", "Benfica"]
+LEAGUES = [("Premier League", "プレミアリーグ"), ("LaLiga", "ラ・リーガ"), ("Bundesliga", "ブンデスリーガ"),
+           ("Serie A", "セリエA"), ("Ligue 1", "リーグ・アン"), ("Eredivisie", "エールディヴィジ")]
+NATIONS = ["Japan", "England", "Spain", "Germany", "Italy", "France", "Netherlands", "Portugal", "Brazil",
+           "Argentina"]
+WORDS = ["goal", "offside", "pressing", "counter", "derby", "transfer", "keeper", "striker", "tactics",
+         "ゴール", "オフサイド", "移籍", "ダービー", "戦術", "サポーター", "スタジアム"]
+
+
+def bench_username(index: int) -> str:
+    return "%s%07d" % (BENCH_PREFIX, index)
+
+
+class BenchSeeder(AbstractModel):
+    def __init__(self, config, scale: int, seed: int = 0):
+        """
+        :param scale: ユーザ数
+        :param seed: 乱数のシード
+        """
+        super(BenchSeeder, self).__init__(config)
+        self.scale = scale
+        self.random = random.Random(seed)
+        self.now = datetime.datetime(2023, 1, 1)
+
+    def seeded_users(self) -> int:
+        sql = "SELECT COUNT(*) AS count FROM users WHERE username LIKE %s"
+        return self.fetch_one(sql, BENCH_PREFIX + "%")["count"]
+
+    def _count(self, name: str) -> int:
+        return max(1, int(self.scale * RATIOS[name]))
+
+    def _user(self) -> str:
+        return bench_username(self.random.randrange(self.scale))
+
+    def _created_at(self) -> datetime.datetime:
+        # 直近１年に散らばらせる
+        return self.now - datetime.timedelta(seconds=self.random.randrange(365 * 24 * 60 * 60))
+
+    def _text(self, words: int) -> str:
+        return " ".join(self.random.choice(WORDS) for _ in range(words))
+
+    def _insert(self, sql: str, rows: Iterator[tuple]) -> int:
+        batch, count = [], 0
+        for row in rows:
+            batch.append(row)
+            if len(batch) >= INSERT_BATCH_SIZE:
+                self.execute_many(sql, batch)
+                count += len(batch)
+                batch = []
+        if batch:
+            self.execute_many(sql, batch)
+            count += len(batch)
+        return count
+
+    def _ids(self, sql: str) -> List[int]:
+        return [row[0] for row in self.iter_rows(sql, BENCH_PREFIX + "%", batch_size=10000, row_type=ROW_TUPLE)]
+
+    def seed_reference(self) -> None:
+        # 既にクラブなどが登録されている場合はそのまま使う
+        if not self.fetch_all("SELECT * FROM clubs LIMIT 1"):
+            self.execute_many("INSERT INTO clubs(clubs) VALUE (%s)", [(club,) for club in CLUBS])
+        if not self.fetch_all("SELECT * FROM leagues LIMIT 1"):
+            self.execute_many("INSERT INTO leagues(english_name, leagues) VALUE (%s, %s)", LEAGUES)
+        if not self.fetch_all("SELECT * FROM nations LIMIT 1"):
+            self.execute_many("INSERT INTO nations(nations) VALUE (%s)", [(nation,) for nation in NATIONS])
+
+    def seed(self) -> None:
+        """
+        全てのテーブルにデータを入れる．同じscaleで作成済みなら何もしない
+        """
+        MigrationModel(self.config).migrate()
+        if self.seeded_users() >= self.scale:
+            logger.info("already seeded %d users", self.scale)
+            return
+        self.seed_reference()
+        password = AuthModel(self.config).hash_password(BENCH_PASSWORD)
+
+        count = self._insert("INSERT IGNORE INTO users(username, password, created_at) VALUE (%s, %s, %s)",
+                             ((bench_username(index), password, self._created_at()) for index in range(self.scale)))
+        logger.info("users: %d", count)
+        leagues = [english_name for english_name, _ in LEAGUES]
+        count = self._insert(
+            "INSERT IGNORE INTO profile(username, nickname, your_club, your_league, your_nation, profile) "
+            "VALUE (%s, %s, %s, %s, %s, %s)",
+            ((bench_username(index), "Bench %d" % index, self.random.choice(CLUBS), self.random.choice(leagues),
+              self.random.choice(NATIONS), self._text(12)) for index in range(self.scale)))
+        logger.info("profile: %d", count)
+
+        pubs = ["%s-pub-%05d" % (BENCH_PREFIX, index) for index in range(self._count("pubs"))]
+        count = self._insert("INSERT IGNORE INTO pubs(pub_id, pub_name, pub_comment, created_by) VALUE (%s, %s, %s, %s)",
+                             ((pub_id, "Pub %s" % pub_id, self._text(10), self._user()) for pub_id in pubs))
+        logger.info("pubs: %d", count)
+
+        count = self._insert("INSERT INTO articles(username, title, body, created_at) VALUE (%s, %s, %s, %s)",
+                             ((self._user(), self._text(4), self._text(80), self._created_at())
+                              for _ in range(self._count("articles"))))
+        logger.info("articles: %d", count)
+        articles = self._ids("SELECT id FROM articles WHERE username LIKE %s")
+        count = self._insert("INSERT INTO comments(username, article_id, comment, created_at) VALUE (%s, %s, %s, %s)",
+                             ((self._user(), self.random.choice(articles), self._text(15), self._created_at())
+                              for _ in range(self._count("comments"))))
+        logger.info("comments: %d", count)
+
+        count = self._insert(
+            "INSERT INTO message(pub_id, username, status, title, body, created_at) VALUE (%s, %s, %s, %s, %s, %s)",
+            ((self.random.choice(pubs), self._user(), self.random.choice(WORDS), self._text(4), self._text(60),
+              self._created_at()) for _ in range(self._count("discussions"))))
+        logger.info("discussions: %d", count)
+        messages = self._ids("SELECT id FROM message WHERE username LIKE %s")
+        count = self._insert(
+            "INSERT INTO discuss_comments(username, message_id, context, created_at) VALUE (%s, %s, %s, %s)",
+            ((self._user(), self.random.choice(messages), self._text(15), self._created_at())
+             for _ in range(self._count("discussion_comments"))))
+        logger.info("discussion comments: %d", count)
+        discussion_comments = self._ids("SELECT id FROM discuss_comments WHERE username LIKE %s")
+        count = self._insert(
+            "INSERT INTO discuss_comment_comments(username, discussion_comment_id, context, created_at) "
+            "VALUE (%s, %s, %s, %s)",
+            ((self._user(), self.random.choice(discussion_comments), self._text(10), self._created_at())
+             for _ in range(self._count("discussion_replies"))))
+        logger.info("discussion replies: %d", count)
+
+        def follows():
+            for _ in range(self._count("follows")):
+                from_user, to_user = self._user(), self._user()
+                if from_user != to_user:
+                    yield to_user, from_user, make_follow_id(from_user, to_user)
+
+        count = self._insert("INSERT IGNORE INTO follow(to_user_id, from_user_id, id) VALUE (%s, %s, %s)", follows())
+        logger.info("follows: %d", count)
+
+        def pub_follows():
+            for _ in range(self._count("pub_follows")):
+                pub_id, user_name = self.random.choice(pubs), self._user()
+                yield pub_id, user_name, make_follow_id(user_name, pub_id)
+
+        count = self._insert("INSERT IGNORE INTO followpub(pub, user, id) VALUE (%s, %s, %s)", pub_follows())
+        logger.info("pub follows: %d", count)
+
+        # 集計テーブルを作り直す(検索用のインデックスはマイグレーションで作成済み)
+        FollowGraphModel(self.config).rebuild_counts()
+        logger.info("seeded %d users", self.scale)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="ベンチマーク用のデータを入れる")
+    parser.add_argument("--scale", type=int, default=10000, help="ユーザ数(1000〜60000で約1.7万〜100万行)")
+    parser.add_argument("--seed", type=int, default=0, help="乱数のシード")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(message)s")
+    BenchSeeder(Config(), args.scale, args.seed).seed()
+
+
+if __name__ == "__main__":
+    main()
@@ -10,10 +10,83 @@ class Config(BaseConfig):
     設定を管理するクラス
     BaseConfigを継承しているので，Config.json_loadsを使えばJSONからConfigに変換できる
     """
-    mysql_host: str = "mysql"
+    mysql_host: str = os.environ.get("MYSQL_HOST", "mysql")
     mysql_username: str = "root"
     mysql_password: str = os.environ.get("MYSQL_ROOT_PASSWORD", "password")
     mysql_database: str = os.environ.get("MYSQL_DATABASE", "app")
+    # コネクションプールの設定
+    mysql_pool_min_size: int = 1
+    mysql_pool_max_size: int = 10
+    # 空きがない時に接続を待つ秒数
+    mysql_pool_timeout: float = 10.0
+    # これより長く使われていない接続はmin_sizeを残して閉じる
+    mysql_pool_idle_timeout: int = 5 * 60
+    # これより長く使われていない接続は取り出し時にpingで生存確認する
+    mysql_pool_ping_interval: int = 30
     session_cache_dir: str = "__cache__"
+    # セッションの保存先: memory(プロセス内), sqlite(同じマシンのworkerで共有), file(cachelib)
+    session_backend: str = os.environ.get("SESSION_BACKEND", "sqlite")
+    # 保持するセッションの上限．新しいセッションを保存した時に超えたら，最後に使われたのが古いものから捨てる
+    session_max_entries: int = 100000
+    # 期限切れセッションを削除する間隔(秒)と，１回に削除する件数
+    session_sweep_interval: int = 60
+    session_sweep_batch_size: int = 500
     # セッションは1日保持する
     session_lifetime: int = 24 * 60 * 60
+    # ログイン中のユーザのプロフィールをキャッシュする秒数と件数
+    profile_cache_ttl: int = 30
+    profile_cache_size: int = 10000
+    # チャットで接続ごとに溜めておける未送信メッセージの数
+    chat_queue_size: int = 100
+    # キューが一杯になった時の方針: drop_oldest(古いものを捨てる) か disconnect(切断する)
+    chat_slow_consumer_policy: str = "drop_oldest"
+    # １通の送信にこれ以上かかるクライアントは切断する(秒)
+    chat_send_timeout: float = 5.0
+    # チャットのpub/sub: inprocess(worker１つ) か socket(ブローカー経由で複数のworker/サーバ)
+    chat_bus: str = os.environ.get("CHAT_BUS", "inprocess")
+    chat_bus_host: str = os.environ.get("CHAT_BUS_HOST", "127.0.0.1")
+    chat_bus_port: int = int(os.environ.get("CHAT_BUS_PORT", "8765"))
+    # ブローカーとの接続が切れている間に溜めておくpublishの数(超えたら古いものから捨てる)と，１通の送信を待つ秒数
+    chat_bus_max_buffered: int = 1000
+    chat_bus_send_timeout: float = 1.0
+    # ブローカーが１つのノードに送り切れずに溜めておけるバイト数．超えたノードは切断する(再接続して続きを受け取る)
+    chat_bus_max_subscriber_buffer: int = 1024 * 1024
+    # 入室時に送る直近のメッセージの数
+    chat_history_size: int = 50
+    # チャットの保存をまとめる件数と間隔(秒)．DBに書けない間に溜めておく上限
+    chat_persist_batch_size: int = 200
+    chat_persist_interval: float = 1.0
+    chat_persist_max_pending: int = 10000
+    # /articles のタイムラインとしてメモリに持つ記事の数と，他のworkerの変更を確認する間隔(秒)
+    article_feed_size: int = 200
+    article_feed_poll_interval: float = 1.0
+    # 記事の変更ログ(article_changes)を残しておく秒数と，古いものを消す間隔(秒)
+    # これより長く変更ログを読めなかったworkerは，タイムラインを作り直す
+    article_feed_change_retention: int = 10 * 60
+    article_feed_prune_interval: int = 60
+    # クラブ，リーグ，国の一覧を読み直す間隔(秒)．0なら再起動するまで読み直さない
+    reference_data_ttl: int = 60 * 60
+    # /matching のインデックスを作り直す間隔(秒)．他のworkerでのプロフィールの変更はこの間隔で反映される
+    matching_index_ttl: int = 5 * 60
+    # コンパイルしたテンプレートの保存先．同じマシンのworkerで共有する
+    template_cache_dir: str = os.environ.get("TEMPLATE_CACHE_DIR", "__cache__/templates")
+    # 記事・Pub・ユーザのページの描画結果をworkerごとに保持する件数と秒数
+    http_page_cache_size: int = 1000
+    http_page_cache_ttl: int = 5 * 60
+    # これ以上かかったSQLをログに出す(秒)．0ならログに出さない
+    slow_query_threshold: float = float(os.environ.get("SLOW_QUERY_THRESHOLD", "0.2"))
+    # /metrics に出す，合計時間の長いSQLの数
+    metrics_top_queries: int = 20
+    # １リクエストでこれより多くSQLを実行したらログに出す(N+1の検出)．0ならログに出さない
+    metrics_query_warn_count: int = 30
+    # コメントとフォローの書き込みをまとめる(write-behind)．Falseなら１件ずつ書き込む
+    write_behind_enabled: bool = os.environ.get("WRITE_BEHIND", "0") == "1"
+    # まとめて書き込む件数と，積んでから書き込むまでの最大の秒数
+    write_behind_batch_size: int = 200
+    write_behind_max_delay: float = 0.2
+    # 溜めておける上限．達したら書き込むユーザのリクエストの中で溜まった分を書き込む
+    write_behind_max_pending: int = 10000
+    # DBに繋がらない時に再試行する間隔の上限(秒)．間隔はmax_delayから倍にしていく
+    write_behind_max_backoff: float = 30.0
+    # 書けなかった行(dead letter)と，停止時に書き込めなかった行を保存するディレクトリ．同じマシンのworkerで共有する
+    write_behind_spool_dir: str = os.environ.get("WRITE_BEHIND_SPOOL_DIR", "__cache__/write_behind")
@@ -7,3 +7,18 @@
 class UserNotLoggedIn(Exception):
     """ユーザがログインしていない時に送る"""
     pass
+
+
+class ConnectionPoolExhausted(Exception):
+    """コネクションプールから時間内に接続を借りられなかった時に送る"""
+    pass
+
+
+class MigrationError(Exception):
+    """マイグレーションを実行できなかった時に送る"""
+    pass
+
+
+class WriteBehindQueueFull(Exception):
+    """write-behindのキューが一杯で，溜まった分もDBに書き込めなかった時に送る"""
+    pass
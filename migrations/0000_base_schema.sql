@@ -0,0 +1,121 @@
+-- アプリの基本のテーブル
+-- マイグレーションを導入する前からあるテーブルなので，既存のデータベースでは何もしない(IF NOT EXISTS)
+-- 0001以降はこれらのテーブルがある前提で，番号の順に実行する
+CREATE TABLE IF NOT EXISTS users (
+    username VARCHAR(255) NOT NULL PRIMARY KEY,
+    password CHAR(64) NOT NULL,
+    created_at DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
+
+CREATE TABLE IF NOT EXISTS profile (
+    username VARCHAR(255) NOT NULL PRIMARY KEY,
+    nickname VARCHAR(255) NOT NULL DEFAULT '未登録',
+    your_club VARCHAR(255) NOT NULL DEFAULT '未登録',
+    your_league VARCHAR(255) NOT NULL DEFAULT '未登録',
+    your_nation VARCHAR(255) NOT NULL DEFAULT '未登録',
+    profile TEXT,
+    twitter VARCHAR(255) NOT NULL DEFAULT '未登録',
+    instagram VARCHAR(255) NOT NULL DEFAULT '未登録',
+    SNS VARCHAR(255) NOT NULL DEFAULT '未登録'
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
+
+CREATE TABLE IF NOT EXISTS clubs (
+    id INT NOT NULL AUTO_INCREMENT PRIMARY KEY,
+    clubs VARCHAR(255) NOT NULL,
+    UNIQUE KEY uq_clubs_clubs (clubs)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
+
+CREATE TABLE IF NOT EXISTS leagues (
+    id INT NOT NULL AUTO_INCREMENT PRIMARY KEY,
+    english_name VARCHAR(255) NOT NULL,
+    leagues VARCHAR(255) NOT NULL,
+    UNIQUE KEY uq_leagues_english_name (english_name)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
+
+CREATE TABLE IF NOT EXISTS nations (
+    id INT NOT NULL AUTO_INCREMENT PRIMARY KEY,
+    nations VARCHAR(255) NOT NULL,
+    UNIQUE KEY uq_nations_nations (nations)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
+
+CREATE TABLE IF NOT EXISTS pubs (
+    pub_id VARCHAR(255) NOT NULL PRIMARY KEY,
+    pub_name VARCHAR(255) NOT NULL,
+    pub_comment TEXT,
+    created_by VARCHAR(255) NOT NULL,
+    created_at DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
+
+CREATE TABLE IF NOT EXISTS articles (
+    id INT NOT NULL AUTO_INCREMENT PRIMARY KEY,
+    username VARCHAR(255) NOT NULL,
+    title VARCHAR(255) NOT NULL,
+    body TEXT,
+    created_at DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
+
+CREATE TABLE IF NOT EXISTS comments (
+    id INT NOT NULL AUTO_INCREMENT PRIMARY KEY,
+    username VARCHAR(255) NOT NULL,
+    article_id INT NOT NULL,
+    comment TEXT,
+    created_at DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
+
+-- ディスカッションのトピック
+CREATE TABLE IF NOT EXISTS message (
+    id INT NOT NULL AUTO_INCREMENT PRIMARY KEY,
+    pub_id VARCHAR(255) NOT NULL,
+    username VARCHAR(255) NOT NULL,
+    status VARCHAR(255),
+    title VARCHAR(255) NOT NULL,
+    body TEXT,
+    created_at DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
+
+CREATE TABLE IF NOT EXISTS discuss_comments (
+    id INT NOT NULL AUTO_INCREMENT PRIMARY KEY,
+    username VARCHAR(255) NOT NULL,
+    message_id INT NOT NULL,
+    context TEXT,
+    created_at DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
+
+-- コメントへの返信．discussion_idは古い画面が参照している列で，書き込まれない
+CREATE TABLE IF NOT EXISTS discuss_comment_comments (
+    id INT NOT NULL AUTO_INCREMENT PRIMARY KEY,
+    username VARCHAR(255) NOT NULL,
+    discussion_comment_id INT NOT NULL,
+    discussion_id INT,
+    context TEXT,
+    created_at DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
+
+-- id はフォローする側--される側
+CREATE TABLE IF NOT EXISTS follow (
+    id VARCHAR(511) NOT NULL PRIMARY KEY,
+    to_user_id VARCHAR(255) NOT NULL,
+    from_user_id VARCHAR(255) NOT NULL
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
+
+CREATE TABLE IF NOT EXISTS followpub (
+    id VARCHAR(511) NOT NULL PRIMARY KEY,
+    pub VARCHAR(255) NOT NULL,
+    user VARCHAR(255) NOT NULL
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
+
+CREATE TABLE IF NOT EXISTS rooms (
+    id INT NOT NULL AUTO_INCREMENT PRIMARY KEY,
+    room_name VARCHAR(255) NOT NULL,
+    room_comment TEXT,
+    created_by VARCHAR(255) NOT NULL,
+    created_at DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
+
+CREATE TABLE IF NOT EXISTS chat_messages (
+    id BIGINT NOT NULL AUTO_INCREMENT PRIMARY KEY,
+    pub_id VARCHAR(255) NOT NULL,
+    nickname VARCHAR(255) NOT NULL,
+    message TEXT,
+    created_at DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
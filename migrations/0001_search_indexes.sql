@@ -0,0 +1,24 @@
+-- SearchModelの検索に使うインデックス(SearchModel.index_statementsと同じもの)
+-- python -m app.models.search でも作成できる．既にあるものは作成しない
+-- ngramのFULLTEXTインデックス(2文字以上の検索語)
+ALTER TABLE articles ADD FULLTEXT INDEX ft_articles_body (body) WITH PARSER ngram;
+ALTER TABLE articles ADD FULLTEXT INDEX ft_articles_title (title) WITH PARSER ngram;
+ALTER TABLE message ADD FULLTEXT INDEX ft_message_body (body) WITH PARSER ngram;
+ALTER TABLE message ADD FULLTEXT INDEX ft_message_title (title) WITH PARSER ngram;
+ALTER TABLE profile ADD FULLTEXT INDEX ft_profile_nickname (nickname) WITH PARSER ngram;
+ALTER TABLE profile ADD FULLTEXT INDEX ft_profile_profile (profile) WITH PARSER ngram;
+ALTER TABLE profile ADD FULLTEXT INDEX ft_profile_username (username) WITH PARSER ngram;
+ALTER TABLE pubs ADD FULLTEXT INDEX ft_pubs_pub_comment (pub_comment) WITH PARSER ngram;
+ALTER TABLE pubs ADD FULLTEXT INDEX ft_pubs_pub_id (pub_id) WITH PARSER ngram;
+ALTER TABLE pubs ADD FULLTEXT INDEX ft_pubs_pub_name (pub_name) WITH PARSER ngram;
+ALTER TABLE rooms ADD FULLTEXT INDEX ft_rooms_room_comment (room_comment) WITH PARSER ngram;
+-- 1文字の検索語の前方一致(LIKE 'x%')に使う，先頭の文字のインデックス
+CREATE INDEX ix_articles_body_prefix ON articles (body(16));
+CREATE INDEX ix_articles_title_prefix ON articles (title(16));
+CREATE INDEX ix_message_body_prefix ON message (body(16));
+CREATE INDEX ix_message_title_prefix ON message (title(16));
+CREATE INDEX ix_profile_nickname_prefix ON profile (nickname(16));
+CREATE INDEX ix_profile_profile_prefix ON profile (profile(16));
+CREATE INDEX ix_pubs_pub_comment_prefix ON pubs (pub_comment(16));
+CREATE INDEX ix_pubs_pub_name_prefix ON pubs (pub_name(16));
+CREATE INDEX ix_rooms_room_comment_prefix ON rooms (room_comment(16));
@@ -0,0 +1,8 @@
+-- 記事の変更ログ．/articles のタイムライン(utilities/feed.py)が他のworkerの変更を反映するのに使う
+-- created_atのインデックスは，全てのworkerが読み終えた古い変更ログを消す(ArticleModel.prune_article_changes)のに使う
+CREATE TABLE IF NOT EXISTS article_changes (
+    id BIGINT NOT NULL AUTO_INCREMENT PRIMARY KEY,
+    article_id INT NOT NULL,
+    created_at DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    KEY ix_article_changes_created_at (created_at)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
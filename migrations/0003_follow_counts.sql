@@ -0,0 +1,22 @@
+-- フォロー数の集計テーブル(models/follow.py)．作成時に今のfollow/followpubから数える
+CREATE TABLE IF NOT EXISTS user_follow_counts (
+    username VARCHAR(255) NOT NULL PRIMARY KEY,
+    followers INT NOT NULL DEFAULT 0,
+    followings INT NOT NULL DEFAULT 0
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
+
+CREATE TABLE IF NOT EXISTS pub_follow_counts (
+    pub_id VARCHAR(255) NOT NULL PRIMARY KEY,
+    followers INT NOT NULL DEFAULT 0
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
+
+INSERT INTO user_follow_counts(username, followers, followings)
+SELECT username, SUM(followers), SUM(followings) FROM (
+    SELECT to_user_id AS username, 1 AS followers, 0 AS followings FROM follow
+    UNION ALL SELECT from_user_id, 0, 1 FROM follow
+) AS edges GROUP BY username
+ON DUPLICATE KEY UPDATE followers = VALUES(followers), followings = VALUES(followings);
+
+INSERT INTO pub_follow_counts(pub_id, followers)
+SELECT pub, COUNT(*) FROM followpub GROUP BY pub
+ON DUPLICATE KEY UPDATE followers = VALUES(followers);
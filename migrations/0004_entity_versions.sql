@@ -0,0 +1,8 @@
+-- ページの元になるデータの版(models/versions.py)．HTTPのETagに使う
+CREATE TABLE IF NOT EXISTS entity_versions (
+    kind VARCHAR(16) NOT NULL,
+    entity_id VARCHAR(255) NOT NULL,
+    version BIGINT NOT NULL DEFAULT 1,
+    updated_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+    PRIMARY KEY (kind, entity_id)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
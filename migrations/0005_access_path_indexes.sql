@@ -0,0 +1,30 @@
+-- モデルの検索条件と並び順(keysetページングのキー)に合わせた複合インデックス
+-- ユーザの記事一覧(新しい順)
+CREATE INDEX ix_articles_username_created_at ON articles (username, created_at);
+-- /articles のタイムラインと記事の検索(created_at, id の順)
+CREATE INDEX ix_articles_created_at_id ON articles (created_at, id);
+-- 記事のコメントのページ
+CREATE INDEX ix_comments_article_id_created_at_id ON comments (article_id, created_at, id);
+-- Pubのディスカッションのページ
+CREATE INDEX ix_message_pub_id_created_at_id ON message (pub_id, created_at, id);
+-- スレッドのコメントと返信
+CREATE INDEX ix_discuss_comments_message_id_created_at ON discuss_comments (message_id, created_at);
+CREATE INDEX ix_discuss_comment_comments_comment_id ON discuss_comment_comments (discussion_comment_id, created_at);
+-- フォロー・フォロワーのページ(idの順)とフォロー中のユーザ
+CREATE INDEX ix_follow_from_user_id_id ON follow (from_user_id, id);
+CREATE INDEX ix_follow_to_user_id_id ON follow (to_user_id, id);
+-- フォロー中のPubと，Pubのメンバーのページ
+CREATE INDEX ix_followpub_user ON followpub (user);
+CREATE INDEX ix_followpub_pub_id ON followpub (pub, id);
+-- おすすめのユーザ(好きなクラブ，リーグ，国)
+CREATE INDEX ix_profile_your_club ON profile (your_club);
+CREATE INDEX ix_profile_your_league ON profile (your_league);
+CREATE INDEX ix_profile_your_nation ON profile (your_nation);
+-- ユーザの作ったPubと，Pubの検索(新しい順)
+CREATE INDEX ix_pubs_created_by ON pubs (created_by);
+CREATE INDEX ix_pubs_created_at_pub_id ON pubs (created_at, pub_id);
+-- ユーザの検索(新しい順)
+CREATE INDEX ix_users_created_at_username ON users (created_at, username);
+CREATE INDEX ix_rooms_created_at_id ON rooms (created_at, id);
+-- チャットの履歴(idをカーソルに遡る)
+CREATE INDEX ix_chat_messages_pub_id_id ON chat_messages (pub_id, id);
@@ -2,6 +2,16 @@
 記事モデル
 """
 from app.models.abstract import AbstractModel
+from app.models.async_abstract import AsyncAbstractModel
+from app.configs import Config
+from app.models.pagination import DEFAULT_PAGE_SIZE
+from app.models.versions import VersionModel, article_key
+from app.utilities.feed import ArticleFeed
+from app.utilities.write_behind import write_behind
+
+# /articles のタイムライン．作成・更新・削除で書き換え，他のworkerの変更はarticle_changesから反映する
+recent_articles = ArticleFeed(Config.article_feed_size, Config.article_feed_poll_interval,
+                              Config.article_feed_change_retention, Config.article_feed_prune_interval)
 
 
 class ArticleModel(AbstractModel):
@@ -17,6 +27,85 @@ class ArticleModel(AbstractModel):
         sql = "SELECT * FROM articles INNER JOIN profile on articles.username = profile.username ORDER BY articles.created_at DESC LIMIT %s"
         return self.fetch_all(sql, limit)
 
+    def fetch_recent_articles_page(self, cursor=None, limit=DEFAULT_PAGE_SIZE):
+        """
+        最新の記事を１ページ分取得する
+        :param cursor: 前回のPageのnext_cursorかprev_cursor．Noneなら最初のページ
+        :param limit: 1ページの件数
+        :return: Page
+        """
+        sql = "SELECT * FROM articles INNER JOIN profile on articles.username = profile.username"
+        return self.fetch_page(sql, [], [], ("articles.created_at", "articles.id"), cursor, limit)
+
+    def fetch_recent_articles_cached(self, cursor=None, limit=DEFAULT_PAGE_SIZE):
+        """
+        fetch_recent_articles_pageと同じページを，メモリ上のタイムラインから返す
+        :param cursor: 前回のPageのnext_cursorかprev_cursor．Noneなら最初のページ
+        :param limit: 1ページの件数
+        :return: Page
+        """
+        return recent_articles.page(self, cursor, limit)
+
+    def fetch_articles_by_ids(self, article_ids):
+        """
+        指定されたIDの記事をまとめて取得する
+        :param article_ids: 記事のIDのリスト
+        :return: 見つかった記事のリスト
+        """
+        if not article_ids:
+            return []
+        placeholders = ", ".join(["%s"] * len(article_ids))
+        sql = "SELECT * FROM articles INNER JOIN profile on articles.username = profile.username WHERE articles.id IN (%s)" % placeholders
+        return self.fetch_all(sql, *article_ids)
+
+    def fetch_article_changes(self, after_id):
+        """
+        記事の変更ログを取得する
+        :param after_id: このidより後の変更を取得する
+        :return: (id, article_id) のリスト
+        """
+        sql = "SELECT id, article_id FROM article_changes WHERE id > %s ORDER BY id"
+        return self.fetch_all(sql, after_id)
+
+    def latest_article_change(self):
+        """
+        :return: 最新の変更ログのid．変更がなければ0
+        """
+        sql = "SELECT COALESCE(MAX(id), 0) AS id FROM article_changes"
+        return self.fetch_one(sql)["id"]
+
+    def prune_article_changes(self, older_than):
+        """
+        古い変更ログを消す
+        :param older_than: これより前(秒)のログを消す
+        :return: 消した数
+        """
+        sql = "DELETE FROM article_changes WHERE created_at < NOW() - INTERVAL %s SECOND LIMIT 10000"
+        return self.execute_rowcount(sql, int(older_than))
+
+    def author_changed(self, username):
+        """
+        投稿者のプロフィールが変わったので，タイムラインに載っているかもしれない記事を変更したことにする
+        タイムラインには新しい順にarticle_feed_size件しか載らないので，そのユーザの記事もその件数だけ見ればよい
+        :param username: プロフィールを変更したユーザ
+        """
+        sql = "SELECT id FROM articles WHERE username = %s ORDER BY created_at DESC LIMIT %s"
+        article_ids = [row["id"] for row in self.fetch_all(sql, username, recent_articles.size)]
+        if not article_ids:
+            return
+        sql = "INSERT INTO article_changes(article_id) VALUE (%s);"
+        self.execute_many(sql, [(article_id,) for article_id in article_ids])
+        recent_articles.apply_many(self, article_ids)
+
+    def _article_changed(self, article_id):
+        # 他のworkerに知らせるためにログを残し，このworkerのタイムラインにはすぐ反映する
+        sql = "INSERT INTO article_changes(article_id) VALUE (%s);"
+        self.execute(sql, article_id)
+        recent_articles.apply(self, article_id)
+        versions = VersionModel(self.config)
+        versions.bump(article_key(article_id))
+        versions.bump_article_author(article_id)
+
     def fetch_article_by_id(self, article_id):
         """
         指定されたIDの記事を取得
@@ -35,6 +124,18 @@ class ArticleModel(AbstractModel):
         sql = "SELECT * FROM comments INNER JOIN profile on comments.username = profile.username WHERE comments.article_id=%s ORDER BY comments.created_at DESC"
         return self.fetch_all(sql, article_id)
 
+    def fetch_comment_page(self, article_id, cursor=None, limit=DEFAULT_PAGE_SIZE):
+        """
+        記事のコメントを新しい順に１ページ分取得する
+        :param article_id: 記事のID
+        :param cursor: 前回のPageのnext_cursorかprev_cursor．Noneなら最初のページ
+        :param limit: 1ページの件数
+        :return: Page
+        """
+        sql = "SELECT * FROM comments INNER JOIN profile on comments.username = profile.username"
+        return self.fetch_page(sql, ["comments.article_id = %s"], [article_id],
+                               ("comments.created_at", "comments.id"), cursor, limit)
+
     def fetch_article_by_username(self, username):
         """
         指定されたIDの記事を取得
@@ -50,18 +151,22 @@ class ArticleModel(AbstractModel):
         :param user_name: 投稿したユーザのusername
         :param title: 記事のタイトル
         :param body: 記事の本文
-        :return: None
+        :return: 作成した記事のID
         """
         sql = "INSERT INTO articles(username, title, body) VALUE (%s, %s, %s);"
-        self.execute(sql, user_name, title, body)
+        article_id = self.execute(sql, user_name, title, body)
+        self._article_changed(article_id)
+        return article_id
 
     def update_article(self, title, body, article_id):
         sql = "UPDATE articles SET title = %s, body = %s WHERE id = %s"
         self.execute(sql, title, body, article_id)
+        self._article_changed(article_id)
 
     def destory_article(self, article_id):
         sql = "UPDATE articles SET title = '[This post has been deleted]', body = '[Deleted]' WHERE id = %s"
         self.execute(sql, article_id)
+        self._article_changed(article_id)
 
     def find_article_by_title(self, keyword):
         if keyword is None:
@@ -92,7 +197,32 @@ class ArticleModel(AbstractModel):
             return self.fetch_all(sql, args)
 
     def post_new_comment(self, user_name, article_id, body):
+        if write_behind.enabled:
+            write_behind.add("comments", self.insert_comments, user_name, (user_name, article_id, body))
+            return
         sql = "INSERT INTO comments(username, article_id, comment) VALUE (%s, %s, %s);"
         self.execute(sql, user_name, article_id, body)
+        VersionModel(self.config).bump(article_key(article_id))
+
+    def insert_comments(self, rows):
+        """
+        write-behindで溜まったコメントを，記事ページの版と一緒に１つのトランザクションで書き込む
+        :param rows: (username, article_id, comment)のリスト
+        """
+        sql = "INSERT INTO comments(username, article_id, comment) VALUE (%s, %s, %s);"
+        with self.transaction():
+            self.execute_many(sql, rows)
+            VersionModel(self.config).bump(*{article_key(article_id) for _, article_id, _ in rows})
+
+
+class AsyncArticleModel(AsyncAbstractModel, ArticleModel):
+    """
+    ArticleModelの非同期版
+    SQLはArticleModelのものをそのまま使い，各メソッドの戻り値をawaitして受け取る
+    タイムライン(recent_articles)の読み書きと記事・コメントの書き込みは同期版のArticleModelで行う
+    """
 
-    
+    sync_only = (
+        "fetch_recent_articles_cached", "latest_article_change", "author_changed", "_article_changed",
+        "create_article", "update_article", "destory_article", "post_new_comment", "insert_comments",
+    )
@@ -0,0 +1,259 @@
+"""
+DB関連の共通処理(asyncio版)
+async defのルートからはこちらを使うと，SQLの待ち時間にスレッドを占有しない
+"""
+import asyncio
+import contextvars
+import time
+import weakref
+from collections import namedtuple
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Dict, List, Optional, Sequence, Tuple
+
+import aiomysql
+
+from app.configs import Config
+from app.models.abstract import ITER_BATCH_SIZE, ROW_DICT, ROW_NAMEDTUPLE
+from app.models.pagination import DEFAULT_PAGE_SIZE, Page, build_page_query, clamp_page_size, make_page
+from app.utilities.metrics import metrics
+
+
+_pools: Dict[tuple, aiomysql.Pool] = {}
+# asyncio.Lockは最初に使ったイベントループに紐づくので，ループごとに作る
+_pools_locks: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, asyncio.Lock]" = weakref.WeakKeyDictionary()
+# transactionの中で使っている(プール, 接続)．タスクごとに別になる
+_transaction = contextvars.ContextVar("async_transaction", default=None)
+
+
+async def get_async_pool(config: Config) -> aiomysql.Pool:
+    """
+    接続先ごとに１つのaiomysqlのプールを返す
+    プールはイベントループに紐づくので，ループもキーに含める
+    :param config: アプリケーションの設定
+    :return: aiomysqlのプール
+    """
+    loop = asyncio.get_running_loop()
+    key = (id(loop), config.mysql_host, config.mysql_username, config.mysql_database)
+    pool = _pools.get(key)
+    if pool is None:
+        lock = _pools_locks.get(loop)
+        if lock is None:
+            lock = _pools_locks[loop] = asyncio.Lock()
+        async with lock:
+            pool = _pools.get(key)
+            if pool is None:
+                pool = await aiomysql.create_pool(
+                    host=config.mysql_host,
+                    user=config.mysql_username,
+                    password=config.mysql_password,
+                    db=config.mysql_database,
+                    minsize=config.mysql_pool_min_size,
+                    maxsize=config.mysql_pool_max_size,
+                    pool_recycle=config.mysql_pool_idle_timeout,
+                    cursorclass=aiomysql.DictCursor,
+                    autocommit=True
+                )
+                _pools[key] = pool
+    return pool
+
+
+def async_pool_stats() -> List[Dict[str, int]]:
+    """
+    :return: イベントループごとのプールの接続数(size)と空いている接続数(free)
+    """
+    return [{"size": pool.size, "free": pool.freesize, "max": pool.maxsize} for pool in _pools.values()]
+
+
+async def close_async_pools() -> None:
+    """
+    作成したプールを全て閉じる．アプリ終了時に呼ぶ
+    """
+    pools = list(_pools.values())
+    _pools.clear()
+    for pool in pools:
+        pool.close()
+        await pool.wait_closed()
+
+
+def _sync_only(name: str):
+    def method(self, *args, **kwargs):
+        raise NotImplementedError("%s.%s は非同期版では使えない．同期版のモデルを使うこと" % (type(self).__name__, name))
+
+    method.__name__ = name
+    return method
+
+
+class AsyncAbstractModel(object):
+    """
+    AbstractModelのasyncio版
+    fetch_all/fetch_one/executeがawaitableになる以外はAbstractModelと同じ使い方をする
+    既存のモデルと多重継承すると，そのモデルのSQLをそのまま非同期で実行できる
+    """
+
+    # 同期版のモデルから引き継ぐが，非同期版では呼べないメソッドの名前
+    # SQLを何回も実行したり結果を使って処理を続けたりするメソッドは，戻り値をawaitしても正しく動かない
+    # (書き込みが途中までしか行われない)ので，呼んだらNotImplementedErrorを送る
+    sync_only: Tuple[str, ...] = ()
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        for name in cls.__dict__.get("sync_only", ()):
+            setattr(cls, name, _sync_only(name))
+
+    def __init__(self, config: Config):
+        """
+        初期化
+        接続はSQLを実行するたびにプールから借りて返す
+        :param config: アプリケーションの設定．ここにデータベースの情報も入っていることを想定
+        """
+        self.config = config
+
+    @asynccontextmanager
+    async def transaction(self) -> AsyncIterator["AsyncAbstractModel"]:
+        """
+        AbstractModel.transactionのasyncio版
+        async with model.transaction(): の中のSQLを１つの接続の１つのトランザクションで実行する
+        接続は１つなので，中でgatherなどを使って並行にSQLを実行しないこと
+        :return: このモデル
+        """
+        pool = await get_async_pool(self.config)
+        current = _transaction.get()
+        if current is not None and current[0] is pool:
+            yield self
+            return
+        async with pool.acquire() as connection:
+            await connection.begin()
+            token = _transaction.set((pool, connection))
+            try:
+                yield self
+                await connection.commit()
+            except BaseException:
+                await connection.rollback()
+                raise
+            finally:
+                _transaction.reset(token)
+
+    @asynccontextmanager
+    async def _connection(self) -> AsyncIterator[aiomysql.Connection]:
+        """
+        transactionの中ならその接続を，そうでなければプールから借りた接続を返す
+        """
+        pool = await get_async_pool(self.config)
+        current = _transaction.get()
+        if current is not None and current[0] is pool:
+            yield current[1]
+            return
+        async with pool.acquire() as connection:
+            yield connection
+
+    async def fetch_all(self, sql_statement: str, *args: any) -> List[Dict[str, any]]:
+        """
+        複数のレコードを取得する
+        :param sql_statement: SQL文
+        :param args: SQLに代入する値
+        :return: 取得したレコード(List)
+        """
+        async with self._connection() as connection:
+            async with connection.cursor() as cursor:
+                await self._execute(sql_statement, cursor, *args)
+                return await cursor.fetchall()
+
+    async def fetch_one(self, sql_statement, *args) -> Dict[str, any]:
+        """
+        レコードを１つだけ取得する
+        :param sql_statement: SQL文
+        :param args: SQLに代入する値
+        :return: 取得したレコード(Dict)
+        """
+        async with self._connection() as connection:
+            async with connection.cursor() as cursor:
+                await self._execute(sql_statement, cursor, *args)
+                return await cursor.fetchone()
+
+    async def iter_rows(self, sql_statement: str, *args: any, batch_size: int = ITER_BATCH_SIZE,
+                        row_type: str = ROW_DICT) -> AsyncIterator[any]:
+        """
+        サーバーサイドカーソルで，レコードをbatch_size件ずつ取り出しながら返す(引数はAbstractModel.iter_rowsと同じ)
+        async for row in model.iter_rows(...) のように使う
+        """
+        cursor_class = aiomysql.SSDictCursor if row_type == ROW_DICT else aiomysql.SSCursor
+        pool = await get_async_pool(self.config)
+        async with pool.acquire() as connection:
+            async with connection.cursor(cursor_class) as cursor:
+                await self._execute(sql_statement, cursor, *args)
+                make_row = None
+                if row_type == ROW_NAMEDTUPLE:
+                    row_class = namedtuple("Row", [column[0] for column in cursor.description], rename=True)
+                    make_row = row_class._make
+                while True:
+                    rows = await cursor.fetchmany(batch_size)
+                    if not rows:
+                        break
+                    for row in rows:
+                        yield row if make_row is None else make_row(row)
+
+    async def fetch_page(self, sql_statement: str, conditions: List[str], args: list, keys: Sequence[str],
+                         cursor: Optional[str] = None, limit: int = DEFAULT_PAGE_SIZE) -> Page:
+        """
+        カーソルを使って１ページ分のレコードを取得する(引数はAbstractModel.fetch_pageと同じ)
+        """
+        limit = clamp_page_size(limit)
+        sql, values, direction = build_page_query(sql_statement, conditions, args, keys, cursor, limit)
+        return make_page(await self.fetch_all(sql, *values), keys, limit, direction)
+
+    async def execute(self, sql_statement, *args) -> int:
+        """
+        結果を返さないSQLを実行する
+        :param sql_statement: SQL文
+        :param args: SQLに代入する値
+        :return: INSERTの場合はAUTO_INCREMENTで採番されたID
+        """
+        async with self._connection() as connection:
+            async with connection.cursor() as cursor:
+                await self._execute(sql_statement, cursor, *args)
+                return cursor.lastrowid
+
+    async def execute_rowcount(self, sql_statement: str, *args: any) -> int:
+        """
+        結果を返さないSQLを実行する
+        :param sql_statement: SQL文
+        :param args: SQLに代入する値
+        :return: 変更された行数
+        """
+        async with self._connection() as connection:
+            async with connection.cursor() as cursor:
+                await self._execute(sql_statement, cursor, *args)
+                return cursor.rowcount
+
+    async def execute_many(self, sql_statement: str, rows: List[tuple]) -> None:
+        """
+        同じSQLを複数の値で実行する
+        INSERT ... VALUE (%s, ...) の形なら，aiomysqlが１つの複数行INSERTにまとめる
+        :param sql_statement: SQL文
+        :param rows: SQLに代入する値のリスト
+        :return:
+        """
+        async with self._connection() as connection:
+            async with connection.cursor() as cursor:
+                await self._execute_many(sql_statement, cursor, rows)
+
+    async def _execute_many(self, sql_statement: str, cursor: aiomysql.Cursor, rows: List[tuple]) -> None:
+        started = time.perf_counter()
+        try:
+            await cursor.executemany(sql_statement, rows)
+        finally:
+            metrics.record_query(sql_statement, time.perf_counter() - started)
+
+    async def _execute(self, sql_statement: str, cursor: aiomysql.Cursor, *args: any) -> None:
+        """
+        SQLを実行する．fetchとかはやらない.
+        :param sql_statement: SQL文
+        :param cursor: aiomysqlのカーソル
+        :param args: SQLに代入する値
+        :return:
+        """
+        started = time.perf_counter()
+        try:
+            await cursor.execute(sql_statement, args)
+        finally:
+            metrics.record_query(sql_statement, time.perf_counter() - started)
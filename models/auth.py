@@ -2,9 +2,31 @@
 ログイン関連の処理をここに書く
 """
 from gettext import find
-from .abstract import AbstractModel
+import asyncio
+from .abstract import AbstractModel, ROW_TUPLE
+from .articles import ArticleModel
+from .async_abstract import AsyncAbstractModel
+from .pagination import DEFAULT_PAGE_SIZE
+from .versions import AsyncVersionModel, VersionModel, pub_key, user_key
+from app.configs import Config
+from app.utilities.cache import TTLCache
+from app.utilities.matching import MatchingIndex
+from app.utilities.reference import ReferenceData, ReferenceRegistry
+from app.utilities.write_behind import write_behind
 
 from hashlib import sha256
+import pymysql
+from pymysql.constants import ER
+
+# username -> プロフィール．ヘッダー表示のために毎リクエスト引くのでキャッシュする
+# 他のworkerで更新された場合はprofile_cache_ttl秒以内に反映される
+profile_cache = TTLCache(Config.profile_cache_size, Config.profile_cache_ttl)
+
+# クラブ，リーグ，国の一覧．起動時に読み込み，reference_data_ttl秒ごとに読み直す
+reference_registry = ReferenceRegistry(Config.reference_data_ttl)
+
+# /matching 用に，ユーザを好きなクラブ，リーグ，国で分けたもの
+matching_index = MatchingIndex(Config.matching_index_ttl)
 
 
 class AuthModel(AbstractModel):
@@ -39,6 +61,25 @@ class AuthModel(AbstractModel):
         sql = "INSERT INTO users(username, password) VALUE (%s, %s);"
         self.execute(sql, username, hashed_password)
 
+    def register(self, username, password):
+        """
+        ユーザとプロフィールを１つのトランザクションで作成する
+        同じユーザ名の登録が同時に来ても，主キーで片方だけが成功する
+        :param username: ユーザ名
+        :param password: パスワード
+        :return: 作成したユーザ．ユーザ名が既に使われていればNone
+        """
+        try:
+            with self.transaction():
+                self.create_user(username, password)
+                user = self.find_user_by_name_and_password(username, password)
+                self.add_profile_info(username)
+        except pymysql.err.IntegrityError as e:
+            if e.args[0] != ER.DUP_ENTRY:
+                raise
+            return None
+        return user
+
     def find_user_by_name_and_password(self, username, password):
         """
         ユーザ名とパスワードからユーザを探す
@@ -64,9 +105,25 @@ class AuthModel(AbstractModel):
         sql = "SELECT * FROM users INNER JOIN profile on users.username = profile.username where profile.username=%s"
         return self.fetch_one(sql, user_name)
 
+    def find_profile_by_user_id_cached(self, user_name):
+        """
+        find_profile_by_user_idの結果をprofile_cache_ttl秒キャッシュする
+        :param user_name: 検索するユーザ名
+        :return: 検索したユーザ
+        """
+        user = profile_cache.get(user_name)
+        if user is None:
+            user = self.find_profile_by_user_id(user_name)
+            if user:
+                profile_cache.set(user_name, user)
+        return user
+
     def add_profile_info(self, username):
         sql = "INSERT INTO profile(username) VALUE (%s)"
         self.execute(sql, username)
+        profile_cache.invalidate(username)
+        matching_index.refresh_user(self, username)
+        VersionModel(self.config).bump(user_key(username))
 
     def logout(self):
         pass
@@ -82,6 +139,11 @@ class AuthModel(AbstractModel):
     def profile_update(self, nickname, yourclub, yourleague, yournation, profile, twitter, instagram, socialmedia, user_name):
         sql = "UPDATE profile SET nickname  = %s, your_club = %s, your_league = %s, your_nation = %s, profile = %s, twitter = %s, instagram = %s, SNS = %s WHERE username = %s;"
         self.execute(sql, nickname, yourclub, yourleague, yournation, profile, twitter, instagram, socialmedia, user_name)
+        profile_cache.invalidate(user_name)
+        matching_index.refresh_user(self, user_name)
+        # /articles のタイムラインの記事にもニックネームが入っている
+        ArticleModel(self.config).author_changed(user_name)
+        VersionModel(self.config).bump(user_key(user_name))
 
     def find_rooms_by_keyword(self, keyword):
         """
@@ -118,11 +180,36 @@ class AuthModel(AbstractModel):
         sql = "SELECT * FROM users INNER JOIN profile on users.username = profile.username"
         return self.fetch_all(sql)
 
-    def fetch_fans(self, your_club, your_league, your_nation):
-        sql = "SELECT * FROM users INNER JOIN profile on users.username = profile.username where profile.your_club = %s"
-        sql2 = "SELECT * FROM users INNER JOIN profile on users.username = profile.username where profile.your_league = %s"
-        sql3 = "SELECT * FROM users INNER JOIN profile on users.username = profile.username where profile.your_nation = %s"
-        return self.fetch_all(sql, your_club), self.fetch_all(sql2, your_league), self.fetch_all(sql3, your_nation)
+    def iter_fans(self):
+        """
+        全ユーザのおすすめに使う列だけを，リストにせずに少しずつ読む
+        :return: (username, nickname, created_at, your_club, your_league, your_nation) のタプルのジェネレータ
+        """
+        sql = "SELECT users.username, profile.nickname, users.created_at, " \
+              "profile.your_club, profile.your_league, profile.your_nation " \
+              "FROM users INNER JOIN profile on users.username = profile.username"
+        return self.iter_rows(sql, batch_size=1000, row_type=ROW_TUPLE)
+
+    def fetch_fans_page(self, cursor=None, limit=DEFAULT_PAGE_SIZE):
+        """
+        ユーザを新しい順に１ページ分取得する
+        :param cursor: 前回のPageのnext_cursorかprev_cursor．Noneなら最初のページ
+        :param limit: 1ページの件数
+        :return: Page
+        """
+        sql = "SELECT * FROM users INNER JOIN profile on users.username = profile.username"
+        return self.fetch_page(sql, [], [], ("users.created_at", "users.username"), cursor, limit)
+
+    def fan_suggestions(self, user, exclude=None, cursor=None, limit=DEFAULT_PAGE_SIZE):
+        """
+        好きなクラブ，リーグ，国が同じユーザを，共通点の多い順にメモリ上のインデックスから返す
+        :param user: ログイン中のユーザのプロフィール
+        :param exclude: 候補のユーザ名のリストから除外するもの(フォロー済みのユーザなど)のsetを返す関数
+        :param cursor: 前回のPageのnext_cursorかprev_cursor．Noneなら最初のページ
+        :param limit: 1ページの件数
+        :return: Page
+        """
+        return matching_index.suggestions(self, user, exclude, cursor, limit)
 
     def find_users_by_keyword(self, keyword, findenAus):
         status = "user"
@@ -163,23 +250,34 @@ class AuthModel(AbstractModel):
         sql = "SELECT * FROM nations"
         return self.fetch_all(sql)
 
+    def reference_data(self) -> ReferenceData:
+        """
+        クラブ，リーグ，国の一覧をメモリから返す．MySQLを読むのは初回と期限切れの時だけ
+        :return: ReferenceData
+        """
+        return reference_registry.get(self)
+
 
     def create_new_pub(self, community_id, community_name, community_comment, user_name):
         """
-        ユーザ名とパスワードからユーザを探す
-        ユーザが存在しない場合，空の辞書を返す
-        :param username: 検索するユーザ名
-        :param password: 検索するパスワード
-        :return: 検索したユーザ
+        Pubを作成し，Pubと作成したユーザのページの版を同じトランザクションで上げる
+        IDが使われているかは先に確認せず，主キーの重複で判定する(同時に同じIDで作成しても片方だけが成功する)
+        :param community_id: PubのID
+        :param community_name: Pubの名前
+        :param community_comment: Pubの説明
+        :param user_name: 作成したユーザ
+        :return: 作成できたかどうか(同じIDのPubが既にあればFalse)
         """
-        is_exist = self.validate_pub(community_id)
-        if is_exist == False:
-            sql = "INSERT INTO pubs(pub_id, pub_name, pub_comment, created_by) VALUE (%s, %s, %s, %s);" 
-            # ID
-            self.execute(sql, community_id, community_name, community_comment, user_name)
-            return True
-        else:
+        sql = "INSERT INTO pubs(pub_id, pub_name, pub_comment, created_by) VALUE (%s, %s, %s, %s);"
+        try:
+            with self.transaction():
+                self.execute(sql, community_id, community_name, community_comment, user_name)
+                VersionModel(self.config).bump(pub_key(community_id), user_key(user_name))
+        except pymysql.err.IntegrityError as e:
+            if e.args[0] != ER.DUP_ENTRY:
+                raise
             return False
+        return True
 
     def find_your_following_community(self, user_name):
         sql = "SELECT * FROM followpub INNER JOIN pubs on followpub.pub = pubs.pub_id where followpub.user=%s"
@@ -209,6 +307,19 @@ class AuthModel(AbstractModel):
         sql = "SELECT * FROM message INNER JOIN profile on message.username = profile.username where message.pub_id=%s ORDER BY message.created_at DESC"
         return self.fetch_all(sql, pub_id)
 
+    def find_discussion_page_by_pub_id(self, pub_id, cursor=None, limit=DEFAULT_PAGE_SIZE, stream=False):
+        """
+        Pubのディスカッションを新しい順に１ページ分取得する
+        :param pub_id: PubのID
+        :param cursor: 前回のPageのnext_cursorかprev_cursor．Noneなら最初のページ
+        :param limit: 1ページの件数
+        :param stream: Trueならストリーミングで描画するためのPageStreamを返す
+        :return: PageかPageStream
+        """
+        sql = "SELECT * FROM message INNER JOIN profile on message.username = profile.username"
+        fetch = self.stream_page if stream else self.fetch_page
+        return fetch(sql, ["message.pub_id = %s"], [pub_id], ("message.created_at", "message.id"), cursor, limit)
+
     def create_new_discussion(self, pub_id, user_name, status, discuss_title, body):
         sql = "INSERT INTO message(pub_id, username, status, title, body) VALUE (%s, %s, %s, %s, %s);"
         self.execute(sql, pub_id, user_name, status, discuss_title, body)
@@ -263,14 +374,38 @@ class AuthModel(AbstractModel):
         sql = "SELECT * FROM followpub INNER JOIN profile on followpub.user = profile.username where followpub.pub = %s"
         return self.fetch_all(sql, pub_id)
 
+    def pub_member_page(self, pub_id, cursor=None, limit=DEFAULT_PAGE_SIZE):
+        """
+        Pubのメンバーを１ページ分取得する
+        followpubには作成日時がないので，一意なidの順に並べる
+        :param pub_id: PubのID
+        :param cursor: 前回のPageのnext_cursorかprev_cursor．Noneなら最初のページ
+        :param limit: 1ページの件数
+        :return: Page
+        """
+        sql = "SELECT * FROM followpub INNER JOIN profile on followpub.user = profile.username"
+        return self.fetch_page(sql, ["followpub.pub = %s"], [pub_id], ("followpub.id",), cursor, limit)
+
     def fetch_discussion_commnet_comments_by_id(self, commeid):
         sql = "SELECT * FROM discuss_comment_comments INNER JOIN profile on discuss_comment_comments.username = profile.username where discuss_comment_comments.discussion_id=%s"
         return self.fetch_all(sql, commeid)
 
     def post_discussion_comment(self, user_name, topic_id, body):
+        if write_behind.enabled:
+            write_behind.add("discuss_comments", self.insert_discussion_comments, user_name,
+                             (user_name, topic_id, body))
+            return
         sql = "INSERT INTO discuss_comments(username, message_id, context) VALUE (%s, %s, %s);"
         self.execute(sql, user_name, topic_id, body)
 
+    def insert_discussion_comments(self, rows):
+        """
+        write-behindで溜まったコメントを１回の複数行INSERTで書き込む
+        :param rows: (username, message_id, context)のリスト
+        """
+        sql = "INSERT INTO discuss_comments(username, message_id, context) VALUE (%s, %s, %s);"
+        self.execute_many(sql, rows)
+
     def update_discussion_page(self, status, title, body, discussion_id):
         sql = "UPDATE message SET status = %s, title = %s, body = %s WHERE id = %s;"
         self.execute(sql, status, title, body, discussion_id)
@@ -280,54 +415,80 @@ class AuthModel(AbstractModel):
         self.execute(sql, context, discussion_comment_id)
 
     def post_discussion_comment_comment(self, user_name, comment_id, body):
+        if write_behind.enabled:
+            write_behind.add("discuss_comment_comments", self.insert_discussion_comment_comments, user_name,
+                             (user_name, comment_id, body))
+            return
         sql = "INSERT INTO discuss_comment_comments(username, discussion_comment_id, context) VALUE (%s, %s, %s);"
         self.execute(sql, user_name, comment_id, body)
 
-    def follow_user(self, username, user_name, follow_id):
-        sql = "INSERT IGNORE INTO follow(to_user_id, from_user_id, id) VALUE (%s, %s, %s);"
-        self.execute(sql, username, user_name, follow_id)
-
-    def unfollow_user(self, username, user_name):
-        sql = "DELETE FROM follow WHERE to_user_id = %s AND from_user_id = %s"
-        self.execute(sql, username, user_name)
-
-    def get_followings(self, username):
-        sql = "SELECT * FROM follow WHERE from_user_id = %s"
-        return self.fetch_all(sql, username)
-
-    def get_followers(self, username):
-        sql = "SELECT * FROM follow WHERE to_user_id = %s"
-        return self.fetch_all(sql, username)
-
-    def detect_follow(self, follow_id):
-        sql = "SELECT * FROM follow WHERE id = %s"
-        return self.fetch_all(sql, follow_id)
+    def insert_discussion_comment_comments(self, rows):
+        """
+        write-behindで溜まった返信を１回の複数行INSERTで書き込む
+        :param rows: (username, discussion_comment_id, context)のリスト
+        """
+        sql = "INSERT INTO discuss_comment_comments(username, discussion_comment_id, context) VALUE (%s, %s, %s);"
+        self.execute_many(sql, rows)
 
+    # def pub_update(self, pub_name, pub_comment, pub_id):
+    #     sql = "UPDATE pubs SET pub_name = %s, pub_comment = %s WHERE pubs.pub_id = %s;"
+    #     self.execute(sql, pub_name, pub_comment, pub_id)
 
-    def follow_pub(self, pub_id, user_name, follow_id):
-        sql = "INSERT IGNORE INTO followpub(pub, user, id) VALUE (%s, %s, %s);"
-        self.execute(sql, pub_id, user_name, follow_id)
 
-    def unfollow_pub(self, pub_id, user_name):
-        sql = "DELETE FROM followpub WHERE pub = %s AND user = %s"
-        self.execute(sql, pub_id, user_name)
+class AsyncAuthModel(AsyncAbstractModel, AuthModel):
+    """
+    AuthModelの非同期版
+    SQLはAuthModelのものをそのまま使い，各メソッドの戻り値をawaitして受け取る
+    取得結果を加工しているメソッドだけはここで上書きする
+    ユーザ・プロフィール・ディスカッションの書き込みは同期版のAuthModelで行う
+    """
 
-    def get_pub_followings(self, username):
-        sql = "SELECT * FROM followpub WHERE user = %s"
-        return self.fetch_all(sql, username)
+    sync_only = (
+        "create_user", "register", "add_profile_info", "profile_update", "find_profile_by_user_id_cached",
+        "reference_data", "create_new_discussion", "post_discussion_comment", "insert_discussion_comments",
+        "update_discussion_page", "update_discussion_comment_page", "post_discussion_comment_comment",
+        "insert_discussion_comment_comments",
+    )
 
-    def get_pub_followers(self, pub_id):
-        sql = "SELECT * FROM followpub WHERE pub = %s"
-        return self.fetch_all(sql, pub_id)
+    async def login(self, username, password):
+        user = await self.find_user_by_name_and_password(username, password)
+        if not user:
+            return False, None
+        return True, user
 
-    def detect_pub_follow(self, follow_id):
-        sql = "SELECT * FROM followpub WHERE id = %s"
-        return self.fetch_all(sql, follow_id)
+    async def find_rooms_by_keyword(self, keyword):
+        rooms, status = super().find_rooms_by_keyword(keyword)
+        return await rooms, status
 
-    # def pub_update(self, pub_name, pub_comment, pub_id):
-    #     sql = "UPDATE pubs SET pub_name = %s, pub_comment = %s WHERE pubs.pub_id = %s;"
-    #     self.execute(sql, pub_name, pub_comment, pub_id)
+    async def find_pubs_by_keyword(self, keyword, findenAus):
+        pubs, status = super().find_pubs_by_keyword(keyword, findenAus)
+        return await pubs, status
 
+    async def find_users_by_keyword(self, keyword, findenAus):
+        users, status = super().find_users_by_keyword(keyword, findenAus)
+        return await users, status
 
+    async def fan_suggestions(self, user, exclude=None, cursor=None, limit=DEFAULT_PAGE_SIZE):
+        """
+        AuthModel.fan_suggestionsの非同期版．excludeはawaitableを返す関数にする
+        インデックスを作り直す時だけ，全ユーザを読むのでスレッドで同期版のモデルを使う
+        """
+        await asyncio.to_thread(matching_index.ensure, AuthModel(self.config))
+        return await matching_index.suggestions_async(user, exclude, cursor, limit)
 
-    
+    async def validate_pub(self, community_id) -> bool:
+        sql = "SELECT * FROM pubs WHERE pub_id=%s"
+        result = await self.fetch_all(sql, community_id)
+        return len(result) > 0
+
+    async def create_new_pub(self, community_id, community_name, community_comment, user_name):
+        sql = "INSERT INTO pubs(pub_id, pub_name, pub_comment, created_by) VALUE (%s, %s, %s, %s);"
+        try:
+            async with self.transaction():
+                await self.execute(sql, community_id, community_name, community_comment, user_name)
+                await AsyncVersionModel(self.config).bump(pub_key(community_id), user_key(user_name))
+        except pymysql.err.IntegrityError as e:
+            if e.args[0] != ER.DUP_ENTRY:
+                raise
+            return False
+        return True
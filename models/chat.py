@@ -0,0 +1,41 @@
+"""
+チャットの履歴モデル
+"""
+from app.models.abstract import AbstractModel
+from app.models.async_abstract import AsyncAbstractModel
+
+
+class ChatModel(AbstractModel):
+    def __init__(self, config):
+        super(ChatModel, self).__init__(config)
+
+    def insert_messages(self, rows):
+        """
+        チャットのメッセージをまとめて保存する
+        :param rows: (pub_id, nickname, message, created_at) のリスト
+        :return: None
+        """
+        sql = "INSERT INTO chat_messages(pub_id, nickname, message, created_at) VALUE (%s, %s, %s, %s);"
+        self.execute_many(sql, rows)
+
+    def fetch_history(self, pub_id, before_id=None, limit=50):
+        """
+        チャットの履歴を新しい順に取得する
+        idをカーソルにするので，どれだけ遡ってもインデックス(pub_id, id)の範囲読みで済む
+        :param pub_id: ルーム(Pub)のID
+        :param before_id: このidより古いメッセージを取得する．Noneなら最新から
+        :param limit: 取得する件数
+        :return: メッセージのリスト(新しい順)
+        """
+        if before_id is None:
+            sql = "SELECT * FROM chat_messages WHERE pub_id = %s ORDER BY id DESC LIMIT %s"
+            return self.fetch_all(sql, pub_id, limit)
+        sql = "SELECT * FROM chat_messages WHERE pub_id = %s AND id < %s ORDER BY id DESC LIMIT %s"
+        return self.fetch_all(sql, pub_id, before_id, limit)
+
+
+class AsyncChatModel(AsyncAbstractModel, ChatModel):
+    """
+    ChatModelの非同期版
+    """
+    pass
@@ -0,0 +1,106 @@
+"""
+ディスカッションのスレッド(トピック，コメント，コメントへの返信)をまとめて読み込む
+３つのテーブルを UNION ALL で１回のSQLにし，親子関係は取得した行を１回なめるだけで組み立てる
+"""
+from collections import defaultdict
+from typing import Dict, List, NamedTuple, Optional
+
+from app.models.abstract import AbstractModel
+from app.models.async_abstract import AsyncAbstractModel
+
+# kind: topic/comment/reply，parent_id: コメントならトピックのid，返信ならコメントのid
+THREAD_SQL = (
+    "SELECT 'topic' AS kind, message.id, NULL AS parent_id, message.username, profile.nickname, "
+    "message.body, message.created_at, message.status, message.title, message.pub_id "
+    "FROM message INNER JOIN profile on message.username = profile.username WHERE message.id = %s "
+    "UNION ALL "
+    "SELECT 'comment', discuss_comments.id, discuss_comments.message_id, discuss_comments.username, "
+    "profile.nickname, discuss_comments.context, discuss_comments.created_at, NULL, NULL, NULL "
+    "FROM discuss_comments INNER JOIN profile on discuss_comments.username = profile.username "
+    "WHERE discuss_comments.message_id = %s "
+    "UNION ALL "
+    "SELECT 'reply', discuss_comment_comments.id, discuss_comment_comments.discussion_comment_id, "
+    "discuss_comment_comments.username, profile.nickname, discuss_comment_comments.context, "
+    "discuss_comment_comments.created_at, NULL, NULL, NULL "
+    "FROM discuss_comment_comments "
+    "INNER JOIN discuss_comments on discuss_comment_comments.discussion_comment_id = discuss_comments.id "
+    "INNER JOIN profile on discuss_comment_comments.username = profile.username "
+    "WHERE discuss_comments.message_id = %s "
+    "ORDER BY created_at, id"
+)
+
+
+class ThreadComment(object):
+    """
+    コメントか返信１つ
+    テンプレートからは今まで通り comment["context"] のように参照できる
+    """
+
+    __slots__ = ("id", "parent_id", "username", "nickname", "context", "created_at", "replies")
+
+    def __init__(self, row: Dict[str, any], replies: List["ThreadComment"]):
+        self.id = row["id"]
+        self.parent_id = row["parent_id"]
+        self.username = row["username"]
+        self.nickname = row["nickname"]
+        self.context = row["body"]
+        self.created_at = row["created_at"]
+        self.replies = replies
+
+    def __getitem__(self, key: str) -> any:
+        return getattr(self, key)
+
+
+class DiscussionThread(NamedTuple):
+    """
+    topic: トピック(id, username, nickname, body, created_at, status, title, pub_id)
+    comments: コメント(古い順)．それぞれのrepliesに返信が古い順に入っている
+    """
+    topic: Dict[str, any]
+    comments: List[ThreadComment]
+
+
+def build_thread(rows: List[Dict[str, any]]) -> Optional[DiscussionThread]:
+    """
+    THREAD_SQLの結果からスレッドを組み立てる
+    :param rows: 作成日時の順に並んだ行
+    :return: DiscussionThread．トピックがなければNone
+    """
+    topic = None
+    comments = []
+    # コメントのid -> 返信のリスト．コメントより先に返信が来ても同じリストに入る
+    replies: Dict[int, List[ThreadComment]] = defaultdict(list)
+    for row in rows:
+        kind = row["kind"]
+        if kind == "comment":
+            comments.append(ThreadComment(row, replies[row["id"]]))
+        elif kind == "reply":
+            replies[row["parent_id"]].append(ThreadComment(row, []))
+        else:
+            topic = {key: row[key] for key in
+                     ("id", "username", "nickname", "body", "created_at", "status", "title", "pub_id")}
+    if topic is None:
+        return None
+    return DiscussionThread(topic, comments)
+
+
+class DiscussionModel(AbstractModel):
+    def __init__(self, config):
+        super(DiscussionModel, self).__init__(config)
+
+    def load_thread(self, message_id):
+        """
+        トピックとコメント，返信を１回のSQLで取得する
+        :param message_id: トピック(message)のID
+        :return: DiscussionThread．トピックがなければNone
+        """
+        return build_thread(self.fetch_all(THREAD_SQL, message_id, message_id, message_id))
+
+
+class AsyncDiscussionModel(AsyncAbstractModel, DiscussionModel):
+    """
+    DiscussionModelの非同期版
+    """
+
+    async def load_thread(self, message_id):
+        return build_thread(await self.fetch_all(THREAD_SQL, message_id, message_id, message_id))
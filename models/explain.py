@@ -0,0 +1,180 @@
+"""
+モデルのクエリの実行計画の確認
+CHECKSに登録したモデルのメソッドを，SQLを実行する代わりにEXPLAINするモデルで呼び出し，
+フルスキャン(type = ALL)になったテーブルがあれば失敗にする
+
+    python -m app.models.migration check
+
+ページや画面で使うSELECTを追加した時は，CHECKSにも追加する
+"""
+import datetime
+import logging
+from typing import Callable, Dict, List, NamedTuple, Tuple
+
+from app.configs import Config
+from app.models.articles import ArticleModel
+from app.models.auth import AuthModel
+from app.models.chat import ChatModel
+from app.models.discussion import DiscussionModel
+from app.models.follow import FollowGraphModel
+from app.models.pagination import NEXT, PREV, encode_cursor
+from app.models.search import SEARCH_TARGETS, SearchModel
+from app.models.versions import VersionModel, article_key, user_key
+
+logger = logging.getLogger(__name__)
+
+# 全件読むのが前提の小さなテーブル
+ALLOWED_FULL_SCAN_TABLES = {"clubs", "leagues", "nations"}
+# 使えるインデックスがあっても，テーブルが小さいとMySQLはフルスキャンを選ぶ
+# その場合はこれより少ない行数の見積もりなら許す(インデックスがなければ行数に関わらず失敗)
+FULL_SCAN_MIN_ROWS = 1000
+
+# EXPLAINに渡す値．実在しなくてよい
+SAMPLE_USER = "explain_user"
+SAMPLE_OTHER_USER = "explain_other"
+SAMPLE_PUB = "explain_pub"
+SAMPLE_ID = 1
+SAMPLE_TIME = str(datetime.datetime(2023, 1, 1))
+
+
+class Check(NamedTuple):
+    name: str
+    model: type
+    call: Callable
+
+
+def _search_checks() -> List[Check]:
+    checks = []
+    for (kind, field), target in SEARCH_TARGETS.items():
+        scope = SAMPLE_PUB if target.scope else None
+        # FULLTEXT(2文字以上)，前方一致(1文字)，検索語なし(新しい順)のそれぞれ
+        for label, query in (("match", "ゴール"), ("prefix", "g"), ("recent", None)):
+            checks.append(Check("SearchModel.search(%s, %s, %s)" % (kind, field, label), SearchModel,
+                                lambda model, kind=kind, field=field, query=query, scope=scope:
+                                model.search(kind, field, query, scope=scope)))
+    return checks
+
+
+CHECKS: List[Check] = [
+    Check("ArticleModel.fetch_recent_articles_page", ArticleModel,
+          lambda model: model.fetch_recent_articles_page()),
+    Check("ArticleModel.fetch_recent_articles_page(next)", ArticleModel,
+          lambda model: model.fetch_recent_articles_page(encode_cursor(NEXT, [SAMPLE_TIME, SAMPLE_ID]))),
+    Check("ArticleModel.fetch_articles_by_ids", ArticleModel, lambda model: model.fetch_articles_by_ids([1, 2, 3])),
+    Check("ArticleModel.fetch_article_changes", ArticleModel, lambda model: model.fetch_article_changes(SAMPLE_ID)),
+    Check("ArticleModel.fetch_article_by_id", ArticleModel, lambda model: model.fetch_article_by_id(SAMPLE_ID)),
+    Check("ArticleModel.fetch_comment_page", ArticleModel, lambda model: model.fetch_comment_page(SAMPLE_ID)),
+    Check("ArticleModel.fetch_comment_page(prev)", ArticleModel,
+          lambda model: model.fetch_comment_page(SAMPLE_ID, encode_cursor(PREV, [SAMPLE_TIME, SAMPLE_ID]))),
+    Check("ArticleModel.fetch_article_by_username", ArticleModel,
+          lambda model: model.fetch_article_by_username(SAMPLE_USER)),
+    Check("AuthModel.find_user_by_name_and_password", AuthModel,
+          lambda model: model.find_user_by_name_and_password(SAMPLE_USER, "password")),
+    Check("AuthModel.find_profile_by_user_id", AuthModel, lambda model: model.find_profile_by_user_id(SAMPLE_USER)),
+    Check("AuthModel.find_other_users_by_username", AuthModel,
+          lambda model: model.find_other_users_by_username(SAMPLE_USER)),
+    Check("AuthModel.validate_pub", AuthModel, lambda model: model.validate_pub(SAMPLE_PUB)),
+    Check("AuthModel.find_pub_by_id", AuthModel, lambda model: model.find_pub_by_id(SAMPLE_PUB)),
+    Check("AuthModel.find_pub_by_created_by", AuthModel, lambda model: model.find_pub_by_created_by(SAMPLE_USER)),
+    Check("AuthModel.find_your_following_community", AuthModel,
+          lambda model: model.find_your_following_community(SAMPLE_USER)),
+    Check("AuthModel.find_discussion_page_by_pub_id", AuthModel,
+          lambda model: model.find_discussion_page_by_pub_id(SAMPLE_PUB)),
+    Check("AuthModel.find_discussion_page_by_pub_id(next)", AuthModel,
+          lambda model: model.find_discussion_page_by_pub_id(SAMPLE_PUB, encode_cursor(NEXT, [SAMPLE_TIME, SAMPLE_ID]))),
+    Check("AuthModel.find_discussion_by_id", AuthModel, lambda model: model.find_discussion_by_id(SAMPLE_ID)),
+    Check("AuthModel.find_discussion_comment_by_id", AuthModel,
+          lambda model: model.find_discussion_comment_by_id(SAMPLE_ID)),
+    Check("AuthModel.pub_member_page", AuthModel, lambda model: model.pub_member_page(SAMPLE_PUB)),
+    Check("AuthModel.fetch_fans_page", AuthModel, lambda model: model.fetch_fans_page()),
+    Check("AuthModel.clubs_list", AuthModel, lambda model: model.clubs_list()),
+    Check("DiscussionModel.load_thread", DiscussionModel, lambda model: model.load_thread(SAMPLE_ID)),
+    Check("FollowGraphModel.user_counts", FollowGraphModel, lambda model: model.user_counts(SAMPLE_USER)),
+    Check("FollowGraphModel.pub_follower_count", FollowGraphModel,
+          lambda model: model.pub_follower_count(SAMPLE_PUB)),
+    Check("FollowGraphModel.relation", FollowGraphModel,
+          lambda model: model.relation(SAMPLE_USER, SAMPLE_OTHER_USER)),
+    Check("FollowGraphModel.is_following_pub", FollowGraphModel,
+          lambda model: model.is_following_pub(SAMPLE_USER, SAMPLE_PUB)),
+    Check("FollowGraphModel.following_among", FollowGraphModel,
+          lambda model: model.following_among(SAMPLE_USER, [SAMPLE_OTHER_USER])),
+    Check("FollowGraphModel.followers_page", FollowGraphModel, lambda model: model.followers_page(SAMPLE_USER)),
+    Check("FollowGraphModel.followings_page", FollowGraphModel, lambda model: model.followings_page(SAMPLE_USER)),
+    Check("ChatModel.fetch_history", ChatModel, lambda model: model.fetch_history(SAMPLE_PUB)),
+    Check("ChatModel.fetch_history(before)", ChatModel, lambda model: model.fetch_history(SAMPLE_PUB, SAMPLE_ID)),
+    Check("VersionModel.versions", VersionModel,
+          lambda model: model.versions([article_key(SAMPLE_ID), user_key(SAMPLE_USER)])),
+] + _search_checks()
+
+
+class ExplainMixin(object):
+    """
+    _executeでSQLの代わりにEXPLAINを実行し，その結果をplansに溜める
+    呼び出し元にはEXPLAINの行が返るので，メソッドの戻り値は使わない
+    """
+
+    def _execute(self, sql_statement, cursor, *args):
+        explain = "EXPLAIN " + sql_statement
+        # 計画を取る前に失敗したら，explainがそのSQLのエラーとして扱う
+        self.explaining = sql_statement
+        super(ExplainMixin, self)._execute(explain, cursor, *args)
+        self.plans.append((sql_statement, cursor.fetchall()))
+        # 呼び出し元がfetchできるように，もう一度実行しておく
+        super(ExplainMixin, self)._execute(explain, cursor, *args)
+        self.explaining = None
+
+
+def explain(config: Config, check: Check) -> List[Tuple[str, List[Dict[str, any]]]]:
+    """
+    :return: checkが実行したSQLとEXPLAINの結果のリスト
+    """
+    model_class = type("Explain" + check.model.__name__, (ExplainMixin, check.model), {})
+    model = model_class(config)
+    model.plans = []
+    model.explaining = None
+    try:
+        check.call(model)
+    except (TypeError, KeyError, IndexError):
+        # EXPLAINの行を本来の結果として加工しようとして失敗したものは，計画が取れているので無視する
+        # SQLのエラーや，計画を取れていないSQLでの失敗はそのまま返す
+        if model.explaining is not None or not model.plans:
+            raise
+    return model.plans
+
+
+def full_scans(plan: List[Dict[str, any]]) -> List[Dict[str, any]]:
+    """
+    :param plan: EXPLAINの結果
+    :return: 許されないフルスキャンの行
+    """
+    problems = []
+    for row in plan:
+        table = row.get("table") or ""
+        if row.get("type") != "ALL" or table.startswith("<") or table in ALLOWED_FULL_SCAN_TABLES:
+            continue
+        if row.get("possible_keys") and (row.get("rows") or 0) < FULL_SCAN_MIN_ROWS:
+            continue
+        problems.append(row)
+    return problems
+
+
+def check_queries(config: Config) -> bool:
+    """
+    CHECKSの全てのクエリをEXPLAINして結果を表示する
+    :return: フルスキャンがなければTrue
+    """
+    ok = True
+    for check in CHECKS:
+        plans = explain(config, check)
+        if not plans:
+            print("?? %s: no query was executed" % check.name)
+            continue
+        for sql, plan in plans:
+            problems = full_scans(plan)
+            summary = ", ".join("%s:%s(%s)" % (row.get("table"), row.get("type"), row.get("key") or "-")
+                                for row in plan)
+            print("%s %s: %s" % ("NG" if problems else "ok", check.name, summary))
+            if problems:
+                ok = False
+                print("   %s" % sql)
+    return ok
@@ -0,0 +1,276 @@
+"""
+フォロー関係(ユーザ -> ユーザ，ユーザ -> Pub)
+ページに必要なのはほとんど数とフォローしているかどうかなので，
+フォロー数は集計テーブルに持ち，フォロー・解除と同じトランザクションで更新する
+集計テーブルは migrations/0003_follow_counts.sql
+"""
+from typing import Dict, List, Tuple
+
+from app.models.abstract import AbstractModel
+from app.models.async_abstract import AsyncAbstractModel
+from app.models.pagination import DEFAULT_PAGE_SIZE
+from app.models.versions import BUMP_SQL, pub_key, user_key
+from app.utilities.write_behind import write_behind
+
+USER_COUNTER_SQL = (
+    "INSERT INTO user_follow_counts(username, followers, followings) VALUE (%s, %s, %s) "
+    "ON DUPLICATE KEY UPDATE followers = GREATEST(followers + VALUES(followers), 0), "
+    "followings = GREATEST(followings + VALUES(followings), 0)"
+)
+PUB_COUNTER_SQL = (
+    "INSERT INTO pub_follow_counts(pub_id, followers) VALUE (%s, %s) "
+    "ON DUPLICATE KEY UPDATE followers = GREATEST(followers + VALUES(followers), 0)"
+)
+
+
+def make_follow_id(from_user: str, to: str) -> str:
+    """
+    follow/followpubテーブルのid．フォローする側--される側
+    """
+    return from_user + "--" + to
+
+
+class FollowGraphModel(AbstractModel):
+    def __init__(self, config):
+        super(FollowGraphModel, self).__init__(config)
+
+    def _update_follow(self, sql: str, args: tuple, counters: List[Tuple[str, tuple]]) -> bool:
+        """
+        フォローの追加・削除と集計テーブルの更新を１つのトランザクションで行う
+        :param sql: followかfollowpubを変更するSQL
+        :param args: sqlに代入する値
+        :param counters: 行が変わった時だけ実行する集計テーブルのSQLと値
+        :return: 行が変わったかどうか(既にフォロー済みなどの場合はFalse)
+        """
+        with self.transaction():
+            changed = self.execute_rowcount(sql, *args) > 0
+            if changed:
+                for counter_sql, counter_args in counters:
+                    self.execute(counter_sql, *counter_args)
+        return changed
+
+    def _user_counters(self, to_user: str, from_user: str, delta: int) -> List[Tuple[str, tuple]]:
+        counters = [(USER_COUNTER_SQL, (to_user, delta, 0)), (USER_COUNTER_SQL, (from_user, 0, delta))]
+        # ロックを取る順番を揃えて，同時にフォローし合った時のデッドロックを避ける
+        counters = sorted(counters, key=lambda counter: counter[1][0])
+        # 両方のユーザページの版も同じトランザクションで上げる
+        return counters + [(BUMP_SQL, key) for key in sorted({user_key(to_user), user_key(from_user)})]
+
+    def _insert_follows(self, table, sql, rows, counters) -> int:
+        """
+        write-behindで溜まったフォローを１つのトランザクションで書き込む
+        既にある行を除いたものだけを挿入し，その分だけ集計テーブルと版を更新する
+        :param table: follow か followpub
+        :param sql: 複数行にまとめられるINSERT
+        :param rows: sqlに代入する値のリスト．最後の値がid
+        :param counters: 挿入する行 -> 集計テーブルなどのSQLと値のリスト，のリスト を返す関数
+        :return: 新しく挿入した行数
+        """
+        # 同じフォローが何度も積まれていても１回だけ数える
+        rows = list({row[-1]: row for row in rows}.values())
+        placeholders = ", ".join(["%s"] * len(rows))
+        with self.transaction():
+            # 行ロックを取ってから既にあるものを除くので，他のworkerと同時に書き込んでも数え間違えない
+            existing = {row["id"] for row in self.fetch_all(
+                "SELECT id FROM %s WHERE id IN (%s) FOR UPDATE" % (table, placeholders), *[row[-1] for row in rows])}
+            new_rows = [row for row in rows if row[-1] not in existing]
+            if new_rows:
+                self.execute_many(sql, new_rows)
+                for counter_sql, counter_rows in counters(new_rows):
+                    self.execute_many(counter_sql, counter_rows)
+        return len(new_rows)
+
+    @staticmethod
+    def _batch_user_counters(rows) -> List[Tuple[str, List[tuple]]]:
+        deltas: Dict[str, List[int]] = {}
+        for to_user, from_user, _ in rows:
+            deltas.setdefault(to_user, [0, 0])[0] += 1
+            deltas.setdefault(from_user, [0, 0])[1] += 1
+        # ロックを取る順番を_user_countersと揃える
+        users = sorted(deltas)
+        return [(USER_COUNTER_SQL, [(user, deltas[user][0], deltas[user][1]) for user in users]),
+                (BUMP_SQL, [user_key(user) for user in users])]
+
+    @staticmethod
+    def _batch_pub_counters(rows) -> List[Tuple[str, List[tuple]]]:
+        deltas: Dict[str, int] = {}
+        for pub_id, _, _ in rows:
+            deltas[pub_id] = deltas.get(pub_id, 0) + 1
+        pubs = sorted(deltas)
+        return [(PUB_COUNTER_SQL, [(pub_id, deltas[pub_id]) for pub_id in pubs]),
+                (BUMP_SQL, [pub_key(pub_id) for pub_id in pubs])]
+
+    def insert_follows(self, rows) -> int:
+        """
+        :param rows: (フォローされるユーザ, フォローするユーザ, id)のリスト
+        :return: 新しくフォローした数
+        """
+        sql = "INSERT IGNORE INTO follow(to_user_id, from_user_id, id) VALUE (%s, %s, %s);"
+        return self._insert_follows("follow", sql, rows, self._batch_user_counters)
+
+    def insert_pub_follows(self, rows) -> int:
+        """
+        :param rows: (PubのID, フォローするユーザ, id)のリスト
+        :return: 新しくフォローした数
+        """
+        sql = "INSERT IGNORE INTO followpub(pub, user, id) VALUE (%s, %s, %s);"
+        return self._insert_follows("followpub", sql, rows, self._batch_pub_counters)
+
+    def follow_user(self, username, user_name, follow_id):
+        """
+        :param username: フォローされるユーザ
+        :param user_name: フォローするユーザ
+        :param follow_id: user_name--username
+        :return: 新しくフォローしたかどうか．write-behindの場合は書き込む前に戻るのでNone
+        """
+        if write_behind.enabled:
+            write_behind.add("follow", self.insert_follows, user_name, (username, user_name, follow_id))
+            return None
+        sql = "INSERT IGNORE INTO follow(to_user_id, from_user_id, id) VALUE (%s, %s, %s);"
+        return self._update_follow(sql, (username, user_name, follow_id),
+                                   self._user_counters(username, user_name, 1))
+
+    def unfollow_user(self, username, user_name):
+        # まだ書き込んでいないフォローを先に書き込んでから外す
+        write_behind.wait_for(user_name)
+        sql = "DELETE FROM follow WHERE to_user_id = %s AND from_user_id = %s"
+        return self._update_follow(sql, (username, user_name), self._user_counters(username, user_name, -1))
+
+    def follow_pub(self, pub_id, user_name, follow_id):
+        if write_behind.enabled:
+            write_behind.add("followpub", self.insert_pub_follows, user_name, (pub_id, user_name, follow_id))
+            return None
+        sql = "INSERT IGNORE INTO followpub(pub, user, id) VALUE (%s, %s, %s);"
+        return self._update_follow(sql, (pub_id, user_name, follow_id),
+                                   [(PUB_COUNTER_SQL, (pub_id, 1)), (BUMP_SQL, pub_key(pub_id))])
+
+    def unfollow_pub(self, pub_id, user_name):
+        write_behind.wait_for(user_name)
+        sql = "DELETE FROM followpub WHERE pub = %s AND user = %s"
+        return self._update_follow(sql, (pub_id, user_name),
+                                   [(PUB_COUNTER_SQL, (pub_id, -1)), (BUMP_SQL, pub_key(pub_id))])
+
+    def user_counts(self, username) -> Dict[str, int]:
+        """
+        :param username: ユーザ名
+        :return: {"followers": フォロワー数, "followings": フォロー数}
+        """
+        sql = "SELECT followers, followings FROM user_follow_counts WHERE username = %s"
+        return self.fetch_one(sql, username) or {"followers": 0, "followings": 0}
+
+    def pub_follower_count(self, pub_id) -> int:
+        sql = "SELECT followers FROM pub_follow_counts WHERE pub_id = %s"
+        row = self.fetch_one(sql, pub_id)
+        return row["followers"] if row else 0
+
+    def relation(self, user_name, username) -> Tuple[bool, bool]:
+        """
+        ２人のフォロー関係を主キーで引く
+        :param user_name: ログイン中のユーザ
+        :param username: 相手のユーザ
+        :return: (user_nameがusernameをフォローしているか, usernameがuser_nameをフォローしているか)
+        """
+        sql = "SELECT id FROM follow WHERE id IN (%s, %s)"
+        rows = self.fetch_all(sql, make_follow_id(user_name, username), make_follow_id(username, user_name))
+        return self._relation(rows, user_name, username)
+
+    @staticmethod
+    def _relation(rows, user_name, username) -> Tuple[bool, bool]:
+        ids = {row["id"] for row in rows}
+        return make_follow_id(user_name, username) in ids, make_follow_id(username, user_name) in ids
+
+    def is_following_pub(self, user_name, pub_id) -> bool:
+        sql = "SELECT id FROM followpub WHERE id = %s"
+        return self.fetch_one(sql, make_follow_id(user_name, pub_id)) is not None
+
+    def following_among(self, username, usernames):
+        """
+        usernamesのうち，usernameがフォローしているユーザ
+        followの主キー(id)で引くので，フォローしている数によらず候補の数だけ読む
+        :param username: ユーザ名
+        :param usernames: 候補のユーザ名のリスト
+        :return: フォローしているユーザ名のset
+        """
+        if not usernames:
+            return set()
+        sql, args = self._following_among_query(username, usernames)
+        return {row["to_user_id"] for row in self.fetch_all(sql, *args)}
+
+    @staticmethod
+    def _following_among_query(username, usernames) -> Tuple[str, List[str]]:
+        placeholders = ", ".join(["%s"] * len(usernames))
+        sql = "SELECT to_user_id FROM follow WHERE id IN (%s)" % placeholders
+        return sql, [make_follow_id(username, other) for other in usernames]
+
+    def followers_page(self, username, cursor=None, limit=DEFAULT_PAGE_SIZE):
+        """
+        フォロワーを１ページ分取得する．followには作成日時がないので，一意なidの順に並べる
+        :return: Page(followの行)
+        """
+        return self.fetch_page("SELECT * FROM follow", ["to_user_id = %s"], [username], ("id",), cursor, limit)
+
+    def followings_page(self, username, cursor=None, limit=DEFAULT_PAGE_SIZE):
+        """
+        フォローしているユーザを１ページ分取得する
+        :return: Page(followの行)
+        """
+        return self.fetch_page("SELECT * FROM follow", ["from_user_id = %s"], [username], ("id",), cursor, limit)
+
+    def rebuild_counts(self):
+        """
+        集計テーブルをfollow/followpubから作り直す．導入時や，ずれた時に実行する
+        """
+        with self.transaction():
+            self.execute("UPDATE user_follow_counts SET followers = 0, followings = 0")
+            self.execute(
+                "INSERT INTO user_follow_counts(username, followers, followings) "
+                "SELECT username, SUM(followers), SUM(followings) FROM ("
+                "SELECT to_user_id AS username, 1 AS followers, 0 AS followings FROM follow "
+                "UNION ALL SELECT from_user_id, 0, 1 FROM follow) AS edges GROUP BY username "
+                "ON DUPLICATE KEY UPDATE followers = VALUES(followers), followings = VALUES(followings)")
+            self.execute("UPDATE pub_follow_counts SET followers = 0")
+            self.execute(
+                "INSERT INTO pub_follow_counts(pub_id, followers) "
+                "SELECT pub, COUNT(*) FROM followpub GROUP BY pub "
+                "ON DUPLICATE KEY UPDATE followers = VALUES(followers)")
+
+
+class AsyncFollowGraphModel(AsyncAbstractModel, FollowGraphModel):
+    """
+    FollowGraphModelの非同期版(読み込みのみ)
+    """
+
+    sync_only = (
+        "follow_user", "unfollow_user", "follow_pub", "unfollow_pub", "insert_follows", "insert_pub_follows",
+        "rebuild_counts",
+    )
+
+    async def user_counts(self, username):
+        sql = "SELECT followers, followings FROM user_follow_counts WHERE username = %s"
+        return await self.fetch_one(sql, username) or {"followers": 0, "followings": 0}
+
+    async def pub_follower_count(self, pub_id):
+        sql = "SELECT followers FROM pub_follow_counts WHERE pub_id = %s"
+        row = await self.fetch_one(sql, pub_id)
+        return row["followers"] if row else 0
+
+    async def following_among(self, username, usernames):
+        if not usernames:
+            return set()
+        sql, args = self._following_among_query(username, usernames)
+        return {row["to_user_id"] for row in await self.fetch_all(sql, *args)}
+
+    async def relation(self, user_name, username):
+        sql = "SELECT id FROM follow WHERE id IN (%s, %s)"
+        rows = await self.fetch_all(sql, make_follow_id(user_name, username), make_follow_id(username, user_name))
+        return self._relation(rows, user_name, username)
+
+    async def is_following_pub(self, user_name, pub_id):
+        sql = "SELECT id FROM followpub WHERE id = %s"
+        return await self.fetch_one(sql, make_follow_id(user_name, pub_id)) is not None
+
+
+if __name__ == "__main__":
+    # python -m app.models.follow でフォロー数の集計テーブルを作り直す
+    from app.configs import Config
+    FollowGraphModel(Config()).rebuild_counts()
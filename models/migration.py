@@ -0,0 +1,161 @@
+"""
+スキーマのマイグレーション
+migrations/ にある NNNN_名前.sql を番号の順に実行し，実行したものを schema_migrations に記録する
+スキーマを変える時は，既存のファイルを書き換えずに新しい番号のファイルを追加する
+
+    python -m app.models.migration migrate    まだ実行していないものを全て実行する
+    python -m app.models.migration status     実行済みかどうかを表示する
+    python -m app.models.migration check      登録したクエリをEXPLAINし，フルスキャンがあれば失敗する
+
+MySQLのDDLはトランザクションにならないので，途中で失敗したファイルは記録されない
+直して再実行した時のために，既にあるテーブルやインデックスを作ろうとしたエラーは無視する
+"""
+import argparse
+import hashlib
+import logging
+import os
+import re
+import sys
+from typing import Dict, List, NamedTuple, Optional
+
+import pymysql
+
+from app.configs import Config
+from app.errors import MigrationError
+from app.models.abstract import AbstractModel
+
+logger = logging.getLogger(__name__)
+
+MIGRATIONS_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "migrations")
+_FILE_NAME = re.compile(r"^(\d{4})_(\w+)\.sql$")
+
+# 1050: Table already exists, 1060: Duplicate column name, 1061: Duplicate key name
+ALREADY_APPLIED_ERRORS = (1050, 1060, 1061)
+# 複数のworkerが同時に起動しても１つだけが実行するようにするロック
+LOCK_NAME = "schema_migrations"
+LOCK_TIMEOUT = 60
+
+
+class Migration(NamedTuple):
+    version: int
+    name: str
+    statements: List[str]
+    checksum: str
+
+
+def load_migrations(directory: str = MIGRATIONS_DIR) -> List[Migration]:
+    """
+    :param directory: SQLファイルのディレクトリ
+    :return: 番号の順に並べたマイグレーション
+    """
+    migrations = []
+    for file_name in sorted(os.listdir(directory)):
+        match = _FILE_NAME.match(file_name)
+        if match is None:
+            continue
+        with open(os.path.join(directory, file_name), encoding="utf-8") as f:
+            source = f.read()
+        # 行コメントを除いてから ; で区切る(SQLの中に ; を含む文字列は書かない)
+        lines = [line for line in source.splitlines() if not line.strip().startswith("--")]
+        statements = [statement.strip() for statement in "\n".join(lines).split(";") if statement.strip()]
+        migrations.append(Migration(int(match.group(1)), match.group(2), statements,
+                                    hashlib.sha1(source.encode()).hexdigest()))
+    versions = [migration.version for migration in migrations]
+    if len(versions) != len(set(versions)):
+        raise MigrationError("duplicate migration version in %s" % directory)
+    return migrations
+
+
+class MigrationModel(AbstractModel):
+    def __init__(self, config):
+        super(MigrationModel, self).__init__(config)
+
+    def _ensure_table(self, cursor) -> None:
+        self._execute(
+            "CREATE TABLE IF NOT EXISTS schema_migrations ("
+            "version INT NOT NULL PRIMARY KEY, name VARCHAR(255) NOT NULL, checksum CHAR(40) NOT NULL, "
+            "applied_at DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4",
+            cursor)
+
+    def applied(self) -> Dict[int, Dict[str, any]]:
+        """
+        :return: 実行済みの番号 -> schema_migrationsの行
+        """
+        with self.pool.connection() as connection:
+            with connection.cursor() as cursor:
+                self._ensure_table(cursor)
+                self._execute("SELECT * FROM schema_migrations", cursor)
+                return {row["version"]: row for row in cursor.fetchall()}
+
+    def status(self, migrations: Optional[List[Migration]] = None) -> List[Dict[str, any]]:
+        """
+        :return: マイグレーションごとの番号，名前，実行日時(未実行ならNone)，実行後にファイルが変わったか
+        """
+        migrations = load_migrations() if migrations is None else migrations
+        applied = self.applied()
+        return [{"version": migration.version, "name": migration.name,
+                 "applied_at": applied[migration.version]["applied_at"] if migration.version in applied else None,
+                 "changed": migration.version in applied
+                 and applied[migration.version]["checksum"] != migration.checksum}
+                for migration in migrations]
+
+    def migrate(self, target: Optional[int] = None, migrations: Optional[List[Migration]] = None) -> List[int]:
+        """
+        まだ実行していないマイグレーションを番号の順に実行する
+        :param target: この番号まで実行する．Noneなら全て
+        :return: 実行した番号
+        """
+        migrations = load_migrations() if migrations is None else migrations
+        done = []
+        with self.pool.connection() as connection:
+            with connection.cursor() as cursor:
+                self._execute("SELECT GET_LOCK(%s, %s) AS locked", cursor, LOCK_NAME, LOCK_TIMEOUT)
+                if not cursor.fetchone()["locked"]:
+                    raise MigrationError("could not get the migration lock")
+                try:
+                    self._ensure_table(cursor)
+                    self._execute("SELECT version FROM schema_migrations", cursor)
+                    applied = {row["version"] for row in cursor.fetchall()}
+                    for migration in migrations:
+                        if migration.version in applied or (target is not None and migration.version > target):
+                            continue
+                        logger.info("applying %04d_%s", migration.version, migration.name)
+                        for statement in migration.statements:
+                            try:
+                                self._execute(statement, cursor)
+                            except pymysql.err.MySQLError as e:
+                                if e.args[0] not in ALREADY_APPLIED_ERRORS:
+                                    raise MigrationError("%04d_%s failed: %s" % (
+                                        migration.version, migration.name, e)) from e
+                                logger.info("already applied: %s", e.args[1])
+                        self._execute("INSERT INTO schema_migrations(version, name, checksum) VALUE (%s, %s, %s)",
+                                      cursor, migration.version, migration.name, migration.checksum)
+                        done.append(migration.version)
+                finally:
+                    self._execute("SELECT RELEASE_LOCK(%s)", cursor, LOCK_NAME)
+                    cursor.fetchall()
+        return done
+
+
+def main():
+    parser = argparse.ArgumentParser(description="スキーマのマイグレーション")
+    parser.add_argument("command", choices=["migrate", "status", "check"])
+    parser.add_argument("--target", type=int, help="migrate: この番号まで実行する")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    config = Config()
+    model = MigrationModel(config)
+    if args.command == "migrate":
+        done = model.migrate(args.target)
+        print("applied: %s" % (", ".join("%04d" % version for version in done) or "nothing"))
+    elif args.command == "status":
+        for row in model.status():
+            state = row["applied_at"] or "pending"
+            print("%04d_%-30s %s%s" % (row["version"], row["name"], state, "  (file changed)" if row["changed"] else ""))
+    else:
+        from app.models.explain import check_queries
+        sys.exit(0 if check_queries(config) else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,173 @@
+"""
+カーソル(キーセット)によるページング
+OFFSETを使わず，前のページの最後の行のキー((created_at, id)など)より後ろを取得するので，
+何ページ目でもインデックスの範囲読みだけで済む
+"""
+import base64
+import json
+from typing import Dict, Iterable, Iterator, List, NamedTuple, Optional, Sequence, Tuple
+
+# 1ページの件数の既定値と上限
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 200
+
+NEXT = "n"
+PREV = "p"
+
+
+class Page(NamedTuple):
+    """
+    items: このページの行(新しい順)
+    next_cursor: 次(古い方)のページのカーソル．なければNone
+    prev_cursor: 前(新しい方)のページのカーソル．なければNone
+    """
+    items: List[Dict[str, any]]
+    next_cursor: Optional[str]
+    prev_cursor: Optional[str]
+
+
+def encode_cursor(direction: str, values: list) -> str:
+    return base64.urlsafe_b64encode(json.dumps([direction, values], default=str).encode()).decode()
+
+
+def decode_cursor(cursor: Optional[str]) -> Tuple[str, Optional[list]]:
+    """
+    :return: (向き, キーの値)．カーソルがないか壊れている場合は最初のページ
+    """
+    if not cursor:
+        return NEXT, None
+    try:
+        direction, values = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except (ValueError, TypeError):
+        return NEXT, None
+    if direction not in (NEXT, PREV) or not isinstance(values, list):
+        return NEXT, None
+    return direction, values
+
+
+def clamp_page_size(limit) -> int:
+    try:
+        limit = int(limit)
+    except (TypeError, ValueError):
+        return DEFAULT_PAGE_SIZE
+    return min(max(limit, 1), MAX_PAGE_SIZE)
+
+
+def keyset_condition(keys: Sequence[str], values: list, operator: str = "<") -> Tuple[str, list]:
+    """
+    (keys) < (values) を，インデックスが効くように展開した条件にする
+    (a, b) < (x, y) -> a < x OR (a = x AND b < y)
+    :param operator: < なら古い方，> なら新しい方
+    :return: (SQLの条件, 代入する値)
+    """
+    first, rest = keys[0], keys[1:]
+    if not rest:
+        return "%s %s %%s" % (first, operator), [values[0]]
+    condition, args = keyset_condition(rest, values[1:], operator)
+    return "(%s %s %%s OR (%s = %%s AND %s))" % (first, operator, first, condition), [values[0], values[0]] + args
+
+
+def column_name(column: str) -> str:
+    """articles.created_at -> created_at (DictCursorの行のキー)"""
+    return column.split(".")[-1]
+
+
+def build_page_query(select: str, conditions: List[str], args: list, keys: Sequence[str],
+                     cursor: Optional[str], limit: int) -> Tuple[str, list, Optional[str]]:
+    """
+    ページを取得するSQLを組み立てる
+    判定のために１件多く取得する
+    :param select: WHERE より前のSELECT文
+    :param conditions: 絞り込みの条件(ANDでつなぐ)
+    :param args: conditionsに代入する値
+    :param keys: 並び順の列．新しい順で一意になるようにする
+    :return: (SQL, 代入する値, カーソルの向き．最初のページならNone)
+    """
+    direction, values = decode_cursor(cursor)
+    conditions, args = list(conditions), list(args)
+    if values is not None and len(values) == len(keys):
+        condition, condition_args = keyset_condition(keys, values, "<" if direction == NEXT else ">")
+        conditions.append(condition)
+        args.extend(condition_args)
+    else:
+        direction = None
+    order = "ASC" if direction == PREV else "DESC"
+    sql = select
+    if conditions:
+        sql += " WHERE " + " AND ".join(conditions)
+    sql += " ORDER BY %s LIMIT %%s" % ", ".join("%s %s" % (key, order) for key in keys)
+    args.append(limit + 1)
+    return sql, args, direction
+
+
+def make_page(rows: List[Dict[str, any]], keys: Sequence[str], limit: int, direction: Optional[str]) -> Page:
+    """
+    build_page_queryで取得した行からPageを作る
+    """
+    has_more = len(rows) > limit
+    rows = list(rows[:limit])
+    if direction == PREV:
+        rows.reverse()
+    if not rows:
+        return Page(rows, None, None)
+    names = [column_name(key) for key in keys]
+    first = [rows[0][name] for name in names]
+    last = [rows[-1][name] for name in names]
+    if direction != PREV:
+        next_cursor = encode_cursor(NEXT, last) if has_more else None
+        prev_cursor = encode_cursor(PREV, first) if direction == NEXT else None
+    else:
+        next_cursor = encode_cursor(NEXT, last)
+        prev_cursor = encode_cursor(PREV, first) if has_more else None
+    return Page(rows, next_cursor, prev_cursor)
+
+
+class PageStream(object):
+    """
+    Pageのitemsを順に返すもの．テンプレートをストリーミングで描画する時に使う
+    rowsはリストでもジェネレータでもよいが，ジェネレータの場合は読み終わるまで接続を借りたままになるので，
+    レスポンスに渡すもの(stream_page)は読み終えたリストにしている
+    next_cursor/prev_cursorは全ての行を読み終わった後に決まるので，一覧より後ろで参照する
+    """
+
+    def __init__(self, rows: Iterable[Dict[str, any]], keys: Sequence[str], limit: int, direction: Optional[str]):
+        """
+        :param rows: build_page_queryのSQLの結果(limit + 1件まで)
+        """
+        self._rows = rows
+        self.keys = keys
+        self.limit = limit
+        self.direction = direction
+        self.next_cursor: Optional[str] = None
+        self.prev_cursor: Optional[str] = None
+
+    def __iter__(self) -> Iterator[Dict[str, any]]:
+        if self.direction == PREV:
+            # 前のページは逆順に取得するので，並べ直すために1ページ分だけリストにする
+            page = make_page(list(self._rows), self.keys, self.limit, PREV)
+            self.next_cursor, self.prev_cursor = page.next_cursor, page.prev_cursor
+            yield from page.items
+            return
+        first = last = None
+        has_more = False
+        rows = iter(self._rows)
+        try:
+            for count, row in enumerate(rows):
+                if count == self.limit:
+                    has_more = True
+                    break
+                if first is None:
+                    first = row
+                last = row
+                yield row
+        finally:
+            close = getattr(rows, "close", None)
+            if close is not None:
+                close()
+        if first is None:
+            return
+        names = [column_name(key) for key in self.keys]
+        if has_more:
+            self.next_cursor = encode_cursor(NEXT, [last[name] for name in names])
+        if self.direction == NEXT:
+            self.prev_cursor = encode_cursor(PREV, [first[name] for name in names])
@@ -0,0 +1,220 @@
+"""
+MySQLのコネクションプール
+プロセス全体で接続を共有し，リクエストごとに接続を張り直さないようにする
+"""
+import os
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from typing import Deque, Dict, Iterator, Tuple
+
+import pymysql
+import pymysql.cursors
+
+from app.configs import Config
+from app.errors import ConnectionPoolExhausted
+
+
+class ConnectionPool(object):
+    """
+    上限付きのコネクションプール
+    取り出し時に一定時間使われていない接続はpingで生存確認し，
+    返却時にidle_timeoutを過ぎた余分な接続を閉じる
+    """
+
+    def __init__(self, config: Config):
+        self.config = config
+        self.min_size = config.mysql_pool_min_size
+        self.max_size = config.mysql_pool_max_size
+        self.timeout = config.mysql_pool_timeout
+        self.idle_timeout = config.mysql_pool_idle_timeout
+        self.ping_interval = config.mysql_pool_ping_interval
+        # (接続, 最後に返却された時刻) を新しいものが右に来るように積む
+        self._idle: Deque[Tuple[pymysql.connections.Connection, float]] = deque()
+        self._size = 0
+        self._condition = threading.Condition()
+        self._last_reap = time.monotonic()
+        self._stats = {
+            "created": 0,
+            "closed": 0,
+            "checkouts": 0,
+            "timeouts": 0,
+            "health_check_failures": 0,
+            "wait_time_total": 0.0,
+            "wait_time_max": 0.0,
+        }
+        for _ in range(self.min_size):
+            self._size += 1
+            self._checkin_new(self._connect())
+
+    def _connect(self) -> pymysql.connections.Connection:
+        connection = pymysql.connect(
+            host=self.config.mysql_host,
+            user=self.config.mysql_username,
+            password=self.config.mysql_password,
+            database=self.config.mysql_database,
+            cursorclass=pymysql.cursors.DictCursor,
+            # トランザクションをちゃんとやるならFalseにしてコードを修正
+            autocommit=True
+        )
+        with self._condition:
+            self._stats["created"] += 1
+        return connection
+
+    def _checkin_new(self, connection: pymysql.connections.Connection) -> None:
+        with self._condition:
+            self._idle.append((connection, time.monotonic()))
+
+    def _close(self, connection: pymysql.connections.Connection) -> None:
+        try:
+            connection.close()
+        except pymysql.err.Error:
+            pass
+        with self._condition:
+            self._stats["closed"] += 1
+
+    def checkout(self) -> pymysql.connections.Connection:
+        """
+        プールから接続を１つ借りる
+        空きがなく上限に達している場合はmysql_pool_timeout秒まで待つ
+        :return: 接続
+        """
+        started = time.monotonic()
+        deadline = started + self.timeout
+        with self._condition:
+            while True:
+                if self._idle:
+                    connection, last_used = self._idle.pop()
+                    break
+                if self._size < self.max_size:
+                    self._size += 1
+                    connection, last_used = None, None
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self._stats["timeouts"] += 1
+                    raise ConnectionPoolExhausted(
+                        "no MySQL connection available within %.1f seconds" % self.timeout)
+                self._condition.wait(remaining)
+            waited = time.monotonic() - started
+            self._stats["checkouts"] += 1
+            self._stats["wait_time_total"] += waited
+            self._stats["wait_time_max"] = max(self._stats["wait_time_max"], waited)
+
+        try:
+            if connection is None:
+                return self._connect()
+            if time.monotonic() - last_used > self.ping_interval:
+                try:
+                    connection.ping(reconnect=True)
+                except pymysql.err.Error:
+                    with self._condition:
+                        self._stats["health_check_failures"] += 1
+                    self._close(connection)
+                    return self._connect()
+            return connection
+        except Exception:
+            # 接続を作れなかった分の枠を空ける
+            with self._condition:
+                self._size -= 1
+                self._condition.notify()
+            raise
+
+    def checkin(self, connection: pymysql.connections.Connection, discard: bool = False) -> None:
+        """
+        借りた接続をプールに返す
+        :param connection: 返却する接続
+        :param discard: Trueの場合は接続を閉じて破棄する(通信エラーが起きた時など)
+        """
+        if discard or not connection.open:
+            self._close(connection)
+            with self._condition:
+                self._size -= 1
+                self._condition.notify()
+            return
+        with self._condition:
+            self._idle.append((connection, time.monotonic()))
+            self._condition.notify()
+        self._reap_idle()
+
+    def _reap_idle(self) -> None:
+        """
+        idle_timeoutより長く使われていない接続を，min_sizeを残して閉じる
+        返却のたびに全件見ないように，確認はidle_timeoutの1/10間隔にとどめる
+        """
+        now = time.monotonic()
+        if now - self._last_reap < self.idle_timeout / 10:
+            return
+        reaped = []
+        with self._condition:
+            self._last_reap = now
+            # 古いものほど左にあるので，左から見ていく
+            while self._idle and self._size > self.min_size and now - self._idle[0][1] > self.idle_timeout:
+                connection, _ = self._idle.popleft()
+                self._size -= 1
+                reaped.append(connection)
+        for connection in reaped:
+            self._close(connection)
+
+    @contextmanager
+    def connection(self) -> Iterator[pymysql.connections.Connection]:
+        """
+        with文で接続を借りて，抜けるときに返す
+        """
+        connection = self.checkout()
+        discard = False
+        try:
+            yield connection
+        except (pymysql.err.OperationalError, pymysql.err.InterfaceError):
+            discard = True
+            raise
+        finally:
+            self.checkin(connection, discard=discard)
+
+    def stats(self) -> Dict[str, float]:
+        """
+        プールの状態を返す
+        :return: 接続数，取り出し待ち時間などの統計
+        """
+        with self._condition:
+            stats = dict(self._stats)
+            stats["size"] = self._size
+            stats["idle"] = len(self._idle)
+            stats["in_use"] = self._size - len(self._idle)
+        checkouts = stats["checkouts"]
+        stats["wait_time_avg"] = stats["wait_time_total"] / checkouts if checkouts else 0.0
+        return stats
+
+    def close(self) -> None:
+        """
+        空いている接続を全て閉じる
+        """
+        with self._condition:
+            idle = list(self._idle)
+            self._idle.clear()
+            self._size -= len(idle)
+        for connection, _ in idle:
+            self._close(connection)
+
+
+_pools: Dict[Tuple, ConnectionPool] = {}
+_pools_lock = threading.Lock()
+
+
+def get_pool(config: Config) -> ConnectionPool:
+    """
+    接続先ごとに１つのプールを返す
+    uvicornのworkerごとに別のプールになるよう，プロセスIDもキーに含める
+    :param config: アプリケーションの設定
+    :return: コネクションプール
+    """
+    key = (os.getpid(), config.mysql_host, config.mysql_username, config.mysql_database)
+    pool = _pools.get(key)
+    if pool is None:
+        with _pools_lock:
+            pool = _pools.get(key)
+            if pool is None:
+                pool = ConnectionPool(config)
+                _pools[key] = pool
+    return pool
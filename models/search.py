@@ -0,0 +1,159 @@
+"""
+検索モデル
+記事，ディスカッション，Pub，ユーザ，ルームの検索をここにまとめる
+LIKE '%keyword%' はインデックスを使えないので，MySQLのFULLTEXTインデックス(ngramパーサ)を使う
+ngramなので日本語でも部分一致で検索でき，インデックスは作成・更新時にMySQLが自動で更新する
+"""
+from typing import Dict, NamedTuple, Optional, Tuple
+
+import pymysql
+
+from app.models.abstract import AbstractModel
+from app.models.pagination import DEFAULT_PAGE_SIZE, NEXT, Page, PageStream, clamp_page_size, column_name, \
+    decode_cursor, encode_cursor
+
+
+class SearchTarget(NamedTuple):
+    """
+    検索対象の定義
+    select: 結果として返す行(テンプレートが使う列)を取るSELECT
+    column: FULLTEXTインデックスを張る列
+    keys: 並び順とカーソルに使う列．新しい順で一意になるようにする
+    scope: 絞り込みに使う列(ディスカッションのpub_idなど)
+    """
+    select: str
+    column: str
+    keys: Tuple[str, ...]
+    scope: Optional[str] = None
+
+
+_ARTICLES = "SELECT * FROM articles INNER JOIN profile on articles.username = profile.username"
+_MESSAGES = "SELECT * FROM message INNER JOIN profile on message.username = profile.username"
+_PUBS = "SELECT * FROM pubs INNER JOIN profile on pubs.created_by = profile.username"
+_USERS = "SELECT * FROM users INNER JOIN profile on users.username = profile.username"
+_ROOMS = "SELECT * FROM rooms INNER JOIN users on rooms.created_by = users.username"
+
+SEARCH_TARGETS: Dict[Tuple[str, str], SearchTarget] = {
+    ("article", "title"): SearchTarget(_ARTICLES, "articles.title", ("articles.created_at", "articles.id")),
+    ("article", "body"): SearchTarget(_ARTICLES, "articles.body", ("articles.created_at", "articles.id")),
+    ("article", "user"): SearchTarget(_ARTICLES, "profile.nickname", ("articles.created_at", "articles.id")),
+    ("discussion", "title"): SearchTarget(_MESSAGES, "message.title", ("message.created_at", "message.id"),
+                                          "message.pub_id"),
+    ("discussion", "body"): SearchTarget(_MESSAGES, "message.body", ("message.created_at", "message.id"),
+                                         "message.pub_id"),
+    ("discussion", "user"): SearchTarget(_MESSAGES, "profile.nickname", ("message.created_at", "message.id"),
+                                         "message.pub_id"),
+    ("pub", "id"): SearchTarget(_PUBS, "pubs.pub_id", ("pubs.created_at", "pubs.pub_id")),
+    ("pub", "name"): SearchTarget(_PUBS, "pubs.pub_name", ("pubs.created_at", "pubs.pub_id")),
+    ("pub", "explanation"): SearchTarget(_PUBS, "pubs.pub_comment", ("pubs.created_at", "pubs.pub_id")),
+    ("user", "id"): SearchTarget(_USERS, "profile.username", ("users.created_at", "users.username")),
+    ("user", "name"): SearchTarget(_USERS, "profile.nickname", ("users.created_at", "users.username")),
+    ("user", "explanation"): SearchTarget(_USERS, "profile.profile", ("users.created_at", "users.username")),
+    ("room", "comment"): SearchTarget(_ROOMS, "rooms.room_comment", ("rooms.created_at", "rooms.id")),
+}
+
+# ngramパーサのトークン長(MySQLのngram_token_sizeの既定値)．これより短い検索語は前方一致で探す
+NGRAM_TOKEN_SIZE = 2
+# 前方一致に使うインデックスに含める先頭の文字数．前方一致はNGRAM_TOKEN_SIZEより短い検索語だけなので短くてよい
+PREFIX_INDEX_LENGTH = 16
+# 主キーなので前方一致用のインデックスを作らない列
+PRIMARY_KEY_COLUMNS = {"profile.username", "pubs.pub_id"}
+
+
+class SearchModel(AbstractModel):
+    def __init__(self, config):
+        super(SearchModel, self).__init__(config)
+
+    def search(self, kind, field, query, limit=DEFAULT_PAGE_SIZE, cursor=None, scope=None, stream=False):
+        """
+        検索する
+        :param kind: 検索対象(article, discussion, pub, user, room)
+        :param field: 検索する項目(SEARCH_TARGETSのキーを参照)
+        :param query: 検索語．Noneか空なら新しい順に全件
+        :param limit: 1ページの件数(最大200)
+        :param cursor: 前回のnext_cursor(検索語がない場合はprev_cursorも使える)
+        :param scope: 絞り込みの値(ディスカッションの場合はpub_id)
+        :param stream: Trueならストリーミングで描画するためのPageStreamを返す(行は読み終えてから返す)
+        :return: Page(関連度の高い順．検索語がない場合は新しい順)かPageStream
+        """
+        target = SEARCH_TARGETS[(kind, field)]
+        limit = clamp_page_size(limit)
+        query = (query or "").replace('"', " ").strip()
+
+        conditions, args = [], []
+        if target.scope is not None:
+            conditions.append("%s = %%s" % target.scope)
+            args.append(scope)
+
+        if len(query) >= NGRAM_TOKEN_SIZE:
+            # フレーズ検索にすると，ngramが連続して現れる行だけ(= 部分一致)になる
+            match = "MATCH(%s) AGAINST (%%s IN BOOLEAN MODE)" % target.column
+            phrase = '"%s"' % query
+            conditions.append(match)
+            args.append(phrase)
+            # 関連度順は前に戻れないので，next_cursorだけを返す
+            direction, position = decode_cursor(cursor)
+            if direction == NEXT and position is not None and len(position) == 2:
+                score, key = position
+                conditions.append("(%s < %%s OR (%s = %%s AND %s < %%s))" % (match, match, target.keys[-1]))
+                args.extend([phrase, score, phrase, score, key])
+            sql = target.select.replace("SELECT *", "SELECT *, %s AS score" % match, 1)
+            sql += " WHERE " + " AND ".join(conditions)
+            sql += " ORDER BY score DESC, %s DESC LIMIT %%s" % target.keys[-1]
+            if stream:
+                # directionをNoneにして，next_cursorだけを作らせる
+                return PageStream(self.fetch_all(sql, phrase, *args, limit + 1),
+                                  ("score", target.keys[-1]), limit, None)
+            rows = self.fetch_all(sql, phrase, *args, limit + 1)
+            next_cursor = None
+            if len(rows) > limit:
+                rows = rows[:limit]
+                last = rows[-1]
+                next_cursor = encode_cursor(NEXT, [last["score"], last[column_name(target.keys[-1])]])
+            return Page(rows, next_cursor, None)
+
+        if query:
+            # ngramより短い(1文字の)検索語はFULLTEXTでは引けないので，前方一致にする
+            # 以前のLIKE '%keyword%'と違い，1文字の検索だけは部分一致ではなく前方一致になる
+            # 列の先頭PREFIX_INDEX_LENGTH文字のインデックス(create_indexes)で範囲を読む
+            conditions.append("%s LIKE %%s" % target.column)
+            args.append(query.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%")
+        fetch = self.stream_page if stream else self.fetch_page
+        return fetch(target.select, conditions, args, target.keys, cursor, limit)
+
+    @staticmethod
+    def index_statements():
+        """
+        検索に使うインデックスを作るSQL．FULLTEXT(ngram)と，短い検索語の前方一致に使う先頭の文字のインデックス
+        """
+        statements = []
+        columns = sorted({target.column for target in SEARCH_TARGETS.values()})
+        for column in columns:
+            table, name = column.split(".")
+            statements.append("ALTER TABLE %s ADD FULLTEXT INDEX ft_%s_%s (%s) WITH PARSER ngram"
+                              % (table, table, name, name))
+        for column in columns:
+            if column in PRIMARY_KEY_COLUMNS:
+                continue
+            table, name = column.split(".")
+            statements.append("CREATE INDEX ix_%s_%s_prefix ON %s (%s(%d))"
+                              % (table, name, table, name, PREFIX_INDEX_LENGTH))
+        return statements
+
+    def create_indexes(self):
+        """
+        検索に使うインデックスを作成する．既にある場合は何もしない
+        """
+        for sql in self.index_statements():
+            try:
+                self.execute(sql)
+            except pymysql.err.OperationalError as e:
+                # 1061: Duplicate key name
+                if e.args[0] != 1061:
+                    raise
+
+
+if __name__ == "__main__":
+    # python -m app.models.search でFULLTEXTインデックスを作成する
+    from app.configs import Config
+    SearchModel(Config()).create_indexes()
@@ -0,0 +1,96 @@
+"""
+ページの元になるデータ(記事，Pub，ユーザ)の版
+書き込みのたびにversionを1つ上げ，HTTPのETagはこの値から作る
+全てのworkerが同じ行を見るので，どのworkerで書き込んでも他のworkerのETagが変わる
+entity_versionsテーブルは migrations/0004_entity_versions.sql
+"""
+from typing import Dict, Iterable, List, Tuple
+
+from app.models.abstract import AbstractModel
+from app.models.async_abstract import AsyncAbstractModel
+
+# (kind, entity_id)
+VersionKey = Tuple[str, str]
+
+BUMP_SQL = (
+    "INSERT INTO entity_versions(kind, entity_id) VALUES (%s, %s) "
+    "ON DUPLICATE KEY UPDATE version = version + 1"
+)
+# 記事の作成・更新・削除で，投稿者のページの版も上げる
+BUMP_ARTICLE_AUTHOR_SQL = (
+    "INSERT INTO entity_versions(kind, entity_id) SELECT 'user', username FROM articles WHERE id = %s "
+    "ON DUPLICATE KEY UPDATE version = version + 1"
+)
+
+# ページに表示されるユーザ(ニックネーム)を引くSQL．そのユーザのプロフィールの版もETagに含めるので，
+# プロフィールを変えたユーザが表示されているページだけ版が変わる
+# (ユーザのページはユーザ自身のキーを持つので要らない)
+SHOWN_USERS_SQL = {
+    "article": "SELECT username FROM articles WHERE id = %s UNION SELECT username FROM comments WHERE article_id = %s",
+}
+
+
+def article_key(article_id) -> VersionKey:
+    return "article", str(article_id)
+
+
+def pub_key(pub_id) -> VersionKey:
+    return "pub", str(pub_id)
+
+
+def user_key(username) -> VersionKey:
+    return "user", str(username)
+
+
+class VersionModel(AbstractModel):
+    def __init__(self, config):
+        super(VersionModel, self).__init__(config)
+
+    def bump(self, *keys: VersionKey) -> None:
+        """
+        版を上げる．書き込んだ後に呼ぶ
+        :param keys: 変更したデータのキー
+        """
+        # 同時に上げた時のデッドロックを避けるために，ロックを取る順番を揃える
+        self.execute_many(BUMP_SQL, sorted(set(keys)))
+
+    def bump_article_author(self, article_id) -> None:
+        self.execute(BUMP_ARTICLE_AUTHOR_SQL, article_id)
+
+    def versions(self, keys: Iterable[VersionKey]) -> Dict[VersionKey, Tuple[int, any]]:
+        """
+        :param keys: 取得するキー
+        :return: キー -> (version, updated_at)．まだ書き込まれていないキーは含まない
+            keysの他に，keysのページに表示されるユーザ(SHOWN_USERS_SQL)のキーも含む
+        """
+        keys = list(keys)
+        return self._versions(self.fetch_all(*self._versions_query(keys)))
+
+    @staticmethod
+    def _versions_query(keys: List[VersionKey]) -> list:
+        sql = "SELECT kind, entity_id, version, updated_at FROM entity_versions WHERE (kind, entity_id) IN (%s)" \
+              % ", ".join(["(%s, %s)"] * len(keys))
+        args = [value for key in keys for value in key]
+        # 表示されるユーザの版も同じ1回のSQLで取る
+        for kind, entity_id in keys:
+            if kind in SHOWN_USERS_SQL:
+                sql += " OR (kind = 'user' AND entity_id IN (%s))" % SHOWN_USERS_SQL[kind]
+                args += [entity_id] * SHOWN_USERS_SQL[kind].count("%s")
+        return [sql] + args
+
+    @staticmethod
+    def _versions(rows) -> Dict[VersionKey, Tuple[int, any]]:
+        return {(row["kind"], row["entity_id"]): (row["version"], row["updated_at"]) for row in rows}
+
+
+class AsyncVersionModel(AsyncAbstractModel, VersionModel):
+    """
+    VersionModelの非同期版
+    """
+
+    async def bump(self, *keys):
+        await self.execute_many(BUMP_SQL, sorted(set(keys)))
+
+    async def versions(self, keys):
+        keys = list(keys)
+        return self._versions(await self.fetch_all(*self._versions_query(keys)))
@@ -0,0 +1,24 @@
+"""
+テストでリポジトリを app パッケージとして読み込むためのpytestのプラグイン(pytest.iniで読み込む)
+リポジトリは /app に置いて app パッケージとして使うので，ディレクトリ名が違っても app として読み込めるようにする
+app/__init__.py はアプリ全体(views)を読み込むので，pytestにもパッケージとして扱わせず実行しない
+"""
+import os
+import sys
+import types
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+if "app" not in sys.modules:
+    package = types.ModuleType("app")
+    package.__path__ = [ROOT]
+    sys.modules["app"] = package
+
+
+@pytest.hookimpl(tryfirst=True)
+def pytest_collect_directory(path, parent):
+    if str(path) == ROOT:
+        return pytest.Dir.from_parent(parent, path=path)
+    return None
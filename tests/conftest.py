@@ -0,0 +1,127 @@
+"""
+テスト共通のフィクスチャ
+MySQLには接続せず，fake_dbでプールを実行したSQLを記録する偽物に差し替える
+(app パッケージとしての読み込みは app_package.py)
+"""
+from contextlib import contextmanager
+from typing import Callable, Dict, List, Optional, Tuple
+
+import pytest
+
+
+class FakeCursor(object):
+    def __init__(self, db: "FakeDB"):
+        self.db = db
+        self.rowcount = 0
+        self.lastrowid = 0
+        self.description = None
+        self._rows: List[dict] = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def execute(self, sql: str, args=()) -> None:
+        self.db.record(sql, tuple(args or ()))
+        rows, self.rowcount, self.lastrowid = self.db.respond(sql, tuple(args or ()))
+        self._rows = list(rows)
+
+    def executemany(self, sql: str, rows) -> None:
+        rows = [tuple(row) for row in rows]
+        self.db.record(sql, rows, many=True)
+        self.rowcount = len(rows)
+
+    def fetchall(self) -> List[dict]:
+        rows, self._rows = self._rows, []
+        return rows
+
+    def fetchone(self) -> Optional[dict]:
+        return self._rows.pop(0) if self._rows else None
+
+    def fetchmany(self, size: int) -> List[dict]:
+        rows, self._rows = self._rows[:size], self._rows[size:]
+        return rows
+
+
+class FakeConnection(object):
+    def __init__(self, db: "FakeDB"):
+        self.db = db
+        self.open = True
+
+    def cursor(self, cursor_class=None) -> FakeCursor:
+        return FakeCursor(self.db)
+
+    def begin(self) -> None:
+        self.db.record("BEGIN", ())
+
+    def commit(self) -> None:
+        self.db.record("COMMIT", ())
+
+    def rollback(self) -> None:
+        self.db.record("ROLLBACK", ())
+
+
+class FakeDB(object):
+    """
+    実行したSQLを statements に (SQL, 値, executemanyかどうか) で記録する
+    on(部分文字列, rows=..., rowcount=..., lastrowid=..., error=...) で結果を決める
+    """
+
+    def __init__(self):
+        self.statements: List[Tuple[str, any, bool]] = []
+        self.checkouts = 0
+        self.in_use = 0
+        self._rules: List[Tuple[str, Callable]] = []
+
+    def on(self, fragment: str, rows=(), rowcount: int = 1, lastrowid: int = 0, error: Exception = None) -> None:
+        def respond(sql, args):
+            if error is not None:
+                raise error
+            return rows, rowcount, lastrowid
+        self._rules.insert(0, (fragment, respond))
+
+    def respond(self, sql: str, args: tuple):
+        for fragment, respond in self._rules:
+            if fragment in sql:
+                return respond(sql, args)
+        return (), 1, 0
+
+    def record(self, sql: str, args, many: bool = False) -> None:
+        self.statements.append((sql, args, many))
+
+    def sql(self) -> List[str]:
+        return [sql for sql, _, _ in self.statements]
+
+    def executed(self, fragment: str) -> List[Tuple[str, any, bool]]:
+        return [statement for statement in self.statements if fragment in statement[0]]
+
+    @contextmanager
+    def connection(self):
+        self.checkouts += 1
+        self.in_use += 1
+        try:
+            yield FakeConnection(self)
+        finally:
+            self.in_use -= 1
+
+    def stats(self) -> Dict[str, int]:
+        return {"checkouts": self.checkouts, "in_use": self.in_use}
+
+
+@pytest.fixture
+def fake_db(monkeypatch):
+    """
+    AbstractModelのプールをFakeDBに差し替える
+    """
+    from app.models import abstract
+    db = FakeDB()
+    monkeypatch.setattr(abstract, "get_pool", lambda config: db)
+    return db
+
+
+@pytest.fixture
+def config():
+    from app.configs import Config
+    return Config()
@@ -0,0 +1,75 @@
+"""
+asyncio版のモデル(AsyncAbstractModel)
+プールの作成がイベントループごとに行われるか，同期版の書き込みが非同期版で呼べないようになっているか
+"""
+import asyncio
+
+import pytest
+
+from app.models import async_abstract
+from app.models.articles import AsyncArticleModel
+from app.models.async_abstract import get_async_pool
+from app.models.auth import AsyncAuthModel
+from app.models.follow import AsyncFollowGraphModel
+
+
+class Pool(object):
+    pass
+
+
+@pytest.fixture
+def pools(monkeypatch):
+    created = []
+
+    async def create_pool(**kwargs):
+        # 作成中に他のタスクがロックを待つようにする
+        await asyncio.sleep(0.01)
+        created.append(Pool())
+        return created[-1]
+    monkeypatch.setattr(async_abstract, "_pools", {})
+    monkeypatch.setattr(async_abstract.aiomysql, "create_pool", create_pool)
+    return created
+
+
+def test_one_pool_per_loop_even_when_requested_concurrently(pools, config):
+    async def run():
+        return await asyncio.gather(*[get_async_pool(config) for _ in range(3)])
+
+    first = asyncio.run(run())
+    # 別のイベントループでも，前のループのロックに紐づかずに作れる
+    second = asyncio.run(run())
+    assert len(pools) == 2
+    assert len(set(map(id, first))) == 1 and len(set(map(id, second))) == 1
+    assert first[0] is not second[0]
+
+
+@pytest.mark.parametrize("model_class, method, args", [
+    (AsyncArticleModel, "create_article", ("alice", "title", "body")),
+    (AsyncArticleModel, "post_new_comment", ("alice", 7, "nice")),
+    (AsyncAuthModel, "add_profile_info", ("alice",)),
+    (AsyncAuthModel, "profile_update", ("Alice", "", "", "", "", "", "", "", "alice")),
+    (AsyncFollowGraphModel, "follow_user", ("alice", "bob", "bob--alice")),
+])
+def test_sync_writes_raise_on_async_models(fake_db, config, model_class, method, args):
+    with pytest.raises(NotImplementedError, match=method):
+        getattr(model_class(config), method)(*args)
+    assert fake_db.statements == []
+
+
+def test_single_statement_reads_are_awaitable(config):
+    class Model(AsyncArticleModel):
+        async def fetch_one(self, sql, *args):
+            return {"sql": sql, "args": args}
+
+    row = asyncio.run(Model(config).fetch_article_by_id(7))
+    assert "WHERE articles.id=%s" in row["sql"] and row["args"] == (7,)
+
+
+def test_async_login_awaits_the_inherited_query(config):
+    class Model(AsyncAuthModel):
+        async def fetch_one(self, sql, *args):
+            return {"username": args[0]} if args[0] == "alice" else None
+
+    model = Model(config)
+    assert asyncio.run(model.login("alice", "password")) == (True, {"username": "alice"})
+    assert asyncio.run(model.login("bob", "password")) == (False, None)
@@ -0,0 +1,74 @@
+"""
+負荷試験(app.bench)の集計と，試験用データの再現性
+"""
+import pytest
+
+from app.bench import seed as seed_module
+from app.bench.run import percentile, query_counts, summarize
+from app.bench.seed import BenchSeeder, bench_username
+
+
+def test_percentile_uses_the_nearest_rank():
+    values = [float(value) for value in range(1, 101)]
+    assert [percentile(values, ratio) for ratio in (0.5, 0.95, 0.99, 1.0)] == [50, 95, 99, 100]
+    assert percentile([3.0], 0.99) == 3.0
+    assert percentile([1.0, 2.0], 0.0) == 1.0
+    assert percentile([], 0.5) is None
+
+
+def test_summarize_reports_milliseconds_and_throughput():
+    summary = summarize([0.3, 0.1, 0.2], errors=1, duration=2.0)
+    assert summary["count"] == 3 and summary["errors"] == 1 and summary["rps"] == 1.5
+    assert summary["p50_ms"] == pytest.approx(200) and summary["max_ms"] == pytest.approx(300)
+    assert summarize([], 0, 0)["p99_ms"] is None
+
+
+def test_query_counts_are_per_request_deltas():
+    before = {"requests": {"routes": {"GET /articles": {"count": 10, "queries_avg": 2.0, "db_avg_ms": 1.0,
+                                                        "queries_max": 3}}}}
+    after = {"requests": {"routes": {"GET /articles": {"count": 30, "queries_avg": 3.0, "db_avg_ms": 2.0,
+                                                       "queries_max": 5},
+                                     "GET /matching": {"count": 4, "queries_avg": 1.0, "db_avg_ms": 0.5,
+                                                       "queries_max": 1}}}}
+    counts = query_counts(before, after)
+    # (3 * 30 - 2 * 10) / 20
+    assert counts["articles"] == {"queries_per_request": 3.5, "db_ms_per_request": 2.5, "queries_max": 5}
+    assert counts["matching"]["queries_per_request"] == 1.0
+    assert "login" not in counts
+
+
+def _seed(db, config, seed):
+    db.statements = []
+    BenchSeeder(config, 50, seed).seed()
+    return [(sql, args) for sql, args, many in db.statements if many]
+
+
+@pytest.fixture(autouse=True)
+def no_migrations(monkeypatch):
+    monkeypatch.setattr(seed_module.MigrationModel, "migrate", lambda self: None)
+
+
+@pytest.fixture
+def seed_db(fake_db):
+    fake_db.on("COUNT(*)", rows=[{"count": 0}])
+    fake_db.on("SELECT id FROM", rows=[(1,), (2,), (3,)])
+    return fake_db
+
+
+def test_same_seed_inserts_the_same_rows(seed_db, config):
+    first = _seed(seed_db, config, 1)
+    assert first == _seed(seed_db, config, 1)
+    assert first != _seed(seed_db, config, 2)
+    users = [args for sql, args in first if sql.startswith("INSERT IGNORE INTO users")][0]
+    assert [row[0] for row in users] == [bench_username(index) for index in range(50)]
+
+
+def test_seeded_follows_are_not_self_follows(seed_db, config):
+    follows = [row for sql, rows in _seed(seed_db, config, 1) if "INTO follow(" in sql for row in rows]
+    assert follows and all(to_user != from_user for to_user, from_user, _ in follows)
+
+
+def test_seed_does_nothing_when_already_seeded(fake_db, config):
+    fake_db.on("COUNT(*)", rows=[{"count": 50}])
+    BenchSeeder(config, 50).seed()
+    assert not [sql for sql in fake_db.sql() if sql.startswith("INSERT")]
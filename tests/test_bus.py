@@ -0,0 +1,133 @@
+"""
+チャットのpub/sub(SocketBusとブローカー)が，ブローカーが止まっていたり遅いノードがいても詰まらないか
+"""
+import asyncio
+import socket
+import time
+
+from app.utilities.bus import BusBroker, InProcessBus, SocketBus
+
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+async def _until(condition, timeout=3.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline
+        await asyncio.sleep(0.01)
+
+
+class FakeTransport(object):
+    def __init__(self, buffered=0):
+        self.buffered = buffered
+        self.aborted = False
+
+    def get_write_buffer_size(self):
+        return self.buffered
+
+    def abort(self):
+        self.aborted = True
+
+
+class FakeWriter(object):
+    def __init__(self, buffered=0, drain_forever=False):
+        self.transport = FakeTransport(buffered)
+        self.lines = []
+        self.closed = False
+        self.drain_forever = drain_forever
+
+    def write(self, line):
+        self.lines.append(line)
+
+    async def drain(self):
+        if self.drain_forever:
+            await asyncio.Event().wait()
+
+    def close(self):
+        self.closed = True
+
+    def get_extra_info(self, name):
+        return None
+
+
+def test_inprocess_bus_dispatches_to_handler():
+    received = []
+
+    async def run():
+        bus = InProcessBus()
+        await bus.start(lambda room, message: received.append((room, message)))
+        await bus.publish("room", {"text": "hi"})
+        return bus.stats()
+
+    stats = asyncio.run(run())
+    assert received == [("room", {"text": "hi"})]
+    assert stats["published"] == 1 and stats["received"] == 1
+
+
+def test_publish_does_not_wait_for_the_broker_and_is_sent_after_connecting():
+    received = []
+
+    async def run():
+        port = _free_port()
+        bus = SocketBus("127.0.0.1", port)
+        await bus.start(lambda room, message: received.append((room, message)))
+        await bus.subscribe("room")
+        started = time.monotonic()
+        await bus.publish("room", {"text": "while down"})
+        assert time.monotonic() - started < 0.5
+        assert bus.stats()["pending"] == 1
+        server = await asyncio.start_server(BusBroker().handle, "127.0.0.1", port)
+        try:
+            await _until(lambda: received)
+        finally:
+            await bus.stop()
+            server.close()
+        return bus.stats()
+
+    stats = asyncio.run(run())
+    assert received == [("room", {"text": "while down"})]
+    assert stats["pending"] == 0 and stats["dropped"] == 0
+
+
+def test_buffer_while_disconnected_is_bounded():
+    async def run():
+        bus = SocketBus("127.0.0.1", 1, max_buffered=2)
+        for i in range(3):
+            await bus.publish("room", {"i": i})
+        return bus
+
+    bus = asyncio.run(run())
+    assert [envelope["message"]["i"] for envelope in bus._buffered] == [1, 2]
+    assert bus.stats()["dropped"] == 1
+
+
+def test_publish_gives_up_on_a_broker_that_does_not_read():
+    async def run():
+        bus = SocketBus("127.0.0.1", 1, send_timeout=0.05)
+        writer = FakeWriter(drain_forever=True)
+        bus._writer = writer
+        bus._connected.set()
+        await bus.publish("room", {"text": "hi"})
+        return bus, writer
+
+    bus, writer = asyncio.run(run())
+    assert writer.closed
+    assert not bus.stats()["connected"]
+    assert bus.stats()["pending"] == 1
+
+
+def test_broker_disconnects_slow_subscribers_only():
+    broker = BusBroker(max_subscriber_buffer=100)
+    fast, slow = FakeWriter(), FakeWriter(buffered=100)
+    for writer in (fast, slow):
+        broker.subscribers.setdefault("room", set()).add(writer)
+    broker.subscribers["other"] = {slow}
+    broker._relay({"room": "room", "message": {}, "sent_at": 0, "origin": "x"})
+    assert len(fast.lines) == 1
+    assert slow.lines == [] and slow.transport.aborted
+    assert broker.subscribers == {"room": {fast}}
+    assert broker.disconnected == 1
@@ -0,0 +1,181 @@
+"""
+チャットのルームと接続ごとの送信(ChatHub, ChatConnection)，入室時の履歴と，メッセージの保存(ChatHistoryWriter)
+"""
+import asyncio
+
+from app.utilities.bus import InProcessBus
+from app.utilities.chat import DISCONNECT, DROP_OLDEST, SLOW_CONSUMER_CLOSE_CODE, ChatConnection, ChatHistoryWriter, \
+    ChatHub
+
+
+class FakeWebSocket(object):
+    def __init__(self, stuck=False):
+        self.sent = []
+        self.close_codes = []
+        # Trueなら送信が終わらない(読まないクライアント)
+        self.stuck = stuck
+
+    async def send_json(self, message):
+        if self.stuck:
+            await asyncio.Event().wait()
+        self.sent.append(message)
+
+    async def close(self, code=1000):
+        self.close_codes.append(code)
+
+
+class FakeChatModel(object):
+    def __init__(self, history=(), insert_delay=0.0):
+        self.history = list(history)
+        self.loaded = asyncio.Event()
+        self.gate = asyncio.Event()
+        self.gate.set()
+        self.fetches = 0
+        self.insert_delay = insert_delay
+        self.inserted = []
+
+    async def fetch_history(self, pub_id, limit=50):
+        self.fetches += 1
+        await self.gate.wait()
+        return list(self.history)
+
+    async def insert_messages(self, rows):
+        await asyncio.sleep(self.insert_delay)
+        self.inserted.extend(rows)
+
+
+def _row(message):
+    return {"nickname": "alice", "message": message, "created_at": "2026-01-01 00:00:00"}
+
+
+async def _settle():
+    for _ in range(5):
+        await asyncio.sleep(0)
+
+
+def test_drop_oldest_keeps_the_newest_messages():
+    async def run():
+        connection = ChatConnection(FakeWebSocket(), 2, DROP_OLDEST, 1.0)
+        results = [connection.offer({"message": str(i)}) for i in range(3)]
+        return connection, results
+
+    connection, results = asyncio.run(run())
+    assert results == [True, True, True]
+    assert [connection.queue.get_nowait()["message"] for _ in range(2)] == ["1", "2"]
+    assert connection.dropped == 1 and not connection.closed
+
+
+def test_disconnect_policy_closes_a_full_connection():
+    async def run():
+        websocket = FakeWebSocket()
+        connection = ChatConnection(websocket, 1, DISCONNECT, 1.0)
+        results = [connection.offer({"message": "1"}), connection.offer({"message": "2"}),
+                   connection.offer({"message": "3"})]
+        await _settle()
+        return websocket, connection, results
+
+    websocket, connection, results = asyncio.run(run())
+    assert results == [True, False, False]
+    assert connection.closed and websocket.close_codes == [SLOW_CONSUMER_CLOSE_CODE]
+
+
+def test_slow_client_does_not_hold_up_the_room(config):
+    config.chat_send_timeout = 0.05
+
+    async def run():
+        hub = ChatHub(config, bus=InProcessBus())
+        hub.model = FakeChatModel()
+        await hub.bus.start(hub.deliver)
+        slow, fast, other = FakeWebSocket(stuck=True), FakeWebSocket(), FakeWebSocket()
+        connections = [("pub1", await hub.join("pub1", slow)), ("pub1", await hub.join("pub1", fast)),
+                       ("pub2", await hub.join("pub2", other))]
+        delivered = hub.deliver("pub1", _row("hello"))
+        await _settle()
+        # 遅いクライアントを待たずに他の接続には届いている
+        received = list(fast.sent)
+        await asyncio.sleep(0.1)
+        for room, connection in connections:
+            await hub.leave(room, connection)
+        return delivered, received, slow, other
+
+    delivered, received, slow, other = asyncio.run(run())
+    assert delivered == 2
+    assert [message["message"] for message in received] == ["hello"]
+    # 送信がchat_send_timeoutを超えたクライアントは切断され，別のルームには届かない
+    assert slow.close_codes[0] == SLOW_CONSUMER_CLOSE_CODE
+    assert other.sent == []
+
+
+def test_joiners_during_history_load_get_the_same_backfill(config):
+    async def run():
+        hub = ChatHub(config, bus=InProcessBus())
+        hub.model = FakeChatModel([_row("second"), _row("first")])
+        hub.model.gate.clear()
+        await hub.bus.start(hub.deliver)
+        first, second = FakeWebSocket(), FakeWebSocket()
+        joining = asyncio.create_task(hub.join("pub", first))
+        await _settle()
+        later = asyncio.create_task(hub.join("pub", second))
+        await _settle()
+        # 読み込み中に届いたメッセージも履歴の後ろに残る
+        hub.deliver("pub", _row("during load"))
+        hub.model.gate.set()
+        connections = await asyncio.gather(joining, later)
+        await _settle()
+        stats = hub.stats()
+        for connection in connections:
+            await hub.leave("pub", connection)
+        return hub, first, second, stats
+
+    hub, first, second, stats = asyncio.run(run())
+    assert hub.model.fetches == 1
+    expected = ["first", "second", "during load"]
+    assert [message["message"] for message in first.sent] == expected
+    assert [message["message"] for message in second.sent] == expected
+    assert stats["connections"] == 2
+    assert hub.rooms == {} and hub.history == {}
+
+
+def test_history_writer_batches_messages(config):
+    async def run():
+        model = FakeChatModel()
+        writer = ChatHistoryWriter(model, batch_size=2, interval=60.0, max_pending=100)
+        writer.start()
+        writer.add("pub", {"nickname": "a", "message": "1", "created_at": "t"})
+        writer.add("pub", {"nickname": "a", "message": "2", "created_at": "t"})
+        await _settle()
+        await writer.stop()
+        return model, writer
+
+    model, writer = asyncio.run(run())
+    assert [row[2] for row in model.inserted] == ["1", "2"]
+    assert writer.stats() == {"written": 2, "batches": 1, "failed": 0, "pending": 0}
+
+
+def test_history_writer_stop_does_not_lose_a_flush_in_progress():
+    async def run():
+        model = FakeChatModel(insert_delay=0.05)
+        writer = ChatHistoryWriter(model, batch_size=1, interval=60.0, max_pending=100)
+        writer.start()
+        writer.add("pub", {"nickname": "a", "message": "in flight", "created_at": "t"})
+        await asyncio.sleep(0.01)
+        writer.add("pub", {"nickname": "a", "message": "left over", "created_at": "t"})
+        await writer.stop()
+        return model
+
+    model = asyncio.run(run())
+    assert [row[2] for row in model.inserted] == ["in flight", "left over"]
+
+
+def test_history_writer_keeps_rows_when_cancelled_mid_flush():
+    async def run():
+        model = FakeChatModel(insert_delay=10)
+        writer = ChatHistoryWriter(model, batch_size=100, interval=60.0, max_pending=100)
+        writer.add("pub", {"nickname": "a", "message": "1", "created_at": "t"})
+        task = asyncio.create_task(writer.flush())
+        await _settle()
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+        return writer
+
+    assert asyncio.run(run()).stats()["pending"] == 1
@@ -0,0 +1,42 @@
+"""
+ログインしていない時にリダイレクトするデコレータ(check_login)
+async defのハンドラはasyncのまま包み，FastAPIがイベントループ上で実行できるか
+"""
+import asyncio
+import inspect
+
+from fastapi.responses import RedirectResponse
+
+from app.utilities.check_login import check_login
+
+
+@check_login
+async def async_page(session_id=None):
+    await asyncio.sleep(0)
+    return "page"
+
+
+@check_login
+def sync_page(session_id=None):
+    return "page"
+
+
+def test_async_handler_stays_a_coroutine_function():
+    # FastAPIはこれを見てスレッドプールに回すかどうかを決める
+    assert inspect.iscoroutinefunction(async_page)
+    assert not inspect.iscoroutinefunction(sync_page)
+    assert async_page.__name__ == "async_page"
+
+
+def test_async_handler_runs_with_a_session():
+    assert asyncio.run(async_page(session_id="abc")) == "page"
+
+
+def test_async_handler_redirects_without_a_session():
+    response = asyncio.run(async_page(session_id=None))
+    assert isinstance(response, RedirectResponse) and response.headers["location"] == "/"
+
+
+def test_sync_handler_redirects_without_a_session():
+    assert sync_page(session_id="abc") == "page"
+    assert isinstance(sync_page(), RedirectResponse)
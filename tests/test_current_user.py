@@ -0,0 +1,76 @@
+"""
+ログイン中のユーザの解決(CurrentUser)と，プロフィールのキャッシュ(TTLCache)
+"""
+import time
+
+import pytest
+
+from app.models import auth
+from app.models.auth import AuthModel
+from app.utilities.cache import TTLCache
+from app.utilities.current_user import CurrentUser
+
+
+class Session(object):
+    def __init__(self, sessions):
+        self.sessions = sessions
+
+    def get(self, session_id):
+        return self.sessions.get(session_id, {})
+
+
+@pytest.fixture(autouse=True)
+def profile_cache(monkeypatch):
+    cache = TTLCache(10, 60)
+    monkeypatch.setattr(auth, "profile_cache", cache)
+    return cache
+
+
+@pytest.fixture
+def current_user(config):
+    return CurrentUser(Session({"s1": {"user": {"username": "alice"}}, "s2": {}}), config)
+
+
+def test_profile_is_looked_up_once_and_cached(fake_db, current_user):
+    fake_db.on("INNER JOIN profile", rows=[{"username": "alice", "nickname": "Alice"}])
+    assert current_user("s1") == {"username": "alice", "nickname": "Alice"}
+    assert current_user("s1")["nickname"] == "Alice"
+    assert len(fake_db.executed("INNER JOIN profile")) == 1
+    assert fake_db.executed("INNER JOIN profile")[0][1] == ("alice",)
+
+
+def test_not_logged_in_returns_none_without_queries(fake_db, current_user):
+    assert current_user(None) is None
+    assert current_user("s2") is None
+    assert current_user("unknown") is None
+    assert fake_db.statements == []
+
+
+def test_missing_profile_is_not_cached(fake_db, current_user, profile_cache):
+    assert current_user("s1") is None
+    assert profile_cache.get("alice") is None
+    current_user("s1")
+    assert len(fake_db.executed("INNER JOIN profile")) == 2
+
+
+def test_profile_update_drops_the_cached_profile(fake_db, config, current_user):
+    fake_db.on("INNER JOIN profile", rows=[{"username": "alice", "nickname": "Alice"}])
+    current_user("s1")
+    AuthModel(config).profile_update("Ali", "", "", "", "", "", "", "", "alice")
+    fake_db.on("INNER JOIN profile", rows=[{"username": "alice", "nickname": "Ali"}])
+    assert current_user("s1")["nickname"] == "Ali"
+
+
+def test_ttl_cache_expires_and_evicts_least_recently_used(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr(time, "monotonic", lambda: now[0])
+    cache = TTLCache(2, 10)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    assert cache.get("a") == 1
+    # bが一番使われていないので捨てられる
+    cache.set("c", 3)
+    assert cache.get("b") is None and cache.get("c") == 3
+    now[0] += 11
+    assert cache.get("a") is None
+    assert cache.stats() == {"size": 1, "hits": 2, "misses": 2}
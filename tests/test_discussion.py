@@ -0,0 +1,36 @@
+"""
+ディスカッションのスレッドを１回のSQLで読み，コメント -> 返信の木にする
+"""
+from app.models.discussion import THREAD_SQL, DiscussionModel, build_thread
+
+
+def _row(kind, row_id, parent_id, body, created_at):
+    return {"kind": kind, "id": row_id, "parent_id": parent_id, "username": "alice", "nickname": "Alice",
+            "body": body, "created_at": created_at, "status": "open" if kind == "topic" else None,
+            "title": "title" if kind == "topic" else None, "pub_id": "pub" if kind == "topic" else None}
+
+
+def test_build_thread_attaches_replies_to_their_comments():
+    thread = build_thread([
+        _row("topic", 1, None, "topic", "2026-01-01 00:00:00"),
+        _row("comment", 10, 1, "first", "2026-01-01 00:01:00"),
+        _row("comment", 11, 1, "second", "2026-01-01 00:02:00"),
+        _row("reply", 100, 10, "reply to first", "2026-01-01 00:03:00"),
+        _row("reply", 101, 10, "another", "2026-01-01 00:04:00"),
+    ])
+    assert thread.topic["title"] == "title" and thread.topic["pub_id"] == "pub"
+    assert [comment["context"] for comment in thread.comments] == ["first", "second"]
+    assert [reply["context"] for reply in thread.comments[0]["replies"]] == ["reply to first", "another"]
+    assert thread.comments[1]["replies"] == []
+
+
+def test_build_thread_without_topic_is_none():
+    assert build_thread([_row("comment", 10, 1, "orphan", "2026-01-01 00:01:00")]) is None
+
+
+def test_load_thread_is_one_query(fake_db, config):
+    fake_db.on("UNION ALL", rows=[_row("topic", 1, None, "topic", "2026-01-01 00:00:00")])
+    thread = DiscussionModel(config).load_thread(1)
+    assert thread.comments == []
+    assert fake_db.sql() == [THREAD_SQL]
+    assert fake_db.statements[0][1] == (1, 1, 1)
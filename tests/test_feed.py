@@ -0,0 +1,127 @@
+"""
+/articles のタイムライン(ArticleFeed)と，プロフィールの変更・変更ログの削除
+"""
+import pytest
+
+from app.models.auth import AuthModel
+from app.models.pagination import NEXT, decode_cursor
+from app.utilities import feed
+from app.utilities.feed import ArticleFeed
+
+
+class FakeArticleModel(object):
+    """
+    記事とarticle_changesをメモリに持つArticleModelの代わり
+    """
+
+    def __init__(self, count):
+        self.articles = {}
+        self.changes = []
+        self.pruned_with = []
+        self.fallbacks = 0
+        for article_id in range(1, count + 1):
+            self.save(article_id, "alice")
+
+    def save(self, article_id, nickname, log=True):
+        self.articles[article_id] = {"id": article_id, "created_at": "2026-01-01 00:00:%02d" % article_id,
+                                     "nickname": nickname}
+        if log:
+            self.changes.append({"id": len(self.changes) + 1, "article_id": article_id})
+
+    def fetch_recent_articles(self, limit):
+        return sorted(self.articles.values(), key=feed._key, reverse=True)[:limit]
+
+    def fetch_recent_articles_page(self, cursor, limit):
+        self.fallbacks += 1
+        return None
+
+    def fetch_articles_by_ids(self, article_ids):
+        return [self.articles[article_id] for article_id in article_ids if article_id in self.articles]
+
+    def fetch_article_changes(self, after_id):
+        return [change for change in self.changes if change["id"] > after_id]
+
+    def latest_article_change(self):
+        return self.changes[-1]["id"] if self.changes else 0
+
+    def prune_article_changes(self, older_than):
+        self.pruned_with.append(older_than)
+        return 0
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    class Clock(object):
+        now = 1000.0
+
+        def monotonic(self):
+            return self.now
+
+    clock = Clock()
+    monkeypatch.setattr(feed.time, "monotonic", clock.monotonic)
+    return clock
+
+
+def _feed(size=5):
+    return ArticleFeed(size, poll_interval=1.0, retention=600.0, prune_interval=60.0)
+
+
+def test_pages_come_from_memory_and_older_pages_from_mysql(clock):
+    model, timeline = FakeArticleModel(8), _feed(size=5)
+    page = timeline.page(model, limit=3)
+    assert [row["id"] for row in page.items] == [8, 7, 6]
+    direction, _ = decode_cursor(page.next_cursor)
+    assert direction == NEXT
+    assert model.fallbacks == 0
+    # 5件目より後ろはメモリにないのでMySQLから取る
+    timeline.page(model, cursor=timeline.page(model, limit=3).next_cursor, limit=3)
+    assert model.fallbacks == 1
+    assert timeline.stats()["rebuilds"] == 1
+
+
+def test_changes_from_other_workers_are_applied_after_poll_interval(clock):
+    model, timeline = FakeArticleModel(3), _feed()
+    timeline.page(model)
+    model.save(2, "Alice")
+    model.save(4, "bob")
+    assert timeline.page(model).items[1]["nickname"] == "alice"
+    clock.now += 1
+    items = timeline.page(model).items
+    assert [row["id"] for row in items] == [4, 3, 2, 1]
+    assert items[2]["nickname"] == "Alice"
+    assert timeline.stats()["refreshed_entries"] == 2
+
+
+def test_worker_that_could_not_read_the_log_for_retention_rebuilds(clock):
+    model, timeline = FakeArticleModel(3), _feed()
+    timeline.page(model)
+    # ログが消されて読めない変更
+    model.save(2, "Alice", log=False)
+    clock.now += 600
+    assert timeline.page(model).items[1]["nickname"] == "Alice"
+    assert timeline.stats()["rebuilds"] == 2
+
+
+def test_old_changes_are_pruned_every_prune_interval(clock):
+    model, timeline = FakeArticleModel(3), _feed()
+    timeline.page(model)
+    for _ in range(3):
+        clock.now += 30
+        timeline.page(model)
+    assert model.pruned_with == [600.0, 600.0]
+
+
+def test_prune_article_changes_sql(fake_db, config):
+    from app.models.articles import ArticleModel
+    fake_db.on("DELETE FROM article_changes", rowcount=7)
+    assert ArticleModel(config).prune_article_changes(600.0) == 7
+    assert fake_db.executed("DELETE FROM article_changes")[0][1] == (600,)
+
+
+def test_profile_update_logs_the_authors_recent_articles(fake_db, config):
+    fake_db.on("SELECT id FROM articles WHERE username", rows=[{"id": 3}, {"id": 1}])
+    AuthModel(config).profile_update("Alice", "Arsenal", "Premier League", "Japan", "hi", "-", "-", "-", "alice")
+    select = fake_db.executed("SELECT id FROM articles WHERE username")[0]
+    assert select[1][0] == "alice"
+    insert = fake_db.executed("INSERT INTO article_changes")[0]
+    assert insert[1] == [(3,), (1,)] and insert[2]
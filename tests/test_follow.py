@@ -0,0 +1,116 @@
+"""
+フォロー数の集計テーブル(user_follow_counts, pub_follow_counts)が，フォロー・解除と同じトランザクションで更新されるか
+"""
+import asyncio
+
+import pymysql
+import pytest
+
+from app.models.follow import PUB_COUNTER_SQL, USER_COUNTER_SQL, AsyncFollowGraphModel, FollowGraphModel
+from app.models.versions import BUMP_SQL, pub_key, user_key
+from app.utilities.write_behind import write_behind
+
+
+@pytest.fixture(autouse=True)
+def direct_writes(monkeypatch):
+    # write-behindを使わずにその場で書き込む
+    monkeypatch.setattr(write_behind, "enabled", False)
+
+
+def test_follow_user_updates_both_counters_in_lock_order(fake_db, config):
+    assert FollowGraphModel(config).follow_user("alice", "bob", "bob--alice") is True
+    sql = fake_db.sql()
+    assert sql[0] == "BEGIN" and sql[-1] == "COMMIT"
+    # フォローされるalice(followers+1)とするbob(followings+1)を名前の順に
+    assert [args for _, args, _ in fake_db.executed(USER_COUNTER_SQL)] == [("alice", 1, 0), ("bob", 0, 1)]
+    assert [args for _, args, _ in fake_db.executed(BUMP_SQL)] == [user_key("alice"), user_key("bob")]
+
+
+def test_unfollow_user_decrements_counters(fake_db, config):
+    assert FollowGraphModel(config).unfollow_user("bob", "alice") is True
+    assert [args for _, args, _ in fake_db.executed(USER_COUNTER_SQL)] == [("alice", 0, -1), ("bob", -1, 0)]
+
+
+def test_counters_are_not_touched_when_nothing_changed(fake_db, config):
+    # 既にフォロー済み(INSERT IGNOREで無視された)
+    fake_db.on("INSERT IGNORE INTO follow", rowcount=0)
+    assert FollowGraphModel(config).follow_user("alice", "bob", "bob--alice") is False
+    assert not fake_db.executed(USER_COUNTER_SQL)
+    assert not fake_db.executed(BUMP_SQL)
+    assert fake_db.sql()[-1] == "COMMIT"
+
+
+def test_failed_counter_update_rolls_back_the_follow(fake_db, config):
+    fake_db.on("INSERT INTO user_follow_counts", error=pymysql.err.OperationalError(1213, "Deadlock found"))
+    with pytest.raises(pymysql.err.OperationalError):
+        FollowGraphModel(config).follow_user("alice", "bob", "bob--alice")
+    assert fake_db.sql()[-1] == "ROLLBACK"
+    assert "COMMIT" not in fake_db.sql()
+
+
+def test_follow_pub_updates_pub_counter(fake_db, config):
+    model = FollowGraphModel(config)
+    assert model.follow_pub("pub1", "alice", "alice--pub1") is True
+    assert model.unfollow_pub("pub1", "alice") is True
+    assert [args for _, args, _ in fake_db.executed(PUB_COUNTER_SQL)] == [("pub1", 1), ("pub1", -1)]
+    assert [args for _, args, _ in fake_db.executed(BUMP_SQL)] == [pub_key("pub1")] * 2
+
+
+def test_batched_follows_add_up_deltas_per_user(fake_db, config):
+    rows = [("carol", "alice", "alice--carol"), ("carol", "bob", "bob--carol"), ("bob", "alice", "alice--bob")]
+    assert FollowGraphModel(config).insert_follows(rows) == 3
+    counters = fake_db.executed(USER_COUNTER_SQL)[0]
+    assert counters[2] and counters[1] == [("alice", 0, 2), ("bob", 1, 1), ("carol", 2, 0)]
+
+
+def test_counts_default_to_zero(fake_db, config):
+    model = FollowGraphModel(config)
+    assert model.user_counts("nobody") == {"followers": 0, "followings": 0}
+    assert model.pub_follower_count("nopub") == 0
+    fake_db.on("FROM pub_follow_counts", rows=[{"followers": 4}])
+    assert model.pub_follower_count("pub1") == 4
+
+
+def test_relation_looks_up_both_directions_by_follow_id(fake_db, config):
+    fake_db.on("SELECT id FROM follow", rows=[{"id": "bob--alice"}])
+    assert FollowGraphModel(config).relation("alice", "bob") == (False, True)
+    assert fake_db.statements[0][1] == ("alice--bob", "bob--alice")
+
+
+def test_rebuild_counts_runs_in_one_transaction(fake_db, config):
+    FollowGraphModel(config).rebuild_counts()
+    sql = fake_db.sql()
+    assert sql[0] == "BEGIN" and sql[-1] == "COMMIT"
+    assert sql[1] == "UPDATE user_follow_counts SET followers = 0, followings = 0"
+    assert "FROM follow" in sql[2] and "FROM followpub" in sql[4]
+
+
+def test_following_among_looks_up_by_follow_id(fake_db, config):
+    fake_db.on("SELECT to_user_id FROM follow", rows=[{"to_user_id": "bob"}])
+    model = FollowGraphModel(config)
+    assert model.following_among("alice", ["bob", "carol"]) == {"bob"}
+    assert fake_db.statements[0][1] == ("alice--bob", "alice--carol")
+    assert model.following_among("alice", []) == set()
+    assert len(fake_db.statements) == 1
+
+
+def test_async_following_among_uses_the_same_query(config):
+    class Model(AsyncFollowGraphModel):
+        async def fetch_all(self, sql, *args):
+            self.executed = (sql, args)
+            return [{"to_user_id": "carol"}]
+
+    model = Model.__new__(Model)
+    assert asyncio.run(model.following_among("alice", ["carol"])) == {"carol"}
+    assert model.executed == ("SELECT to_user_id FROM follow WHERE id IN (%s)", ("alice--carol",))
+
+
+def test_async_relation_uses_the_same_query(config):
+    class Model(AsyncFollowGraphModel):
+        async def fetch_all(self, sql, *args):
+            self.executed = (sql, args)
+            return [{"id": "alice--carol"}]
+
+    model = Model.__new__(Model)
+    assert asyncio.run(model.relation("alice", "carol")) == (True, False)
+    assert model.executed == ("SELECT id FROM follow WHERE id IN (%s, %s)", ("alice--carol", "carol--alice"))
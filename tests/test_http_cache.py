@@ -0,0 +1,64 @@
+"""
+HTTPキャッシュ(ETagと条件付きGET)
+ETagがページに表示されるユーザの版で変わり，関係ないユーザの版では変わらないか
+"""
+from types import SimpleNamespace
+
+from fastapi.responses import HTMLResponse
+
+from app.models.versions import VersionModel, article_key, user_key
+from app.utilities.http_cache import HttpCache
+
+
+def _request(if_none_match: str = ""):
+    return SimpleNamespace(url=SimpleNamespace(path="/article/7", query=""),
+                           headers={"if-none-match": if_none_match} if if_none_match else {})
+
+
+def _versions(*rows):
+    return [{"kind": kind, "entity_id": entity_id, "version": version, "updated_at": None}
+            for kind, entity_id, version in rows]
+
+
+def _page(config):
+    cache = HttpCache(config, SimpleNamespace(version="t1"))
+    rendered = []
+
+    @cache.conditional(article="article_id")
+    def article_detail_page(request, article_id, user):
+        rendered.append(article_id)
+        return HTMLResponse("<p>%s</p>" % article_id)
+
+    return article_detail_page, rendered
+
+
+def test_versions_include_the_users_shown_on_an_article_in_one_query(fake_db, config):
+    VersionModel(config).versions([article_key(7), user_key("alice")])
+    sql, args, _ = fake_db.statements[0]
+    assert "OR (kind = 'user' AND entity_id IN (SELECT username FROM articles WHERE id = %s" in sql
+    assert "SELECT username FROM comments WHERE article_id = %s" in sql
+    assert args == ("article", "7", "user", "alice", "7", "7")
+    assert len(fake_db.statements) == 1
+
+
+def test_etag_changes_only_when_a_shown_user_changes(fake_db, config):
+    page, rendered = _page(config)
+    fake_db.on("FROM entity_versions", rows=_versions(("article", "7", 1), ("user", "bob", 1)))
+    etag = page(request=_request(), article_id=7, user={"username": "alice"}).headers["ETag"]
+    assert page(request=_request(etag), article_id=7, user={"username": "alice"}).status_code == 304
+    # コメントしたbobがプロフィールを変えた
+    fake_db.on("FROM entity_versions", rows=_versions(("article", "7", 1), ("user", "bob", 2)))
+    response = page(request=_request(etag), article_id=7, user={"username": "alice"})
+    assert response.status_code == 200 and response.headers["ETag"] != etag
+    assert rendered == [7, 7]
+
+
+def test_page_is_rendered_once_per_etag(fake_db, config):
+    page, rendered = _page(config)
+    fake_db.on("FROM entity_versions", rows=_versions(("article", "7", 1)))
+    first = page(request=_request(), article_id=7, user={"username": "alice"})
+    second = page(request=_request(), article_id=7, user={"username": "alice"})
+    assert second.body == first.body and rendered == [7]
+    # ログイン中のユーザが違えば別のETag
+    other = page(request=_request(), article_id=7, user={"username": "carol"})
+    assert other.headers["ETag"] != first.headers["ETag"] and rendered == [7, 7]
@@ -0,0 +1,150 @@
+"""
+/matching のおすすめユーザ(MatchingIndex)
+"""
+import asyncio
+import random
+
+import pytest
+
+from app.models.follow import FollowGraphModel
+from app.models.pagination import decode_cursor
+from app.utilities import matching
+from app.utilities.matching import CLUB_WEIGHT, LEAGUE_WEIGHT, NATION_WEIGHT, MatchingIndex
+
+CLUBS = ["Arsenal", "Chelsea", "未登録"]
+LEAGUES = ["Premier League", "La Liga", None]
+NATIONS = ["Japan", "England", ""]
+
+
+class FakeAuthModel(object):
+    def __init__(self, count, seed=1):
+        generator = random.Random(seed)
+        self.rows = [("user%03d" % i, "fan %d" % i, "2026-01-%02d 00:00:00" % (1 + i % 28),
+                      generator.choice(CLUBS), generator.choice(LEAGUES), generator.choice(NATIONS))
+                     for i in range(count)]
+        self.builds = 0
+
+    def iter_fans(self):
+        self.builds += 1
+        return iter(self.rows)
+
+    def find_profile_by_user_id(self, username):
+        for row in self.rows:
+            if row[0] == username:
+                return dict(zip(("username", "nickname", "created_at", "your_club", "your_league",
+                                 "your_nation"), row))
+        return None
+
+
+def _viewer(club="Arsenal", league="Premier League", nation="Japan"):
+    return {"username": "user000", "your_club": club, "your_league": league, "your_nation": nation}
+
+
+def _expected(model, user, excluded=()):
+    ranked = []
+    for username, _, created_at, club, league, nation in model.rows:
+        if username == user["username"] or username in excluded:
+            continue
+        score = 0
+        for value, mine, weight in ((club, user["your_club"], CLUB_WEIGHT),
+                                    (league, user["your_league"], LEAGUE_WEIGHT),
+                                    (nation, user["your_nation"], NATION_WEIGHT)):
+            if mine not in matching.UNSET and value == mine:
+                score += weight
+        if score:
+            ranked.append((score, created_at, username))
+    return [username for _, _, username in sorted(ranked, reverse=True)]
+
+
+def _walk(index, model, user, exclude=None, limit=7):
+    usernames, cursors, cursor = [], [], None
+    while True:
+        page = index.suggestions(model, user, exclude, cursor, limit)
+        usernames.extend(row["username"] for row in page.items)
+        cursors.append(page)
+        if page.next_cursor is None:
+            return usernames, cursors
+        cursor = page.next_cursor
+
+
+@pytest.mark.parametrize("user", [_viewer(), _viewer(league=None), _viewer(club="未登録", nation="England"),
+                                  _viewer(club=None, league=None, nation=None)])
+def test_pages_follow_the_same_order_as_scoring_everyone(user):
+    model = FakeAuthModel(120)
+    index = MatchingIndex(ttl=0)
+    usernames, _ = _walk(index, model, user)
+    assert usernames == _expected(model, user)
+    assert model.builds == 1
+
+
+def test_prev_cursor_returns_the_previous_page():
+    model, index = FakeAuthModel(60), MatchingIndex(ttl=0)
+    first = index.suggestions(model, _viewer(), limit=5)
+    second = index.suggestions(model, _viewer(), cursor=first.next_cursor, limit=5)
+    back = index.suggestions(model, _viewer(), cursor=second.prev_cursor, limit=5)
+    assert [row["username"] for row in back.items] == [row["username"] for row in first.items]
+    assert back.prev_cursor is None
+    assert decode_cursor(back.next_cursor) == decode_cursor(first.next_cursor)
+
+
+def test_exclusion_is_looked_up_per_batch_of_candidates():
+    model, index = FakeAuthModel(120), MatchingIndex(ttl=0)
+    following = set(_expected(model, _viewer())[::2])
+    lookups = []
+
+    def exclude(usernames):
+        lookups.append(len(usernames))
+        return following & set(usernames)
+
+    usernames, _ = _walk(index, model, _viewer(), exclude)
+    assert usernames == _expected(model, _viewer(), following)
+    assert max(lookups) <= 8
+
+
+def test_exclusion_lookups_are_capped_and_continue_on_the_next_page():
+    model, index = FakeAuthModel(120), MatchingIndex(ttl=0)
+    expected = _expected(model, _viewer())
+    following = set(expected[:40])
+    calls = []
+
+    def exclude(usernames):
+        calls.append(usernames)
+        return following & set(usernames)
+
+    page = index.suggestions(model, _viewer(), exclude, limit=3)
+    # 4件ずつ5回問い合わせても全てフォロー済みなので，空のページで次のカーソルを返す
+    assert len(calls) == matching.MAX_EXCLUDE_LOOKUPS
+    assert page.items == [] and page.next_cursor is not None
+    usernames, _ = _walk(index, model, _viewer(), exclude, limit=3)
+    assert usernames == _expected(model, _viewer(), following)
+
+
+def test_refresh_user_moves_the_user_between_buckets():
+    model, index = FakeAuthModel(30), MatchingIndex(ttl=0)
+    index.suggestions(model, _viewer())
+    row = list(model.rows[5])
+    row[3:6] = ["Arsenal", "Premier League", "Japan"]
+    model.rows[5] = tuple(row)
+    index.refresh_user(model, row[0])
+    usernames, _ = _walk(index, model, _viewer())
+    assert usernames == _expected(model, _viewer())
+    assert index.stats()["updates"] == 1
+
+
+def test_suggestions_async_uses_an_async_exclude():
+    model, index = FakeAuthModel(50), MatchingIndex(ttl=0)
+    index.ensure(model)
+    following = set(_expected(model, _viewer())[:3])
+
+    async def exclude(usernames):
+        return following & set(usernames)
+
+    page = asyncio.run(index.suggestions_async(_viewer(), exclude, limit=200))
+    assert [row["username"] for row in page.items] == _expected(model, _viewer(), following)
+
+
+def test_following_among_reads_by_follow_id(fake_db, config):
+    fake_db.on("SELECT to_user_id FROM follow", rows=[{"to_user_id": "bob"}])
+    assert FollowGraphModel(config).following_among("alice", ["bob", "carol"]) == {"bob"}
+    assert fake_db.executed("SELECT to_user_id FROM follow")[0][1] == ("alice--bob", "alice--carol")
+    assert FollowGraphModel(config).following_among("alice", []) == set()
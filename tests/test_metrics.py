@@ -0,0 +1,83 @@
+"""
+リクエストとSQLの計測(/metrics)
+"""
+import asyncio
+from types import SimpleNamespace
+
+from app.models.abstract import AbstractModel
+from app.utilities import metrics as metrics_module
+from app.utilities.metrics import Metrics, MetricsMiddleware, normalize_sql
+
+
+def test_normalize_sql_groups_queries_that_differ_only_in_values():
+    assert normalize_sql("SELECT * FROM users WHERE id = 5 AND name = 'bob'") == \
+        "SELECT * FROM users WHERE id = ? AND name = ?"
+    assert normalize_sql("SELECT id FROM follow WHERE id IN (%s, %s, %s)") == "SELECT id FROM follow WHERE id IN (...)"
+    assert normalize_sql("INSERT INTO t(a, b) VALUES (%s, %s), (%s, %s)") == "INSERT INTO t(a, b) VALUES (...), ..."
+    assert normalize_sql("SELECT  *\n FROM t") == "SELECT * FROM t"
+
+
+def test_request_counts_queries_and_latency_buckets():
+    metrics = Metrics(0, 10, 0)
+    token = metrics.begin_request()
+    metrics.record_query("SELECT * FROM articles WHERE id = %s", 0.002)
+    metrics.record_query("SELECT * FROM articles WHERE id = %s", 0.004)
+    metrics.end_request(token, "GET /article/{article_id}", 0.020)
+    token = metrics.begin_request()
+    metrics.end_request(token, "GET /article/{article_id}", 10.0)
+    route = metrics.stats()["routes"]["GET /article/{article_id}"]
+    assert route["count"] == 2 and route["queries_max"] == 2 and route["queries_avg"] == 1
+    assert route["histogram"]["25"] == 1 and route["histogram"]["inf"] == 1
+    assert route["p50_ms"] == 25 and route["p99_ms"] is None
+    query = metrics.stats()["queries"][0]
+    assert query["sql"] == "SELECT * FROM articles WHERE id = ?" and query["count"] == 2
+
+
+def test_queries_are_sorted_by_total_time_and_capped():
+    metrics = Metrics(0, 1, 0)
+    metrics.record_query("SELECT 1", 0.001)
+    metrics.record_query("SELECT * FROM follow", 0.5)
+    assert [query["sql"] for query in metrics.stats()["queries"]] == ["SELECT * FROM follow"]
+
+
+def test_slow_queries_and_chatty_requests_are_logged(caplog):
+    metrics = Metrics(0.1, 10, 1)
+    token = metrics.begin_request()
+    metrics.record_query("SELECT 1", 0.2)
+    metrics.record_query("SELECT 2", 0.0)
+    metrics.end_request(token, "GET /", 0.3)
+    messages = [record.getMessage() for record in caplog.records]
+    assert any(message.startswith("slow query 200.0ms") for message in messages)
+    assert any(message.startswith("GET / ran 2 queries") for message in messages)
+
+
+def test_model_queries_are_recorded_for_the_current_request(fake_db, config, monkeypatch):
+    metrics = Metrics(0, 10, 0)
+    monkeypatch.setattr(metrics_module.metrics, "record_query", metrics.record_query)
+    token = metrics.begin_request()
+    AbstractModel(config).fetch_all("SELECT * FROM pubs")
+    metrics.end_request(token, "GET /pubs", 0.001)
+    assert metrics.stats()["routes"]["GET /pubs"]["queries_max"] == 1
+
+
+def test_middleware_records_the_route_template():
+    metrics = Metrics(0, 10, 0)
+
+    async def app(scope, receive, send):
+        scope["route"] = SimpleNamespace(path="/article/{article_id}")
+        metrics.record_query("SELECT 1", 0.0)
+
+    scope = {"type": "http", "method": "GET", "path": "/article/3"}
+    asyncio.run(MetricsMiddleware(app, metrics)(scope, None, None))
+    route = metrics.stats()["routes"]["GET /article/{article_id}"]
+    assert route["count"] == 1 and route["queries_max"] == 1
+
+
+def test_middleware_ignores_non_http_scopes():
+    metrics = Metrics(0, 10, 0)
+
+    async def app(scope, receive, send):
+        pass
+
+    asyncio.run(MetricsMiddleware(app, metrics)({"type": "lifespan"}, None, None))
+    assert metrics.stats()["routes"] == {}
@@ -0,0 +1,138 @@
+"""
+スキーマのマイグレーション(load_migrations, MigrationModel)と，クエリの実行計画の確認(explain)
+"""
+import pymysql
+import pytest
+
+from app.errors import MigrationError
+from app.models.explain import Check, explain, full_scans
+from app.models.migration import LOCK_NAME, MigrationModel, load_migrations
+
+
+def _write(directory, name, source):
+    (directory / name).write_text(source, encoding="utf-8")
+
+
+@pytest.fixture
+def migrations(tmp_path):
+    _write(tmp_path, "0002_second.sql", "-- 2つ目\nCREATE INDEX ix_b ON b (x);\nCREATE INDEX ix_c ON c (x);\n")
+    _write(tmp_path, "0001_first.sql", "CREATE TABLE a (\n  id INT\n);\n")
+    _write(tmp_path, "README.md", "not a migration")
+    return load_migrations(str(tmp_path))
+
+
+def _locked(db, locked=1, applied=()):
+    db.on("GET_LOCK", rows=[{"locked": locked}])
+    db.on("SELECT version FROM schema_migrations", rows=[{"version": version} for version in applied])
+
+
+def test_files_are_loaded_in_version_order_without_comments(migrations):
+    assert [(migration.version, migration.name) for migration in migrations] == [(1, "first"), (2, "second")]
+    assert migrations[0].statements == ["CREATE TABLE a (\n  id INT\n)"]
+    assert migrations[1].statements == ["CREATE INDEX ix_b ON b (x)", "CREATE INDEX ix_c ON c (x)"]
+    assert len(migrations[0].checksum) == 40
+
+
+def test_duplicate_versions_are_rejected(tmp_path):
+    _write(tmp_path, "0001_a.sql", "SELECT 1;")
+    _write(tmp_path, "0001_b.sql", "SELECT 1;")
+    with pytest.raises(MigrationError):
+        load_migrations(str(tmp_path))
+
+
+def test_repository_migrations_have_unique_versions():
+    versions = [migration.version for migration in load_migrations()]
+    assert versions == sorted(versions) and versions[0] == 0
+
+
+def test_migrate_applies_pending_files_under_the_lock(fake_db, config, migrations):
+    _locked(fake_db, applied=[1])
+    assert MigrationModel(config).migrate(migrations=migrations) == [2]
+    sql = fake_db.sql()
+    assert sql[0].startswith("SELECT GET_LOCK") and sql[-1] == "SELECT RELEASE_LOCK(%s)"
+    assert fake_db.statements[0][1] == (LOCK_NAME, 60)
+    assert "CREATE TABLE a" not in "\n".join(sql)
+    assert fake_db.executed("INSERT INTO schema_migrations")[0][1] == (2, "second", migrations[1].checksum)
+
+
+def test_migrate_stops_at_the_target(fake_db, config, migrations):
+    _locked(fake_db)
+    assert MigrationModel(config).migrate(target=1, migrations=migrations) == [1]
+    assert not fake_db.executed("ix_b")
+
+
+def test_existing_indexes_are_skipped_and_the_file_is_recorded(fake_db, config, migrations):
+    _locked(fake_db, applied=[1])
+    fake_db.on("ix_b", error=pymysql.err.OperationalError(1061, "Duplicate key name 'ix_b'"))
+    assert MigrationModel(config).migrate(migrations=migrations) == [2]
+    assert fake_db.executed("ix_c") and fake_db.executed("INSERT INTO schema_migrations")
+
+
+def test_failed_file_is_not_recorded_and_the_lock_is_released(fake_db, config, migrations):
+    _locked(fake_db, applied=[1])
+    fake_db.on("ix_b", error=pymysql.err.OperationalError(1146, "Table 'b' doesn't exist"))
+    with pytest.raises(MigrationError, match="0002_second"):
+        MigrationModel(config).migrate(migrations=migrations)
+    assert not fake_db.executed("ix_c") and not fake_db.executed("INSERT INTO schema_migrations")
+    assert fake_db.sql()[-1] == "SELECT RELEASE_LOCK(%s)"
+
+
+def test_migrate_fails_without_the_lock(fake_db, config, migrations):
+    _locked(fake_db, locked=0)
+    with pytest.raises(MigrationError):
+        MigrationModel(config).migrate(migrations=migrations)
+    assert not fake_db.executed("CREATE TABLE a")
+
+
+def test_status_reports_changed_files(fake_db, config, migrations):
+    fake_db.on("SELECT * FROM schema_migrations",
+               rows=[{"version": 1, "checksum": "0" * 40, "applied_at": "2026-01-01"}])
+    status = MigrationModel(config).status(migrations)
+    assert status[0] == {"version": 1, "name": "first", "applied_at": "2026-01-01", "changed": True}
+    assert status[1]["applied_at"] is None and not status[1]["changed"]
+
+
+class Model(object):
+    def __init__(self, config):
+        self.config = config
+
+    def _execute(self, sql_statement, cursor, *args):
+        cursor.execute(sql_statement, args)
+
+
+def test_explain_ignores_result_shape_errors_after_the_plan(config):
+    class Cursor(object):
+        def execute(self, sql, args):
+            pass
+
+        def fetchall(self):
+            return [{"table": "articles", "type": "ALL", "possible_keys": None, "rows": 5}]
+
+    def call(model):
+        model._execute("SELECT * FROM articles", Cursor())
+        # EXPLAINの行を記事として読もうとして失敗する
+        return model.plans[-1][1][0]["title"]
+
+    plans = explain(config, Check("Model.call", Model, call))
+    assert [sql for sql, _ in plans] == ["SELECT * FROM articles"]
+    assert full_scans(plans[0][1]) == plans[0][1]
+
+
+def test_explain_raises_errors_of_the_statement_being_explained(config):
+    class Cursor(object):
+        def execute(self, sql, args):
+            raise TypeError("not all arguments converted during string formatting")
+
+    def call(model):
+        model._execute("SELECT * FROM articles WHERE id = %s", Cursor())
+
+    with pytest.raises(TypeError):
+        explain(config, Check("Model.call", Model, call))
+
+
+def test_explain_raises_other_errors(config):
+    def call(model):
+        raise ValueError("bug in the check")
+
+    with pytest.raises(ValueError):
+        explain(config, Check("Model.call", Model, call))
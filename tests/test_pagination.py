@@ -0,0 +1,99 @@
+"""
+カーソル(キーセット)によるページング
+"""
+from app.models.abstract import AbstractModel
+from app.models.pagination import (DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE, NEXT, PREV, build_page_query, clamp_page_size,
+                                   decode_cursor, encode_cursor, keyset_condition, make_page)
+
+KEYS = ("articles.created_at", "articles.id")
+
+
+def _rows(*ids):
+    return [{"created_at": "2024-01-%02d" % i, "id": i} for i in ids]
+
+
+def test_cursor_round_trip():
+    cursor = encode_cursor(PREV, ["2024-01-02", 5])
+    assert decode_cursor(cursor) == (PREV, ["2024-01-02", 5])
+
+
+def test_broken_or_missing_cursor_is_the_first_page():
+    assert decode_cursor(None) == (NEXT, None)
+    assert decode_cursor("") == (NEXT, None)
+    assert decode_cursor("not a cursor!") == (NEXT, None)
+    assert decode_cursor(encode_cursor("x", [1])) == (NEXT, None)
+    assert decode_cursor(encode_cursor(NEXT, "1")) == (NEXT, None)
+
+
+def test_clamp_page_size():
+    assert clamp_page_size("20") == 20
+    assert clamp_page_size(0) == 1
+    assert clamp_page_size(10000) == MAX_PAGE_SIZE
+    assert clamp_page_size("abc") == DEFAULT_PAGE_SIZE
+    assert clamp_page_size(None) == DEFAULT_PAGE_SIZE
+
+
+def test_keyset_condition_expands_the_row_comparison():
+    condition, args = keyset_condition(("a", "b", "c"), [1, 2, 3])
+    assert condition == "(a < %s OR (a = %s AND (b < %s OR (b = %s AND c < %s))))"
+    assert args == [1, 1, 2, 2, 3]
+    assert keyset_condition(("id",), [7], ">") == ("id > %s", [7])
+
+
+def test_first_page_query():
+    sql, args, direction = build_page_query("SELECT * FROM articles", ["user_id = %s"], ["alice"], KEYS, None, 10)
+    assert sql == ("SELECT * FROM articles WHERE user_id = %s "
+                   "ORDER BY articles.created_at DESC, articles.id DESC LIMIT %s")
+    assert args == ["alice", 11]
+    assert direction is None
+
+
+def test_cursor_with_the_wrong_number_of_keys_is_the_first_page():
+    cursor = encode_cursor(NEXT, [1])
+    sql, args, direction = build_page_query("SELECT * FROM articles", [], [], KEYS, cursor, 10)
+    assert "WHERE" not in sql and args == [11] and direction is None
+
+
+def test_prev_query_reads_ascending():
+    cursor = encode_cursor(PREV, ["2024-01-05", 5])
+    sql, args, direction = build_page_query("SELECT * FROM articles", [], [], KEYS, cursor, 2)
+    assert "articles.created_at > %s" in sql
+    assert sql.endswith("ORDER BY articles.created_at ASC, articles.id ASC LIMIT %s")
+    assert args == ["2024-01-05", "2024-01-05", 5, 3]
+    assert direction == PREV
+
+
+def test_first_page_has_only_a_next_cursor():
+    page = make_page(_rows(9, 8, 7), KEYS, 2, None)
+    assert [row["id"] for row in page.items] == [9, 8]
+    assert decode_cursor(page.next_cursor) == (NEXT, ["2024-01-08", 8])
+    assert page.prev_cursor is None
+
+
+def test_last_page_has_only_a_prev_cursor():
+    page = make_page(_rows(2, 1), KEYS, 2, NEXT)
+    assert page.next_cursor is None
+    assert decode_cursor(page.prev_cursor) == (PREV, ["2024-01-02", 2])
+
+
+def test_prev_page_is_put_back_in_order():
+    # PREVは古い順に取得している
+    page = make_page(_rows(6, 7, 8), KEYS, 2, PREV)
+    assert [row["id"] for row in page.items] == [7, 6]
+    assert decode_cursor(page.next_cursor) == (NEXT, ["2024-01-06", 6])
+    assert decode_cursor(page.prev_cursor) == (PREV, ["2024-01-07", 7])
+
+
+def test_empty_page_has_no_cursors():
+    assert make_page([], KEYS, 2, NEXT) == ([], None, None)
+
+
+def test_fetch_page_runs_the_page_query(fake_db, config):
+    fake_db.on("SELECT * FROM articles", rows=_rows(3, 2, 1))
+    cursor = encode_cursor(NEXT, ["2024-01-04", 4])
+    page = AbstractModel(config).fetch_page("SELECT * FROM articles", [], [], KEYS, cursor, limit=2)
+    sql, args, _ = fake_db.statements[0]
+    assert "articles.created_at < %s" in sql
+    assert args == ("2024-01-04", "2024-01-04", 4, 3)
+    assert [row["id"] for row in page.items] == [3, 2]
+    assert page.next_cursor is not None and page.prev_cursor is not None
@@ -0,0 +1,162 @@
+"""
+MySQLのコネクションプール
+pymysql.connectを偽の接続を返すものに差し替えて，接続の貸し借りだけを確かめる
+"""
+import threading
+
+import pymysql
+import pytest
+
+from app.errors import ConnectionPoolExhausted
+from app.models import pool as pool_module
+from app.models.pool import ConnectionPool, get_pool
+
+
+class Connection(object):
+    def __init__(self, ping_error: bool = False):
+        self.open = True
+        self.pings = 0
+        self.ping_error = ping_error
+
+    def ping(self, reconnect=False):
+        self.pings += 1
+        if self.ping_error:
+            raise pymysql.err.OperationalError(2006, "MySQL server has gone away")
+
+    def close(self):
+        self.open = False
+
+
+@pytest.fixture
+def connections(monkeypatch):
+    created = []
+
+    def connect(**kwargs):
+        created.append(Connection())
+        return created[-1]
+    monkeypatch.setattr(pool_module.pymysql, "connect", connect)
+    return created
+
+
+def _pool(config, **settings):
+    settings = dict({"mysql_pool_min_size": 0, "mysql_pool_max_size": 2, "mysql_pool_timeout": 0.05,
+                     "mysql_pool_idle_timeout": 300, "mysql_pool_ping_interval": 30}, **settings)
+    for name, value in settings.items():
+        setattr(config, name, value)
+    return ConnectionPool(config)
+
+
+def test_connections_are_reused(connections, config):
+    pool = _pool(config)
+    with pool.connection() as first:
+        pass
+    with pool.connection() as second:
+        assert second is first
+    assert len(connections) == 1
+    stats = pool.stats()
+    assert stats["checkouts"] == 2 and stats["size"] == 1 and stats["idle"] == 1 and stats["in_use"] == 0
+
+
+def test_min_size_connections_are_opened_up_front(connections, config):
+    pool = _pool(config, mysql_pool_min_size=2)
+    assert len(connections) == 2
+    assert pool.stats()["idle"] == 2
+
+
+def test_checkout_times_out_when_exhausted(connections, config):
+    pool = _pool(config, mysql_pool_max_size=1)
+    pool.checkout()
+    with pytest.raises(ConnectionPoolExhausted):
+        pool.checkout()
+    assert pool.stats()["timeouts"] == 1
+
+
+def test_waiting_checkout_gets_the_returned_connection(connections, config):
+    pool = _pool(config, mysql_pool_max_size=1, mysql_pool_timeout=5)
+    connection = pool.checkout()
+    timer = threading.Timer(0.05, pool.checkin, (connection,))
+    timer.start()
+    assert pool.checkout() is connection
+    timer.join()
+    assert pool.stats()["wait_time_max"] > 0
+
+
+def test_counters_add_up_under_concurrent_checkouts(connections, config):
+    pool = _pool(config, mysql_pool_max_size=8, mysql_pool_timeout=5)
+
+    def borrow():
+        for _ in range(50):
+            connection = pool.checkout()
+            pool.checkin(connection, discard=True)
+    threads = [threading.Thread(target=borrow) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    stats = pool.stats()
+    assert stats["created"] == stats["closed"] == len(connections) == 400
+    assert stats["checkouts"] == 400 and stats["size"] == 0
+
+
+def test_operational_errors_discard_the_connection(connections, config):
+    pool = _pool(config)
+    with pytest.raises(pymysql.err.OperationalError):
+        with pool.connection():
+            raise pymysql.err.OperationalError(2013, "Lost connection")
+    assert not connections[0].open
+    assert pool.stats()["size"] == 0
+    with pool.connection() as connection:
+        assert connection is connections[1]
+
+
+def test_other_errors_return_the_connection_to_the_pool(connections, config):
+    pool = _pool(config)
+    # SQLの誤りや制約違反では接続は壊れていないので，閉じずに使い回す
+    with pytest.raises(pymysql.err.IntegrityError):
+        with pool.connection():
+            raise pymysql.err.IntegrityError(1062, "Duplicate entry")
+    assert connections[0].open
+    assert pool.stats()["idle"] == 1 and pool.stats()["in_use"] == 0
+    with pool.connection() as connection:
+        assert connection is connections[0]
+
+
+def test_stale_connection_is_pinged_and_replaced_when_dead(connections, config):
+    pool = _pool(config, mysql_pool_ping_interval=-1)
+    connection = pool.checkout()
+    connection.ping_error = True
+    pool.checkin(connection)
+    assert pool.checkout() is connections[1]
+    assert connection.pings == 1 and not connection.open
+    assert pool.stats()["health_check_failures"] == 1
+
+
+def test_idle_connections_above_min_size_are_reaped(connections, config):
+    pool = _pool(config, mysql_pool_min_size=1, mysql_pool_idle_timeout=0)
+    first, second = pool.checkout(), pool.checkout()
+    pool.checkin(first)
+    pool.checkin(second)
+    # min_sizeの１つだけ残す
+    assert pool.stats()["size"] == 1
+    assert not first.open and second.open
+
+
+def test_failed_connect_frees_the_slot(monkeypatch, config):
+    def connect(**kwargs):
+        raise pymysql.err.OperationalError(2003, "Can't connect")
+    monkeypatch.setattr(pool_module.pymysql, "connect", connect)
+    pool = _pool(config, mysql_pool_max_size=1)
+    for _ in range(2):
+        with pytest.raises(pymysql.err.OperationalError):
+            pool.checkout()
+    assert pool.stats()["size"] == 0
+
+
+def test_get_pool_returns_one_pool_per_database(connections, monkeypatch, config):
+    monkeypatch.setattr(pool_module, "_pools", {})
+    config.mysql_pool_min_size = 0
+    assert get_pool(config) is get_pool(config)
+    config.mysql_database = "other"
+    assert len(pool_module._pools) == 1
+    get_pool(config)
+    assert len(pool_module._pools) == 2
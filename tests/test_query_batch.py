@@ -0,0 +1,45 @@
+"""
+ページのクエリの並行実行(QueryBatch, gather_queries)
+"""
+import asyncio
+
+import pytest
+
+from app.utilities import query_batch
+from app.utilities.query_batch import QueryBatch, gather_queries, timing_stats
+
+
+@pytest.fixture(autouse=True)
+def timings(monkeypatch):
+    monkeypatch.setattr(query_batch, "_timings", {})
+
+
+async def _query(value, delay=0.05):
+    await asyncio.sleep(delay)
+    return value
+
+
+def test_queries_run_concurrently_and_keep_their_keys():
+    results = asyncio.run(gather_queries("page", user=_query("alice"), articles=_query([1, 2]), count=_query(3)))
+    assert results == {"user": "alice", "articles": [1, 2], "count": 3}
+    stats = timing_stats()["page"]
+    assert stats["batches"] == 1
+    # 逐次なら3つ分かかるところを，1つ分ほどで終わる
+    assert stats["sequential_avg_ms"] >= 150 and stats["concurrent_avg_ms"] < 120
+
+
+def test_batch_records_each_query_time():
+    batch = QueryBatch("page")
+    batch.add("fast", _query(1, 0))
+    batch.add("slow", _query(2, 0.05))
+    assert asyncio.run(batch.run()) == {"fast": 1, "slow": 2}
+    assert batch.timings["slow"] >= 0.05 > batch.timings["fast"]
+    assert 0.05 <= batch.elapsed < 0.1
+
+
+def test_a_failing_query_fails_the_batch():
+    async def broken():
+        raise LookupError("no such table")
+
+    with pytest.raises(LookupError):
+        asyncio.run(gather_queries("page", user=_query("alice", 0), broken=broken()))
@@ -0,0 +1,63 @@
+"""
+クラブ，リーグ，国の一覧(ReferenceRegistry)
+"""
+import time
+
+import pytest
+
+from app.utilities.reference import ReferenceRegistry
+
+
+class Model(object):
+    def __init__(self):
+        self.loads = 0
+
+    def clubs_list(self):
+        self.loads += 1
+        return [{"id": 1, "clubs": "Arsenal"}, {"id": 2, "clubs": "Liverpool"}]
+
+    def leagues_list(self):
+        return [{"id": 1, "leagues": "プレミアリーグ", "english_name": "Premier League"}]
+
+    def nations_list(self):
+        return [{"id": 1, "nations": "Japan"}]
+
+
+def test_tables_are_read_once_and_shared():
+    model = Model()
+    registry = ReferenceRegistry(0)
+    data = registry.get(model)
+    assert registry.get(model) is data
+    assert model.loads == 1
+    assert registry.stats() == {"loads": 1, "hits": 1, "clubs": 2, "leagues": 1, "nations": 1}
+    assert [club["clubs"] for club in data.clubs] == ["Arsenal", "Liverpool"]
+
+
+def test_lookups_by_name_and_value():
+    data = ReferenceRegistry(0).get(Model())
+    assert data.is_club("Arsenal") and not data.is_club("Chelsea") and not data.is_club(None)
+    # リーグは表示名ではなく，フォームの値(english_name)で確かめる
+    assert data.is_league("Premier League") and not data.is_league("プレミアリーグ")
+    assert data.is_nation("Japan")
+    assert data.clubs.get("id", 2)["clubs"] == "Liverpool"
+    assert data.clubs.get("unknown_column", 1) is None
+
+
+def test_rows_are_read_only():
+    data = ReferenceRegistry(0).get(Model())
+    with pytest.raises(TypeError):
+        data.clubs.rows[0]["clubs"] = "Chelsea"
+
+
+def test_tables_are_read_again_after_ttl_or_reload(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr(time, "monotonic", lambda: now[0])
+    model = Model()
+    registry = ReferenceRegistry(60)
+    first = registry.get(model)
+    now[0] += 30
+    assert registry.get(model) is first
+    now[0] += 31
+    assert registry.get(model) is not first
+    registry.reload(model)
+    assert model.loads == 3
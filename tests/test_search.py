@@ -0,0 +1,72 @@
+"""
+検索(FULLTEXTのngram検索，短い検索語の前方一致，関連度順のカーソル)
+"""
+import os
+
+import pymysql
+import pytest
+
+from app.models.pagination import NEXT, decode_cursor, encode_cursor
+from app.models.search import PREFIX_INDEX_LENGTH, PRIMARY_KEY_COLUMNS, SEARCH_TARGETS, SearchModel
+
+MIGRATIONS_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "migrations")
+
+
+def test_long_query_uses_fulltext_phrase_search(fake_db, config):
+    fake_db.on("AGAINST", rows=[{"id": 3, "score": 2.5}, {"id": 1, "score": 1.0}])
+    page = SearchModel(config).search("article", "title", 'サッカー"', limit=1)
+    sql, args, _ = fake_db.statements[0]
+    assert "MATCH(articles.title) AGAINST (%s IN BOOLEAN MODE) AS score" in sql
+    assert "LIKE" not in sql
+    assert sql.endswith("ORDER BY score DESC, articles.id DESC LIMIT %s")
+    # "は取り除いてフレーズにする
+    assert args == ('"サッカー"', '"サッカー"', 2)
+    assert [row["id"] for row in page.items] == [3]
+    assert decode_cursor(page.next_cursor) == (NEXT, [2.5, 3])
+    assert page.prev_cursor is None
+
+
+def test_fulltext_cursor_continues_after_the_last_score(fake_db, config):
+    cursor = encode_cursor(NEXT, [2.5, 3])
+    page = SearchModel(config).search("article", "title", "サッカー", limit=1, cursor=cursor)
+    sql, args, _ = fake_db.statements[0]
+    assert "OR (MATCH(articles.title) AGAINST (%s IN BOOLEAN MODE) = %s AND articles.id < %s)" in sql
+    assert args[-6:] == ('"サッカー"', 2.5, '"サッカー"', 2.5, 3, 2)
+    assert page.items == [] and page.next_cursor is None
+
+
+def test_short_query_uses_escaped_prefix_match(fake_db, config):
+    SearchModel(config).search("user", "id", "%")
+    sql, args, _ = fake_db.statements[0]
+    assert "profile.username LIKE %s" in sql
+    assert args[0] == "\\%%"
+
+
+def test_empty_query_lists_newest_first_within_scope(fake_db, config):
+    SearchModel(config).search("discussion", "title", None, limit=10, scope="pub1")
+    sql, args, _ = fake_db.statements[0]
+    assert "WHERE message.pub_id = %s ORDER BY message.created_at DESC, message.id DESC" in sql
+    assert args == ("pub1", 11)
+
+
+def test_create_indexes_ignores_existing_indexes(fake_db, config):
+    fake_db.on("ft_articles_title", error=pymysql.err.OperationalError(1061, "Duplicate key name"))
+    SearchModel(config).create_indexes()
+    columns = {target.column for target in SEARCH_TARGETS.values()}
+    # 既にあった１つで止まらずに，全ての列に作る
+    assert len(fake_db.executed("ADD FULLTEXT INDEX")) == len(columns)
+    # 前方一致用のインデックスは主キーの列以外に作る
+    assert len(fake_db.executed("_prefix ON")) == len(columns - PRIMARY_KEY_COLUMNS)
+    assert fake_db.executed("ix_articles_body_prefix")[0][0].endswith("(body(%d))" % PREFIX_INDEX_LENGTH)
+
+
+def test_search_migration_matches_create_indexes():
+    with open(os.path.join(MIGRATIONS_DIR, "0001_search_indexes.sql"), encoding="utf-8") as f:
+        lines = [line.rstrip(";") for line in f.read().splitlines() if line and not line.startswith("--")]
+    assert lines == SearchModel.index_statements()
+
+
+def test_create_indexes_raises_other_errors(fake_db, config):
+    fake_db.on("ft_articles_title", error=pymysql.err.OperationalError(1146, "Table doesn't exist"))
+    with pytest.raises(pymysql.err.OperationalError):
+        SearchModel(config).create_indexes()
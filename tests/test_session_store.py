@@ -0,0 +1,142 @@
+"""
+セッションストア(memory, sqlite, file)の期限切れ・上限・掃除
+"""
+import sqlite3
+
+import pytest
+
+from app.utilities import session_store
+from app.utilities.session_store import FileSystemSessionStore, MemorySessionStore, SqliteSessionStore, \
+    create_session_store
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    class Clock(object):
+        now = 1000000.0
+
+        def time(self):
+            return self.now
+
+    clock = Clock()
+    monkeypatch.setattr(session_store.time, "time", clock.time)
+    return clock
+
+
+@pytest.fixture
+def sqlite_store(tmp_path):
+    return SqliteSessionStore(str(tmp_path / "sessions" / "sessions.sqlite3"), max_entries=3)
+
+
+@pytest.mark.parametrize("backend", ["memory", "sqlite", "file"])
+def test_set_get_delete(backend, tmp_path, config):
+    config.session_backend = backend
+    config.session_cache_dir = str(tmp_path)
+    store = create_session_store(config)
+    store.set("a", {"user": {"username": "alice"}}, 60)
+    assert store.get("a") == {"user": {"username": "alice"}}
+    store.set("a", {"user": None}, 60)
+    assert store.get("a") == {"user": None}
+    store.delete("a")
+    assert store.get("a") is None
+    assert store.get("missing") is None
+
+
+@pytest.mark.parametrize("backend", ["memory", "sqlite"])
+def test_expired_sessions_are_not_returned(backend, tmp_path, config, clock):
+    config.session_backend = backend
+    config.session_cache_dir = str(tmp_path)
+    store = create_session_store(config)
+    store.set("a", {}, 10)
+    clock.now += 11
+    assert store.get("a") is None
+
+
+def test_unknown_backend_is_rejected(config):
+    config.session_backend = "redis"
+    with pytest.raises(ValueError):
+        create_session_store(config)
+
+
+def test_memory_store_evicts_least_recently_used(clock):
+    store = MemorySessionStore(max_entries=2)
+    store.set("a", {}, 60)
+    store.set("b", {}, 60)
+    store.get("a")
+    store.set("c", {}, 60)
+    assert store.get("b") is None
+    assert store.get("a") == {} and store.get("c") == {}
+    assert store.stats()["evicted"] == 1
+
+
+def test_memory_store_expires_and_sweeps(clock):
+    store = MemorySessionStore(max_entries=10)
+    store.set("a", {}, 10)
+    store.set("b", {}, 100)
+    clock.now += 50
+    assert store.sweep(10) == 1
+    assert store.stats() == {"live": 1, "expired": 1, "evicted": 0}
+
+
+def test_sqlite_store_enforces_the_cap_on_set_by_last_use(sqlite_store, clock):
+    for session_id in ("a", "b", "c"):
+        sqlite_store.set(session_id, {}, 3600)
+        clock.now += session_store.SQLITE_TOUCH_INTERVAL + 1
+    # aは一番古く書き込まれたが，最近読まれたので残る
+    assert sqlite_store.get("a") == {}
+    clock.now += 1
+    sqlite_store.set("d", {}, 3600)
+    assert sqlite_store.get("b") is None
+    assert [sqlite_store.get(session_id) for session_id in ("a", "c", "d")] == [{}, {}, {}]
+    assert sqlite_store.stats() == {"live": 3, "expired": 0, "evicted": 1}
+
+
+def test_sqlite_store_updating_a_session_does_not_evict(sqlite_store, clock):
+    for session_id in ("a", "b", "c"):
+        sqlite_store.set(session_id, {}, 3600)
+    sqlite_store.set("a", {"user": "alice"}, 3600)
+    assert sqlite_store.stats()["evicted"] == 0
+    assert sqlite_store.get("a") == {"user": "alice"}
+
+
+def test_sqlite_store_reads_do_not_write_within_the_touch_interval(sqlite_store, clock):
+    sqlite_store.set("a", {}, 3600)
+    connection = sqlite_store._connection()
+    before = connection.total_changes
+    clock.now += 1
+    sqlite_store.get("a")
+    assert connection.total_changes == before
+    clock.now += session_store.SQLITE_TOUCH_INTERVAL
+    sqlite_store.get("a")
+    assert connection.total_changes == before + 1
+
+
+def test_sqlite_store_sweeps_expired_sessions(sqlite_store, clock):
+    sqlite_store.set("a", {}, 10)
+    sqlite_store.set("b", {}, 100)
+    clock.now += 50
+    assert sqlite_store.get("a") is None
+    assert sqlite_store.sweep(10) == 1
+    assert sqlite_store.stats() == {"live": 1, "expired": 1, "evicted": 0}
+
+
+def test_sqlite_store_upgrades_a_file_without_last_access(tmp_path, clock):
+    path = str(tmp_path / "sessions.sqlite3")
+    connection = sqlite3.connect(path)
+    connection.execute("CREATE TABLE sessions (id TEXT PRIMARY KEY, data BLOB NOT NULL, expires_at REAL NOT NULL)")
+    connection.commit()
+    connection.close()
+    store = SqliteSessionStore(path, max_entries=10)
+    store.set("a", {"user": None}, 60)
+    assert store.get("a") == {"user": None}
+
+
+def test_file_store_counts_sessions_without_listing_the_directory(tmp_path, monkeypatch):
+    store = FileSystemSessionStore(str(tmp_path), max_entries=5)
+    monkeypatch.setattr(session_store.os, "listdir", None)
+    store.set("a", {}, 60)
+    store.set("a", {"user": None}, 60)
+    store.set("b", {}, 60)
+    store.delete("b")
+    store.delete("missing")
+    assert store.stats() == {"live": 1, "expired": 0, "evicted": 0, "created": 2, "deleted": 1}
@@ -0,0 +1,51 @@
+"""
+ストリーミングで描画するページ(stream_page)が，送っている間プールの接続を借りたままにしないか
+"""
+import asyncio
+
+from starlette.requests import Request
+
+from app.models.abstract import AbstractModel
+from app.models.pagination import NEXT, decode_cursor
+from app.models.search import SearchModel
+from app.utilities.templates import AppTemplates
+
+
+def _rows(count):
+    return [{"id": count - i, "title": "t%d" % (count - i)} for i in range(count)]
+
+
+def test_stream_page_returns_the_connection_before_rendering(fake_db, config):
+    fake_db.on("SELECT * FROM message", rows=_rows(3))
+    page = AbstractModel(config).stream_page("SELECT * FROM message", [], [], ("id",), limit=2)
+    # 行を読む前に，接続はプールに返っている
+    assert fake_db.checkouts == 1 and fake_db.in_use == 0
+    assert [row["id"] for row in page] == [3, 2]
+    direction, position = decode_cursor(page.next_cursor)
+    assert direction == NEXT and position == [2]
+    assert fake_db.checkouts == 1
+
+
+def test_search_stream_returns_the_connection_before_rendering(fake_db, config):
+    fake_db.on("AGAINST", rows=[{"id": 1, "score": 2.0}, {"id": 2, "score": 1.0}])
+    page = SearchModel(config).search("article", "title", "keyword", limit=1, stream=True)
+    assert fake_db.in_use == 0
+    assert [row["id"] for row in page] == [1]
+    assert page.next_cursor is not None
+
+
+def test_streaming_template_response_renders_a_page_stream(tmp_path, fake_db, config):
+    (tmp_path / "list.html").write_text(
+        "{% for row in rows %}<li>{{ row.title }}</li>{% endfor %}{{ page.next_cursor is not none }}")
+    templates = AppTemplates(str(tmp_path))
+    fake_db.on("SELECT * FROM message", rows=_rows(3))
+    page = AbstractModel(config).stream_page("SELECT * FROM message", [], [], ("id",), limit=2)
+    request = Request({"type": "http", "method": "GET", "path": "/", "headers": []})
+    response = templates.StreamingTemplateResponse("list.html", {"request": request, "rows": page, "page": page})
+
+    async def read():
+        return "".join([chunk async for chunk in response.body_iterator])
+
+    assert asyncio.run(read()) == "<li>t3</li><li>t2</li>True"
+    assert fake_db.in_use == 0
+    assert templates.stats()["renders"]["list.html"]["count"] == 1
@@ -0,0 +1,49 @@
+"""
+テンプレートの起動時のコンパイルと，ディスクのバイトコードキャッシュ(AppTemplates)
+"""
+import os
+
+import pytest
+
+from app.utilities.templates import AppTemplates
+
+
+@pytest.fixture
+def template_dir(tmp_path):
+    directory = tmp_path / "templates"
+    directory.mkdir()
+    (directory / "base.html").write_text("<h1>{% block title %}{% endblock %}</h1>", encoding="utf-8")
+    (directory / "page.html").write_text('{% extends "base.html" %}{% block title %}{{ title }}{% endblock %}',
+                                         encoding="utf-8")
+    return str(directory)
+
+
+def test_prewarm_compiles_every_template_and_writes_bytecode(template_dir, tmp_path):
+    cache_dir = str(tmp_path / "bytecode")
+    templates = AppTemplates(template_dir, cache_dir)
+    result = templates.prewarm()
+    assert result["templates"] == 2
+    assert templates.env.cache.capacity >= 4
+    assert len(os.listdir(cache_dir)) == 2
+    assert templates.version != "0"
+
+
+def test_next_worker_loads_bytecode_without_compiling(template_dir, tmp_path, monkeypatch):
+    cache_dir = str(tmp_path / "bytecode")
+    AppTemplates(template_dir, cache_dir).prewarm()
+    templates = AppTemplates(template_dir, cache_dir)
+
+    def compile(*args, **kwargs):
+        raise AssertionError("compiled again")
+    monkeypatch.setattr(templates.env, "compile", compile)
+    templates.prewarm()
+    assert templates.env.get_template("page.html").render(title="hi") == "<h1>hi</h1>"
+
+
+def test_renders_are_counted_per_template(template_dir):
+    templates = AppTemplates(template_dir)
+    for _ in range(2):
+        response = templates.TemplateResponse("page.html", {"request": object(), "title": "hi"})
+    assert response.body == b"<h1>hi</h1>"
+    renders = templates.stats()["renders"]
+    assert renders["page.html"]["count"] == 2 and renders["page.html"]["max"] >= renders["page.html"]["avg"]
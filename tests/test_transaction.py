@@ -0,0 +1,163 @@
+"""
+AbstractModel.transactionと，それを使うユーザ登録・Pubの作成
+"""
+import asyncio
+from contextlib import asynccontextmanager
+
+import pymysql
+import pytest
+from pymysql.constants import ER
+
+from app.models import async_abstract
+from app.models.abstract import AbstractModel
+from app.models.async_abstract import AsyncAbstractModel
+from app.models.auth import AsyncAuthModel, AuthModel
+from app.models.versions import BUMP_SQL, VersionModel, pub_key, user_key
+
+
+def _duplicate():
+    return pymysql.err.IntegrityError(ER.DUP_ENTRY, "Duplicate entry")
+
+
+def test_transaction_commits_on_one_connection(fake_db, config):
+    fake_db.on("INSERT INTO articles", lastrowid=5)
+    model = AbstractModel(config)
+    with model.transaction():
+        assert model.execute("INSERT INTO articles(title) VALUE (%s)", "t") == 5
+        # 他のモデルや入れ子のtransactionも同じトランザクションに入る
+        with VersionModel(config).transaction():
+            VersionModel(config).bump(user_key("alice"))
+    assert fake_db.sql() == ["BEGIN", "INSERT INTO articles(title) VALUE (%s)", BUMP_SQL, "COMMIT"]
+    assert fake_db.checkouts == 1
+
+
+def test_transaction_rolls_back_on_error(fake_db, config):
+    model = AbstractModel(config)
+    with pytest.raises(ValueError):
+        with model.transaction():
+            model.execute("DELETE FROM follow")
+            raise ValueError()
+    assert fake_db.sql() == ["BEGIN", "DELETE FROM follow", "ROLLBACK"]
+    # 抜けた後は元通りSQLごとに接続を借りる
+    model.execute("SELECT 1")
+    assert fake_db.sql()[-1] == "SELECT 1"
+    assert fake_db.checkouts == 2
+
+
+class AsyncCursor(object):
+    def __init__(self, db):
+        self.db = db
+        self.lastrowid = 0
+        self.rowcount = 0
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        return False
+
+    async def execute(self, sql, args=()):
+        self.db.record(sql, tuple(args or ()))
+        _, self.rowcount, self.lastrowid = self.db.respond(sql, tuple(args or ()))
+
+    async def executemany(self, sql, rows):
+        self.db.record(sql, [tuple(row) for row in rows], many=True)
+
+
+class AsyncConnection(object):
+    def __init__(self, db):
+        self.db = db
+
+    def cursor(self, cursor_class=None):
+        return AsyncCursor(self.db)
+
+    async def begin(self):
+        self.db.record("BEGIN", ())
+
+    async def commit(self):
+        self.db.record("COMMIT", ())
+
+    async def rollback(self):
+        self.db.record("ROLLBACK", ())
+
+
+@pytest.fixture
+def async_db(fake_db, monkeypatch):
+    """
+    AsyncAbstractModelのaiomysqlのプールも，fake_dbに記録するものに差し替える
+    """
+    class Pool(object):
+        @asynccontextmanager
+        async def acquire(self):
+            fake_db.checkouts += 1
+            yield AsyncConnection(fake_db)
+
+    pool = Pool()
+
+    async def get_async_pool(config):
+        return pool
+    monkeypatch.setattr(async_abstract, "get_async_pool", get_async_pool)
+    return fake_db
+
+
+def test_async_transaction_rolls_back_on_error(async_db, config):
+    model = AsyncAbstractModel(config)
+
+    async def run():
+        async with model.transaction():
+            await model.execute("DELETE FROM follow")
+            async with model.transaction():
+                await model.execute("DELETE FROM followpub")
+            raise ValueError()
+
+    with pytest.raises(ValueError):
+        asyncio.run(run())
+    assert async_db.sql() == ["BEGIN", "DELETE FROM follow", "DELETE FROM followpub", "ROLLBACK"]
+    assert async_db.checkouts == 1
+
+
+def test_register_creates_user_and_profile_in_one_commit(fake_db, config):
+    fake_db.on("SELECT * FROM users", rows=[{"username": "alice"}])
+    user = AuthModel(config).register("alice", "password")
+    assert user == {"username": "alice"}
+    sql = fake_db.sql()
+    assert sql[0] == "BEGIN" and sql[-1] == "COMMIT"
+    assert sql.count("BEGIN") == 1
+    assert fake_db.executed("INSERT INTO profile")[0][1] == ("alice",)
+    bumped = fake_db.executed(BUMP_SQL)[0][1]
+    assert set(bumped) == {user_key("alice")}
+
+
+def test_register_duplicate_username_returns_none(fake_db, config):
+    fake_db.on("INSERT INTO users", error=_duplicate())
+    assert AuthModel(config).register("alice", "password") is None
+    assert fake_db.sql()[-1] == "ROLLBACK"
+    assert not fake_db.executed("INSERT INTO profile")
+
+
+def test_register_other_integrity_errors_are_raised(fake_db, config):
+    fake_db.on("INSERT INTO users", error=pymysql.err.IntegrityError(ER.BAD_NULL_ERROR, "cannot be null"))
+    with pytest.raises(pymysql.err.IntegrityError):
+        AuthModel(config).register("alice", "")
+
+
+def test_create_new_pub_inserts_and_bumps_in_one_commit(fake_db, config):
+    assert AuthModel(config).create_new_pub("pub1", "Pub", "comment", "alice") is True
+    sql = fake_db.sql()
+    assert sql[0] == "BEGIN" and sql[-1] == "COMMIT"
+    assert not fake_db.executed("SELECT * FROM pubs")
+    assert set(fake_db.executed(BUMP_SQL)[0][1]) == {pub_key("pub1"), user_key("alice")}
+
+
+def test_create_new_pub_duplicate_id_returns_false(fake_db, config):
+    fake_db.on("INSERT INTO pubs", error=_duplicate())
+    assert AuthModel(config).create_new_pub("pub1", "Pub", "comment", "alice") is False
+    assert fake_db.sql()[-1] == "ROLLBACK"
+    assert not fake_db.executed(BUMP_SQL)
+
+
+def test_async_create_new_pub_duplicate_id_rolls_back(async_db, config):
+    async_db.on("INSERT INTO pubs", error=_duplicate())
+    assert asyncio.run(AsyncAuthModel(config).create_new_pub("pub1", "Pub", "comment", "alice")) is False
+    assert async_db.sql()[-1] == "ROLLBACK"
+    assert not async_db.executed(BUMP_SQL)
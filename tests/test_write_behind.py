@@ -0,0 +1,218 @@
+"""
+write-behindのキュー(まとめて書き込む，read-your-writes，再試行，dead letter，停止時の保存)と，それが呼ぶモデルの書き込み
+"""
+import time
+
+import pymysql
+import pytest
+
+from app.errors import WriteBehindQueueFull
+from app.models.articles import ArticleModel
+from app.models.follow import FollowGraphModel
+from app.models.versions import BUMP_SQL, article_key
+from app.utilities.write_behind import WriteBehindQueue
+
+
+def _queue(tmp_path, **kwargs) -> WriteBehindQueue:
+    options = dict(enabled=True, batch_size=100, max_delay=60.0, max_pending=1000, max_backoff=60.0,
+                   spool_dir=str(tmp_path))
+    options.update(kwargs)
+    return WriteBehindQueue(**options)
+
+
+def _down():
+    return pymysql.err.OperationalError(2003, "Can't connect to MySQL server")
+
+
+class Writer(object):
+    """
+    fail回目まではerrorで失敗する．bad_rowsの行を含むバッチは重複で失敗する
+    """
+
+    def __init__(self, fail: int = 0, error: Exception = None, bad_rows=()):
+        self.batches = []
+        self.fail = fail
+        self.error = error or _down()
+        self.bad_rows = set(bad_rows)
+
+    def __call__(self, rows):
+        if self.fail:
+            self.fail -= 1
+            raise self.error
+        if self.bad_rows & set(rows):
+            raise pymysql.err.IntegrityError(1062, "Duplicate entry")
+        self.batches.append(rows)
+
+
+def _fill(queue, writer, rows, kind="comments"):
+    # スレッドが動いていないとaddがその場で書き込むので，溜めるだけにする
+    queue._thread = object()
+    try:
+        for user_name, row in rows:
+            queue.add(kind, writer, user_name, row)
+    finally:
+        queue._thread = None
+
+
+def test_flush_writes_each_kind_in_one_batch(tmp_path):
+    queue, writer = _queue(tmp_path), Writer()
+    _fill(queue, writer, [("alice", (1,)), ("bob", (2,)), ("alice", (3,))])
+    assert queue.stats()["pending"] == 3
+    assert queue.flush() is True
+    assert writer.batches == [[(1,), (2,), (3,)]]
+    stats = queue.stats()
+    assert stats["pending"] == 0 and stats["pending_users"] == 0
+    assert stats["rows_per_batch"] == 3.0
+
+
+def test_wait_for_flushes_only_when_the_user_has_pending_rows(tmp_path):
+    queue, writer = _queue(tmp_path), Writer()
+    _fill(queue, writer, [("alice", (1,))])
+    queue.wait_for("bob")
+    assert writer.batches == []
+    queue.wait_for("alice")
+    assert writer.batches == [[(1,)]]
+    assert queue.stats()["read_your_writes_flushes"] == 1
+
+
+def test_background_thread_writes_within_max_delay(tmp_path):
+    queue, writer = _queue(tmp_path, max_delay=0.01), Writer()
+    queue.start()
+    try:
+        queue.add("comments", writer, "alice", (1,))
+        deadline = time.monotonic() + 2
+        while not writer.batches and time.monotonic() < deadline:
+            time.sleep(0.01)
+    finally:
+        queue.stop()
+    assert writer.batches == [[(1,)]]
+
+
+def test_stop_writes_what_is_left(tmp_path):
+    queue, writer = _queue(tmp_path), Writer()
+    _fill(queue, writer, [("alice", (1,)), ("alice", (2,))])
+    queue.stop()
+    assert writer.batches == [[(1,), (2,)]]
+
+
+def test_failed_rows_are_retried_in_order(tmp_path):
+    queue, writer = _queue(tmp_path), Writer(fail=1)
+    _fill(queue, writer, [("alice", (1,))])
+    assert queue.flush() is False
+    _fill(queue, writer, [("alice", (2,))])
+    assert queue.stats()["failing"]["comments"]["failures"] == 1
+    assert queue.flush() is True
+    assert writer.batches == [[(1,), (2,)]]
+    assert queue.stats()["failing"] == {}
+
+
+def test_connection_errors_are_retried_until_written(tmp_path):
+    queue, writer = _queue(tmp_path, max_delay=0.1), Writer(fail=20)
+    _fill(queue, writer, [("alice", (1,))])
+    for _ in range(20):
+        assert queue.flush() is False
+    # 何回失敗しても捨てずに持ち続け，再試行の間隔は倍にしながらmax_backoffまで延ばす
+    stats = queue.stats()
+    assert stats["pending"] == 1 and stats["dead"] == 0
+    assert 0 < stats["retry_in"] <= 60.0
+    assert queue.flush() is True
+    assert writer.batches == [[(1,)]]
+    assert queue.stats()["retry_in"] == 0.0
+
+
+def test_wait_for_does_not_retry_while_backing_off(tmp_path):
+    queue, writer = _queue(tmp_path), Writer(fail=1)
+    _fill(queue, writer, [("alice", (1,))])
+    assert queue.flush() is False
+    queue.wait_for("alice")
+    assert queue.stats()["read_your_writes_flushes"] == 0
+    assert queue.stats()["pending"] == 1
+
+
+def test_bad_rows_are_dead_lettered_to_a_file(tmp_path, caplog):
+    queue, writer = _queue(tmp_path), Writer(bad_rows=[(2,)])
+    _fill(queue, writer, [("alice", (1,)), ("bob", (2,)), ("alice", (3,))])
+    assert queue.flush() is True
+    # 書ける行は１行ずつ書き直し，書けない行だけを残す
+    assert writer.batches == [[(1,)], [(3,)]]
+    stats = queue.stats()
+    assert stats["pending"] == 0 and stats["pending_users"] == 0 and stats["dead"] == 1
+    letters = queue.dead_letters()
+    assert [(letter["kind"], letter["user"], letter["row"]) for letter in letters] == [("comments", "bob", [2])]
+    assert "IntegrityError" in letters[0]["error"]
+    assert any(record.levelname == "ERROR" and "giving up" in record.getMessage() for record in caplog.records)
+    # ファイルなので，別のキュー(再起動した後のworker)からも読める
+    assert len(_queue(tmp_path).dead_letters()) == 1
+
+
+def test_connection_lost_while_writing_one_by_one_keeps_the_rest(tmp_path):
+    queue = _queue(tmp_path)
+    calls = []
+
+    def writer(rows):
+        calls.append(rows)
+        if len(calls) == 1:
+            raise pymysql.err.IntegrityError(1062, "Duplicate entry")
+        raise _down()
+    _fill(queue, writer, [("alice", (1,)), ("bob", (2,))])
+    assert queue.flush() is False
+    assert queue.stats()["pending"] == 2 and queue.stats()["dead"] == 0
+
+
+def test_stop_saves_unwritten_rows_and_start_restores_them(tmp_path):
+    queue, writer = _queue(tmp_path), Writer(fail=1)
+    _fill(queue, writer, [("alice", (1, "a")), ("bob", (2, "b"))])
+    queue.stop()
+    assert queue.stats()["spooled"] == 2 and queue.stats()["pending"] == 0
+    # 次に起動したworkerが読み込んで書き込む
+    restarted, rewriter = _queue(tmp_path, max_delay=0.01), Writer()
+    restarted.register("comments", rewriter)
+    restarted.start()
+    try:
+        deadline = time.monotonic() + 2
+        while not rewriter.batches and time.monotonic() < deadline:
+            time.sleep(0.01)
+    finally:
+        restarted.stop()
+    assert rewriter.batches == [[(1, "a"), (2, "b")]]
+    assert restarted.stats()["restored"] == 2
+    assert not list(tmp_path.glob("pending-*"))
+
+
+def test_spooled_rows_without_a_writer_are_dead_lettered(tmp_path):
+    queue, writer = _queue(tmp_path), Writer(fail=1)
+    _fill(queue, writer, [("alice", (1,))], kind="followpub")
+    queue.stop()
+    restarted = _queue(tmp_path)
+    restarted.start()
+    restarted.stop()
+    assert [letter["kind"] for letter in restarted.dead_letters()] == ["followpub"]
+    assert restarted.stats()["pending"] == 0
+
+
+def test_add_raises_when_full_and_cannot_be_written(tmp_path):
+    queue, writer = _queue(tmp_path, max_pending=1), Writer(fail=1)
+    _fill(queue, writer, [("alice", (1,))])
+    with pytest.raises(WriteBehindQueueFull):
+        queue.add("comments", writer, "alice", (2,))
+    # 書き込めるようになれば，そのリクエストの中で書き込んでから積む
+    queue.add("comments", writer, "alice", (3,))
+    assert writer.batches == [[(1,)], [(3,)]]
+
+
+def test_insert_comments_bumps_articles_in_one_transaction(fake_db, config):
+    ArticleModel(config).insert_comments([("alice", 1, "a"), ("bob", 2, "b"), ("carol", 1, "c")])
+    sql = fake_db.sql()
+    assert sql[0] == "BEGIN" and sql[-1] == "COMMIT"
+    insert = fake_db.executed("INSERT INTO comments")[0]
+    assert insert[2] and len(insert[1]) == 3
+    assert set(fake_db.executed(BUMP_SQL)[0][1]) == {article_key(1), article_key(2)}
+
+
+def test_insert_follows_skips_existing_and_duplicates(fake_db, config):
+    fake_db.on("SELECT id FROM follow", rows=[{"id": "alice--bob"}])
+    rows = [("bob", "alice", "alice--bob"), ("carol", "alice", "alice--carol"), ("carol", "alice", "alice--carol")]
+    assert FollowGraphModel(config).insert_follows(rows) == 1
+    insert = fake_db.executed("INSERT IGNORE INTO follow")[0]
+    assert insert[1] == [("carol", "alice", "alice--carol")]
+    assert fake_db.sql()[-1] == "COMMIT"
@@ -0,0 +1,47 @@
+"""
+記事・コメント・プロフィールの書き込みが，SQLを実行した後に版(entity_versions)まで上げられるか
+"""
+from app.models.articles import ArticleModel
+from app.models.auth import AuthModel
+from app.models.versions import BUMP_ARTICLE_AUTHOR_SQL, BUMP_SQL, article_key, user_key
+
+
+def _bumped(db):
+    keys = []
+    for _, rows, many in db.executed(BUMP_SQL):
+        keys.extend(rows if many else [rows])
+    return keys
+
+
+def test_create_article_bumps_article_and_author(fake_db, config):
+    fake_db.on("INSERT INTO articles", lastrowid=42)
+    article_id = ArticleModel(config).create_article("alice", "title", "body")
+    assert article_id == 42
+    assert fake_db.executed("INSERT INTO article_changes")[0][1] == (42,)
+    assert article_key(42) in _bumped(fake_db)
+    assert fake_db.executed(BUMP_ARTICLE_AUTHOR_SQL)[0][1] == (42,)
+
+
+def test_update_and_destroy_article_bump_versions(fake_db, config):
+    model = ArticleModel(config)
+    model.update_article("new title", "new body", 7)
+    model.destory_article(7)
+    assert _bumped(fake_db).count(article_key(7)) == 2
+
+
+def test_post_new_comment_bumps_article(fake_db, config):
+    ArticleModel(config).post_new_comment("alice", 7, "nice")
+    assert fake_db.executed("INSERT INTO comments")[0][1] == ("alice", 7, "nice")
+    assert article_key(7) in _bumped(fake_db)
+
+
+def test_add_profile_info_bumps_only_the_user(fake_db, config):
+    AuthModel(config).add_profile_info("alice")
+    assert fake_db.executed("INSERT INTO profile")[0][1] == ("alice",)
+    assert set(_bumped(fake_db)) == {user_key("alice")}
+
+
+def test_profile_update_bumps_only_the_user(fake_db, config):
+    AuthModel(config).profile_update("Alice", "Arsenal", "Premier League", "Japan", "hi", "-", "-", "-", "alice")
+    assert fake_db.executed("UPDATE profile")[0][1][-1] == "alice"
+    assert set(_bumped(fake_db)) == {user_key("alice")}
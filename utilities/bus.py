@@ -0,0 +1,297 @@
+"""
+チャットのメッセージを複数のworker/サーバに配るためのpub/sub
+    inprocess: 同じプロセス内だけで配る(worker１つの場合)
+    socket:    ブローカー(このファイルを python -m app.utilities.bus で起動)を経由して全workerに配る
+"""
+import argparse
+import asyncio
+import json
+import logging
+import time
+import uuid
+from collections import deque
+from typing import Callable, Deque, Dict, Optional, Set
+
+from app.configs import Config
+
+logger = logging.getLogger(__name__)
+
+# (ルーム名, メッセージ) を受け取ってローカルの接続に配る関数
+Handler = Callable[[str, dict], None]
+
+
+class MessageBus(object):
+    """
+    pub/subの共通インターフェース
+    publishしたメッセージは，そのルームをsubscribeしている全てのノードのhandlerに届く
+    """
+
+    def __init__(self):
+        self.handler: Optional[Handler] = None
+        self.node_id = uuid.uuid4().hex
+        self._stats = {"published": 0, "received": 0, "latency_total": 0.0, "latency_max": 0.0}
+
+    async def start(self, handler: Handler) -> None:
+        """
+        :param handler: 届いたメッセージを受け取る関数
+        """
+        self.handler = handler
+
+    async def stop(self) -> None:
+        pass
+
+    async def subscribe(self, room: str) -> None:
+        """
+        このノードでルームのメッセージを受け取るようにする．最初の接続がjoinした時に呼ぶ
+        """
+        pass
+
+    async def unsubscribe(self, room: str) -> None:
+        """
+        このノードでルームのメッセージを受け取らないようにする．最後の接続がleaveした時に呼ぶ
+        """
+        pass
+
+    async def publish(self, room: str, message: dict) -> None:
+        raise NotImplementedError
+
+    def _envelope(self, room: str, message: dict) -> dict:
+        self._stats["published"] += 1
+        return {"room": room, "message": message, "sent_at": time.time(), "origin": self.node_id}
+
+    def _dispatch(self, envelope: dict) -> None:
+        # ノード間の時計のずれがあると，socketの場合の遅延は多少不正確になる
+        latency = max(time.time() - envelope["sent_at"], 0.0)
+        self._stats["received"] += 1
+        self._stats["latency_total"] += latency
+        self._stats["latency_max"] = max(self._stats["latency_max"], latency)
+        if self.handler is not None:
+            self.handler(envelope["room"], envelope["message"])
+
+    def stats(self) -> Dict[str, float]:
+        """
+        :return: publish/受信した数と，publishから受信までの遅延(秒)
+        """
+        stats = dict(self._stats)
+        received = stats["received"]
+        stats["latency_avg"] = stats["latency_total"] / received if received else 0.0
+        return stats
+
+
+class InProcessBus(MessageBus):
+    """
+    同じプロセス内のhandlerにそのまま渡す
+    """
+
+    async def publish(self, room: str, message: dict) -> None:
+        self._dispatch(self._envelope(room, message))
+
+
+class SocketBus(MessageBus):
+    """
+    ブローカーにTCPでつなぎ，１行１つのJSONでやりとりする
+    ブローカーとの接続が切れた場合は再接続し，subscribe中のルームを登録し直す
+    切れている間のpublishは待たずにmax_buffered件まで溜めておき，つながったら送る
+    """
+
+    def __init__(self, host: str, port: int, max_buffered: int = 1000, send_timeout: float = 1.0):
+        """
+        :param max_buffered: 接続が切れている間に溜めておくpublishの数．超えたら古いものから捨てる
+        :param send_timeout: １通の送信を待つ秒数．超えたら接続を切ってつなぎ直す
+        """
+        super().__init__()
+        self.host = host
+        self.port = port
+        self.max_buffered = max_buffered
+        self.send_timeout = send_timeout
+        self.rooms: Set[str] = set()
+        self._writer: Optional[asyncio.StreamWriter] = None
+        self._connected = asyncio.Event()
+        self._reader_task: Optional[asyncio.Task] = None
+        self._buffered: Deque[dict] = deque()
+        self._stats.update({"buffered": 0, "dropped": 0})
+
+    async def start(self, handler: Handler) -> None:
+        await super().start(handler)
+        self._reader_task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._reader_task is not None:
+            self._reader_task.cancel()
+        if self._writer is not None:
+            self._writer.close()
+
+    async def _run(self) -> None:
+        backoff = 0.1
+        while True:
+            try:
+                reader, self._writer = await asyncio.open_connection(self.host, self.port)
+                for room in self.rooms:
+                    await self._send({"op": "subscribe", "room": room})
+                while self._buffered:
+                    await self._send({"op": "publish", "envelope": self._buffered[0]})
+                    self._buffered.popleft()
+                self._connected.set()
+                backoff = 0.1
+                while True:
+                    line = await reader.readline()
+                    if not line:
+                        break
+                    self._dispatch(json.loads(line))
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("chat bus connection to %s:%d failed", self.host, self.port)
+            self._disconnected()
+            await asyncio.sleep(backoff)
+            backoff = min(backoff * 2, 5.0)
+
+    def _disconnected(self) -> None:
+        self._connected.clear()
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+
+    async def _send(self, payload: dict) -> None:
+        writer = self._writer
+        writer.write(json.dumps(payload).encode() + b"\n")
+        try:
+            await asyncio.wait_for(writer.drain(), self.send_timeout)
+        except asyncio.TimeoutError:
+            # ブローカーが受け取らない．接続を切れば_runがつなぎ直す
+            logger.warning("chat bus %s:%d did not accept a message in %.1fs", self.host, self.port,
+                           self.send_timeout)
+            if writer is self._writer:
+                self._disconnected()
+            raise ConnectionError("chat bus send timed out")
+
+    async def subscribe(self, room: str) -> None:
+        self.rooms.add(room)
+        await self._send_if_connected({"op": "subscribe", "room": room})
+
+    async def unsubscribe(self, room: str) -> None:
+        self.rooms.discard(room)
+        await self._send_if_connected({"op": "unsubscribe", "room": room})
+
+    async def _send_if_connected(self, payload: dict) -> None:
+        # 送れなくても，つなぎ直した時にself.roomsから登録し直す
+        if not self._connected.is_set():
+            return
+        try:
+            await self._send(payload)
+        except (ConnectionError, OSError):
+            self._disconnected()
+
+    async def publish(self, room: str, message: dict) -> None:
+        envelope = self._envelope(room, message)
+        if self._connected.is_set():
+            try:
+                await self._send({"op": "publish", "envelope": envelope})
+                return
+            except (ConnectionError, OSError):
+                # 送れなかった分は溜めておき，つなぎ直した時に送る(ブローカーには届いていたら重複する)
+                self._disconnected()
+        self._buffer(envelope)
+
+    def _buffer(self, envelope: dict) -> None:
+        if len(self._buffered) >= self.max_buffered:
+            self._buffered.popleft()
+            self._stats["dropped"] += 1
+        self._buffered.append(envelope)
+        self._stats["buffered"] += 1
+
+    def stats(self) -> Dict[str, float]:
+        stats = super().stats()
+        stats["pending"] = len(self._buffered)
+        stats["connected"] = self._connected.is_set()
+        return stats
+
+
+class BusBroker(object):
+    """
+    SocketBusのブローカー
+    publishされたメッセージを，そのルームをsubscribeしている接続にだけ中継する
+    送り切れずにmax_subscriber_bufferバイト以上溜まったノードは切断する(ノードはつなぎ直して続きを受け取る)
+    """
+
+    def __init__(self, max_subscriber_buffer: int = 1024 * 1024):
+        """
+        :param max_subscriber_buffer: １つのノードに送り切れずに溜めておけるバイト数
+        """
+        self.max_subscriber_buffer = max_subscriber_buffer
+        self.subscribers: Dict[str, Set[asyncio.StreamWriter]] = {}
+        self.disconnected = 0
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        rooms: Set[str] = set()
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                payload = json.loads(line)
+                if payload["op"] == "subscribe":
+                    rooms.add(payload["room"])
+                    self.subscribers.setdefault(payload["room"], set()).add(writer)
+                elif payload["op"] == "unsubscribe":
+                    rooms.discard(payload["room"])
+                    self._remove(payload["room"], writer)
+                elif payload["op"] == "publish":
+                    self._relay(payload["envelope"])
+        finally:
+            for room in rooms:
+                self._remove(room, writer)
+            writer.close()
+
+    def _relay(self, envelope: dict) -> None:
+        line = json.dumps(envelope).encode() + b"\n"
+        for subscriber in list(self.subscribers.get(envelope["room"], ())):
+            # drainを待たないので，遅いノードがいても他のノードへの中継は止まらない
+            # その代わり，送り切れない分が上限を超えたノードは切断して，ブローカーのメモリが増え続けないようにする
+            if subscriber.transport.get_write_buffer_size() + len(line) > self.max_subscriber_buffer:
+                self._disconnect(subscriber)
+                continue
+            subscriber.write(line)
+
+    def _disconnect(self, writer: asyncio.StreamWriter) -> None:
+        logger.warning("disconnecting a slow chat bus subscriber %s", writer.get_extra_info("peername"))
+        self.disconnected += 1
+        for room in list(self.subscribers):
+            self._remove(room, writer)
+        # abortで送り切れていない分を捨てて切る．handleのreadlineが終わり後始末される
+        writer.transport.abort()
+
+    def _remove(self, room: str, writer: asyncio.StreamWriter) -> None:
+        subscribers = self.subscribers.get(room)
+        if subscribers is not None:
+            subscribers.discard(writer)
+            if not subscribers:
+                del self.subscribers[room]
+
+    async def serve(self, host: str, port: int) -> None:
+        server = await asyncio.start_server(self.handle, host, port)
+        async with server:
+            await server.serve_forever()
+
+
+def create_message_bus(config: Config) -> MessageBus:
+    """
+    設定に応じたpub/subを作る
+    :param config: アプリケーションの設定
+    :return: MessageBus
+    """
+    if config.chat_bus == "inprocess":
+        return InProcessBus()
+    if config.chat_bus == "socket":
+        return SocketBus(config.chat_bus_host, config.chat_bus_port, config.chat_bus_max_buffered,
+                         config.chat_bus_send_timeout)
+    raise ValueError("unknown chat bus: %s" % config.chat_bus)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="チャット用のpub/subブローカー")
+    parser.add_argument("--host", default=Config.chat_bus_host)
+    parser.add_argument("--port", type=int, default=Config.chat_bus_port)
+    parser.add_argument("--max-subscriber-buffer", type=int, default=Config.chat_bus_max_subscriber_buffer)
+    args = parser.parse_args()
+    asyncio.run(BusBroker(args.max_subscriber_buffer).serve(args.host, args.port))
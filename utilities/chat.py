@@ -0,0 +1,303 @@
+"""
+Pubごとのチャットルーム
+接続ごとに送信用のキューとタスクを持たせ，遅いクライアントがルーム全体の配信を止めないようにする
+メッセージはMessageBusを経由して配るので，別のworkerにつないでいるユーザにも届く
+直近のメッセージはルームごとのリングバッファに持ち，新しく入ってきた接続にすぐ送る
+"""
+import asyncio
+import logging
+from collections import deque
+from datetime import datetime
+from typing import Deque, Dict, List, Optional, Set
+
+from fastapi import WebSocket
+
+from app.configs import Config
+from app.models.chat import AsyncChatModel
+from app.utilities.bus import MessageBus, create_message_bus
+
+logger = logging.getLogger(__name__)
+
+# キューの詰まり方の方針
+# drop_oldest: 一番古い未送信のメッセージを捨てて新しいものを入れる
+# disconnect:  キューが一杯になったクライアントは切断する
+DROP_OLDEST = "drop_oldest"
+DISCONNECT = "disconnect"
+
+# WebSocketの切断コード(Policy Violation)．遅すぎるクライアントを切る時に使う
+SLOW_CONSUMER_CLOSE_CODE = 1008
+
+
+class ChatConnection(object):
+    """
+    １つのWebSocket接続
+    broadcastからはofferでキューに積むだけで，実際の送信はwriterタスクが行う
+    """
+
+    def __init__(self, websocket: WebSocket, queue_size: int, policy: str, send_timeout: float):
+        self.websocket = websocket
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=queue_size)
+        self.policy = policy
+        self.send_timeout = send_timeout
+        self.dropped = 0
+        self.closed = False
+        self._writer: Optional[asyncio.Task] = None
+
+    def start(self) -> None:
+        self._writer = asyncio.create_task(self._write_loop())
+
+    def offer(self, message: dict) -> bool:
+        """
+        送信するメッセージをキューに積む．待たずにすぐ戻る
+        :param message: 送信するメッセージ
+        :return: 積めたかどうか(disconnectの方針でキューが一杯ならFalse)
+        """
+        if self.closed:
+            return False
+        try:
+            self.queue.put_nowait(message)
+            return True
+        except asyncio.QueueFull:
+            if self.policy == DROP_OLDEST:
+                self.queue.get_nowait()
+                self.queue.put_nowait(message)
+                self.dropped += 1
+                return True
+            self.closed = True
+            asyncio.create_task(self.close(SLOW_CONSUMER_CLOSE_CODE))
+            return False
+
+    async def _write_loop(self) -> None:
+        try:
+            while True:
+                message = await self.queue.get()
+                # 送信が詰まったクライアントはそれ以上待たずに切断する
+                await asyncio.wait_for(self.websocket.send_json(message), self.send_timeout)
+        except asyncio.CancelledError:
+            raise
+        except asyncio.TimeoutError:
+            self.closed = True
+            await self.close(SLOW_CONSUMER_CLOSE_CODE)
+        except Exception:
+            # 切断済みの接続への送信など．受信側のループが後始末をする
+            self.closed = True
+
+    async def close(self, code: int = 1000) -> None:
+        self.closed = True
+        if self._writer is not None and self._writer is not asyncio.current_task():
+            self._writer.cancel()
+        try:
+            await self.websocket.close(code=code)
+        except Exception:
+            pass
+
+
+class ChatHistoryWriter(object):
+    """
+    チャットのメッセージをまとめてMySQLに保存する
+    batch_size件溜まるか，interval秒経つごとに１回の複数行INSERTで書き込む
+    """
+
+    def __init__(self, model: AsyncChatModel, batch_size: int, interval: float, max_pending: int):
+        self.model = model
+        self.batch_size = batch_size
+        self.interval = interval
+        self.max_pending = max_pending
+        self._pending: List[tuple] = []
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        self._stopping = False
+        self._stats = {"written": 0, "batches": 0, "failed": 0}
+
+    def start(self) -> None:
+        self._stopping = False
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        """
+        書き込み中の分はキャンセルせずに終わるのを待ち，残りを全て書き込む
+        """
+        if self._task is not None:
+            self._stopping = True
+            self._wakeup.set()
+            await self._task
+            self._task = None
+        await self.flush()
+
+    def add(self, pub_id: str, message: dict) -> None:
+        self._pending.append((pub_id, message.get("nickname"), message.get("message"), message["created_at"]))
+        if len(self._pending) >= self.batch_size:
+            self._wakeup.set()
+
+    async def _run(self) -> None:
+        while not self._stopping:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            if self._stopping:
+                # 残りはstopが書き込む
+                return
+            await self.flush()
+
+    async def flush(self) -> None:
+        rows, self._pending = self._pending, []
+        if not rows:
+            return
+        try:
+            await self.model.insert_messages(rows)
+            self._stats["written"] += len(rows)
+            self._stats["batches"] += 1
+        except asyncio.CancelledError:
+            # 書き込み中にキャンセルされても，行は捨てずに戻しておく
+            self._pending = rows + self._pending
+            raise
+        except Exception:
+            logger.exception("failed to persist %d chat messages", len(rows))
+            self._stats["failed"] += 1
+            # 次回にもう一度書き込む．DBが落ち続けていても溜めすぎないよう上限を超えた分は捨てる
+            self._pending = (rows + self._pending)[-self.max_pending:]
+
+    def stats(self) -> Dict[str, int]:
+        stats = dict(self._stats)
+        stats["pending"] = len(self._pending)
+        return stats
+
+
+class ChatHub(object):
+    """
+    pub_idごとにルームを持ち，同じルームの接続にだけメッセージを配信する
+    broadcastしたメッセージはbusを一周してから，各ノードのdeliverでローカルの接続に配られる
+    保存はbroadcastしたノードだけが行うので，workerが複数あっても重複しない
+    """
+
+    def __init__(self, config: Config, bus: Optional[MessageBus] = None):
+        self.queue_size = config.chat_queue_size
+        self.policy = config.chat_slow_consumer_policy
+        self.send_timeout = config.chat_send_timeout
+        self.bus = bus or create_message_bus(config)
+        self.history_size = config.chat_history_size
+        self.model = AsyncChatModel(config)
+        self.writer = ChatHistoryWriter(self.model, config.chat_persist_batch_size,
+                                        config.chat_persist_interval, config.chat_persist_max_pending)
+        self.rooms: Dict[str, Set[ChatConnection]] = {}
+        # このノードに接続があるルームの直近のメッセージ(古い順)
+        self.history: Dict[str, Deque[dict]] = {}
+        # 履歴を読み込み中のルーム．読み込み中に入ってきた接続はこれを待ってから履歴を受け取る
+        self._loading: Dict[str, asyncio.Future] = {}
+        self._stats = {"messages": 0, "deliveries": 0, "dropped": 0, "slow_disconnects": 0, "fanout_max": 0}
+
+    async def start(self) -> None:
+        await self.bus.start(self.deliver)
+        self.writer.start()
+
+    async def stop(self) -> None:
+        await self.bus.stop()
+        await self.writer.stop()
+
+    async def _load_history(self, room: str) -> None:
+        # ルームの最初の接続の時だけDBから読む．以降はdeliverでリングバッファが更新される
+        # 読んでいる間にdeliverで届いたメッセージは，読んだ履歴の後ろに残す
+        received = self.history.setdefault(room, deque(maxlen=self.history_size))
+        rows = await self.model.fetch_history(room, limit=self.history_size)
+        history = deque(
+            ({"nickname": row["nickname"], "message": row["message"], "created_at": str(row["created_at"])}
+             for row in reversed(rows)),
+            maxlen=self.history_size
+        )
+        history.extend(received)
+        self.history[room] = history
+
+    async def join(self, room: str, websocket: WebSocket) -> ChatConnection:
+        """
+        接続をルームに追加し，送信用のタスクを起動する
+        :param room: ルーム名(pub_id)
+        :param websocket: acceptしたWebSocket
+        :return: 追加した接続
+        """
+        connection = ChatConnection(websocket, self.queue_size, self.policy, self.send_timeout)
+        connection.start()
+        if room not in self.rooms:
+            self.rooms[room] = set()
+            loading = self._loading[room] = asyncio.get_running_loop().create_future()
+            try:
+                await self.bus.subscribe(room)
+                await self._load_history(room)
+            except Exception:
+                logger.exception("failed to load chat history of %s", room)
+                self.history.setdefault(room, deque(maxlen=self.history_size))
+            finally:
+                del self._loading[room]
+                loading.set_result(None)
+        elif room in self._loading:
+            # 最初の接続が履歴を読み込んでいる間に入ってきた接続も，同じ履歴を受け取る
+            await asyncio.shield(self._loading[room])
+        for message in self.history.get(room, ()):
+            connection.offer(message)
+        self.rooms[room].add(connection)
+        return connection
+
+    async def leave(self, room: str, connection: ChatConnection) -> None:
+        """
+        接続をルームから外して閉じる
+        """
+        connections = self.rooms.get(room)
+        if connections is not None:
+            connections.discard(connection)
+            if not connections:
+                del self.rooms[room]
+                # subscribeをやめると以降のメッセージが届かないので，リングバッファも捨てる
+                self.history.pop(room, None)
+                await self.bus.unsubscribe(room)
+        self._stats["dropped"] += connection.dropped
+        await connection.close()
+
+    async def broadcast(self, room: str, message: dict) -> None:
+        """
+        ルームにメッセージを送る．全てのノードのdeliverに届く
+        :param room: ルーム名(pub_id)
+        :param message: 配信するメッセージ
+        """
+        message["created_at"] = datetime.now().isoformat(sep=" ", timespec="seconds")
+        self.writer.add(room, message)
+        await self.bus.publish(room, message)
+
+    def deliver(self, room: str, message: dict) -> int:
+        """
+        このノードにあるルームの全ての接続にメッセージを配信する
+        各接続のキューに積むだけなので，遅いクライアントがいても待たされない
+        :param room: ルーム名(pub_id)
+        :param message: 配信するメッセージ
+        :return: 配信できた接続の数
+        """
+        history = self.history.get(room)
+        if history is not None:
+            history.append(message)
+        delivered = 0
+        for connection in list(self.rooms.get(room, ())):
+            if connection.closed:
+                # 切断処理中の接続．受信側のループがleaveする
+                continue
+            if connection.offer(message):
+                delivered += 1
+            else:
+                self._stats["slow_disconnects"] += 1
+        self._stats["messages"] += 1
+        self._stats["deliveries"] += delivered
+        self._stats["fanout_max"] = max(self._stats["fanout_max"], delivered)
+        return delivered
+
+    def stats(self) -> Dict[str, int]:
+        """
+        :return: ルーム数，接続数，１メッセージあたりの配信数，busの遅延などの統計
+        """
+        stats = dict(self._stats)
+        stats["fanout_avg"] = stats["deliveries"] / stats["messages"] if stats["messages"] else 0.0
+        stats["rooms"] = len(self.rooms)
+        stats["connections"] = sum(len(connections) for connections in self.rooms.values())
+        stats["dropped"] += sum(connection.dropped
+                                for connections in self.rooms.values() for connection in connections)
+        stats["bus"] = self.bus.stats()
+        stats["persistence"] = self.writer.stats()
+        return stats
@@ -1,3 +1,4 @@
+import inspect
 import logging
 from functools import wraps
 
@@ -5,6 +6,17 @@ from fastapi.responses import RedirectResponse
 
 
 def check_login(func):
+    if inspect.iscoroutinefunction(func):
+        # async defのルートはFastAPIがイベントループ上で実行するので，wrapperもasyncにする
+        @wraps(func)
+        async def async_wrapper(*args, **kwargs):
+            if not kwargs.get("session_id"):
+                logging.error("Session not found")
+                return RedirectResponse("/")
+            return await func(*args, **kwargs)
+
+        return async_wrapper
+
     @wraps(func)
     def wrapper(*args, **kwargs):
         if not kwargs.get("session_id"):
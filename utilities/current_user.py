@@ -0,0 +1,42 @@
+"""
+ログイン中のユーザを取得するFastAPIの依存関係
+ヘッダーの表示のためにほぼ全てのページでプロフィールが必要になるので，リクエストごとに１回だけ解決する
+write-behindでまだ書き込んでいないこのユーザのコメントやフォローがあれば，ページを作る前に書き込む
+"""
+from typing import Dict, Optional
+
+from fastapi import Cookie
+
+from app.configs import Config
+from app.models.auth import AuthModel
+from app.utilities.session import Session
+from app.utilities.write_behind import write_behind
+
+
+class CurrentUser(object):
+    """
+    セッションからユーザ名を取り出し，そのユーザのプロフィールを返す
+    プロフィールはAuthModel.find_profile_by_user_id_cachedで短い時間キャッシュされる
+    ログインしていない場合はNoneを返す(リダイレクトはcheck_loginが行う)
+
+    current_user = CurrentUser(session, config)
+
+    @app.get("/")
+    def index(user=Depends(current_user)):
+        ...
+    """
+
+    def __init__(self, session: Session, config: Config):
+        self.session = session
+        self.config = config
+
+    def __call__(self, session_id: Optional[str] = Cookie(default=None)) -> Optional[Dict[str, any]]:
+        if not session_id:
+            return None
+        session_obj = self.session.get(session_id)
+        if not session_obj or not session_obj.get("user"):
+            return None
+        user_name = session_obj.get("user").get("username")
+        # 自分の書き込みは直後のページに必ず表示されるようにする(ETagの計算より先に行われる)
+        write_behind.wait_for(user_name)
+        return AuthModel(self.config).find_profile_by_user_id_cached(user_name)
@@ -0,0 +1,191 @@
+"""
+/articles のタイムライン用に，最新の記事をメモリ上に持っておく
+記事の作成・更新・削除はArticleModelからapplyで即座に反映する(write-through)
+他のworkerでの変更は，article_changesテーブル(変更ログ．idが単調増加するバージョン)を
+poll_interval秒に１回見に行き，変わった記事だけを取り直す
+記事の行には投稿者のプロフィール(nicknameなど)も入っているので，プロフィールの変更も記事の変更としてログに残す
+(ArticleModel.author_changed)
+変更ログはretention秒残し，prune_interval秒に１回古いものを消す．retention秒より長くログを読めなかった
+(DBにつながらなかった)workerは，消されたログを読み飛ばさないようにタイムラインを作り直す
+article_changesテーブルは migrations/0002_article_changes.sql
+"""
+import threading
+import time
+from typing import Dict, List, Optional, Tuple
+
+from app.models.pagination import DEFAULT_PAGE_SIZE, NEXT, PREV, Page, clamp_page_size, decode_cursor, make_page
+
+KEYS = ("articles.created_at", "articles.id")
+
+
+def _key(row: Dict[str, any]) -> Tuple[str, int]:
+    # カーソルにはcreated_atが文字列で入るので，比較も文字列で行う
+    return str(row["created_at"]), row["id"]
+
+
+class ArticleFeed(object):
+    """
+    新しい順にsize件の記事を持つ
+    modelにはArticleModel(同期版)を渡す
+    """
+
+    def __init__(self, size: int, poll_interval: float, retention: float, prune_interval: float):
+        """
+        :param size: メモリに持つ記事の数
+        :param poll_interval: 他のworkerの変更を確認する間隔(秒)
+        :param retention: 変更ログを残しておく秒数
+        :param prune_interval: 古い変更ログを消す間隔(秒)
+        """
+        self.size = size
+        self.poll_interval = poll_interval
+        self.retention = retention
+        self.prune_interval = prune_interval
+        self._rows: Dict[int, Dict[str, any]] = {}
+        # 新しい順の記事のid
+        self._order: List[int] = []
+        # 全ての記事がメモリに載っているか．Falseならsize件より古い記事はMySQLから取る
+        self._complete = False
+        # 反映済みのarticle_changesのid．Noneならまだ作っていない
+        self._version: Optional[int] = None
+        self._checked_at = 0.0
+        # 最後に変更ログを読み終えた時刻．retentionより前なら，その後のログが消されているかもしれない
+        self._read_at = 0.0
+        self._pruned_at = 0.0
+        self._lock = threading.Lock()
+        self._refresh_lock = threading.Lock()
+        self._stats = {"hits": 0, "fallbacks": 0, "rebuilds": 0, "refreshes": 0, "refreshed_entries": 0,
+                       "writes": 0, "pruned": 0}
+
+    def page(self, model, cursor: Optional[str] = None, limit: int = DEFAULT_PAGE_SIZE) -> Page:
+        """
+        最新の記事を１ページ分返す．メモリに載っていない古いページだけMySQLから取る
+        :param model: ArticleModel
+        :param cursor: 前回のPageのnext_cursorかprev_cursor．Noneなら最初のページ
+        :param limit: 1ページの件数
+        :return: Page
+        """
+        self.refresh(model)
+        limit = clamp_page_size(limit)
+        direction, values = decode_cursor(cursor)
+        with self._lock:
+            rows = [self._rows[article_id] for article_id in self._order]
+            complete = self._complete
+        position = None
+        if values is not None and len(values) == 2 and isinstance(values[0], str) and isinstance(values[1], int):
+            position = (values[0], values[1])
+        if position is None:
+            direction = None
+            candidates = rows
+        elif direction == NEXT:
+            candidates = [row for row in rows if _key(row) < position]
+        else:
+            candidates = [row for row in reversed(rows) if _key(row) > position]
+        candidates = candidates[:limit + 1]
+        if direction != PREV and len(candidates) <= limit and not complete:
+            with self._lock:
+                self._stats["fallbacks"] += 1
+            return model.fetch_recent_articles_page(cursor, limit)
+        with self._lock:
+            self._stats["hits"] += 1
+        return make_page(candidates, KEYS, limit, direction)
+
+    def refresh(self, model, force: bool = False) -> None:
+        """
+        まだ作っていなければ作り，poll_interval秒経っていれば他のworkerの変更を反映する
+        :param model: ArticleModel
+        :param force: poll_intervalを待たずに確認する
+        """
+        if not force and self._version is not None and time.monotonic() - self._checked_at < self.poll_interval:
+            return
+        with self._refresh_lock:
+            if self._version is None:
+                self._rebuild(model)
+                return
+            now = time.monotonic()
+            if not force and now - self._checked_at < self.poll_interval:
+                return
+            self._checked_at = now
+            if now - self._read_at >= self.retention:
+                self._rebuild(model)
+                return
+            changes = model.fetch_article_changes(self._version)
+            self._read_at = now
+            self._prune(model, now)
+            if not changes:
+                return
+            article_ids = sorted({change["article_id"] for change in changes})
+            self._replace(article_ids, model.fetch_articles_by_ids(article_ids))
+            with self._lock:
+                self._version = max(change["id"] for change in changes)
+                self._stats["refreshes"] += 1
+                self._stats["refreshed_entries"] += len(article_ids)
+
+    def _prune(self, model, now: float) -> None:
+        # どのworkerが消してもよい．poll_intervalごとに読んでいるworkerはretentionより古いログを読み終えている
+        if now - self._pruned_at < self.prune_interval:
+            return
+        self._pruned_at = now
+        pruned = model.prune_article_changes(self.retention)
+        with self._lock:
+            self._stats["pruned"] += pruned
+
+    def _rebuild(self, model) -> None:
+        # 先にバージョンを読むので，読み込み中の変更は次のrefreshでもう一度反映される(取り直すだけなので問題ない)
+        started = time.monotonic()
+        version = model.latest_article_change()
+        rows = model.fetch_recent_articles(self.size)
+        with self._lock:
+            self._rows = {row["id"]: row for row in rows}
+            self._order = [row["id"] for row in rows]
+            self._complete = len(rows) < self.size
+            self._version = version
+            self._checked_at = self._read_at = started
+            self._stats["rebuilds"] += 1
+
+    def apply(self, model, article_id: int) -> None:
+        """
+        このworkerで変更した記事をすぐに反映する
+        まだ作っていない場合は何もしない(最初のpageで作る時に読み込まれる)
+        :param model: ArticleModel
+        :param article_id: 作成・更新・削除した記事のID
+        """
+        self.apply_many(model, [article_id])
+
+    def apply_many(self, model, article_ids: List[int]) -> None:
+        """
+        applyの複数の記事版．プロフィールを変更したユーザの記事などに使う
+        """
+        if self._version is None or not article_ids:
+            return
+        self._replace(article_ids, model.fetch_articles_by_ids(article_ids))
+        with self._lock:
+            self._stats["writes"] += 1
+
+    def _replace(self, article_ids: List[int], rows: List[Dict[str, any]]) -> None:
+        found = {row["id"]: row for row in rows}
+        with self._lock:
+            oldest = _key(self._rows[self._order[-1]]) if self._order else None
+            for article_id in article_ids:
+                row = found.get(article_id)
+                if row is None:
+                    self._rows.pop(article_id, None)
+                elif article_id in self._rows:
+                    self._rows[article_id] = row
+                elif self._complete or oldest is None or _key(row) > oldest:
+                    # メモリに載っている範囲より古い記事は持たない
+                    self._rows[article_id] = row
+            self._order = sorted(self._rows, key=lambda article_id: _key(self._rows[article_id]), reverse=True)
+            for article_id in self._order[self.size:]:
+                del self._rows[article_id]
+                self._complete = False
+            del self._order[self.size:]
+
+    def stats(self) -> Dict[str, int]:
+        """
+        :return: メモリから返した数，MySQLに取りに行った数，反映した変更の数など
+        """
+        with self._lock:
+            stats = dict(self._stats)
+            stats["size"] = len(self._order)
+            stats["version"] = self._version or 0
+        return stats
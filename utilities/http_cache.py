@@ -0,0 +1,142 @@
+"""
+読み込みが多いページのHTTPキャッシュ(ETag/Last-Modified と条件付きGET)
+ETagはページの元になるデータの版(entity_versions)とログイン中のユーザから作るので，
+If-None-Matchが一致すればハンドラのSQLもテンプレートの描画も行わずに304を返す
+一致しなくても，同じETagで描画したHTMLがこのworkerに残っていればそれを返す
+
+    @app.get("/article/{article_id}")
+    @check_login
+    @http_cache.conditional(article="article_id")
+    def article_detail_page(request: Request, article_id: int, user=Depends(current_user), ...):
+        ...
+"""
+import hashlib
+import inspect
+import threading
+from datetime import timezone
+from email.utils import format_datetime
+from functools import wraps
+from typing import Dict, List, Optional
+
+from fastapi.responses import HTMLResponse, Response
+
+from app.configs import Config
+from app.models.versions import AsyncVersionModel, VersionKey, VersionModel, user_key
+from app.utilities.cache import TTLCache
+from app.utilities.templates import AppTemplates
+
+# 他人のページも含まれるのでブラウザだけに保存させ，使う前に毎回確認させる
+CACHE_CONTROL = "private, no-cache"
+
+
+class HttpCache(object):
+    """
+    ハンドラに付けるデコレータと，描画したHTMLのキャッシュ
+    HTMLはETag(= ユーザごと，データの版ごと)をキーにするので，書き込みで版が上がれば古いものは使われなくなり，
+    件数の上限と有効期限で捨てられる
+    """
+
+    def __init__(self, config: Config, templates: AppTemplates):
+        self.config = config
+        self.templates = templates
+        self.pages = TTLCache(config.http_page_cache_size, config.http_page_cache_ttl)
+        self._lock = threading.Lock()
+        self._stats = {"not_modified": 0, "page_hits": 0, "rendered": 0}
+
+    def conditional(self, **entities: str):
+        """
+        :param entities: 版を見るデータの種類(article, pub, user) -> パスパラメータの名前
+        :return: デコレータ．ハンドラは request と user(current_user) を引数に持つこと
+        """
+
+        def decorator(func):
+            if inspect.iscoroutinefunction(func):
+                @wraps(func)
+                async def async_wrapper(*args, **kwargs):
+                    keys = self._keys(entities, kwargs)
+                    if keys is None:
+                        return await func(*args, **kwargs)
+                    versions = await AsyncVersionModel(self.config).versions(keys)
+                    request = kwargs["request"]
+                    etag, response = self._lookup(request, keys, versions)
+                    if response is None:
+                        response = self._store(etag, versions, await func(*args, **kwargs))
+                    return response
+
+                return async_wrapper
+
+            @wraps(func)
+            def wrapper(*args, **kwargs):
+                keys = self._keys(entities, kwargs)
+                if keys is None:
+                    return func(*args, **kwargs)
+                versions = VersionModel(self.config).versions(keys)
+                request = kwargs["request"]
+                etag, response = self._lookup(request, keys, versions)
+                if response is None:
+                    response = self._store(etag, versions, func(*args, **kwargs))
+                return response
+
+            return wrapper
+
+        return decorator
+
+    @staticmethod
+    def _keys(entities: Dict[str, str], kwargs: dict) -> Optional[List[VersionKey]]:
+        user = kwargs.get("user")
+        if not user:
+            # ログインしていない場合はハンドラ(check_login)に任せる
+            return None
+        keys = [(kind, str(kwargs[param])) for kind, param in entities.items()]
+        return keys + [user_key(user["username"])]
+
+    def _lookup(self, request, keys: List[VersionKey], versions: dict):
+        # ログイン中のユーザはkeysに含まれているので，ユーザごとに別のETagになる
+        # versionsにはページに表示されるユーザの版も入っているので，それも加える
+        keys = keys + sorted(set(versions) - set(keys))
+        source = "|".join([request.url.path, request.url.query, self.templates.version] +
+                          ["%s:%s:%s" % (kind, entity_id, versions.get((kind, entity_id), (0, None))[0])
+                           for kind, entity_id in keys])
+        etag = 'W/"%s"' % hashlib.sha1(source.encode()).hexdigest()
+        headers = self._headers(etag, versions)
+        # If-Modified-Sinceは見ない．Last-Modifiedにはユーザが含まれないので，同じブラウザで別のユーザに304を返してしまう
+        if_none_match = request.headers.get("if-none-match", "")
+        if etag in [tag.strip() for tag in if_none_match.split(",")]:
+            self._count("not_modified")
+            return etag, Response(status_code=304, headers=headers)
+        body = self.pages.get(etag)
+        if body is not None:
+            self._count("page_hits")
+            return etag, HTMLResponse(body, headers=headers)
+        return etag, None
+
+    def _store(self, etag: str, versions: dict, response: Response) -> Response:
+        # リダイレクトやストリーミングはキャッシュしない
+        if response.status_code != 200 or getattr(response, "body", None) is None:
+            return response
+        self.pages.set(etag, response.body)
+        response.headers.update(self._headers(etag, versions))
+        self._count("rendered")
+        return response
+
+    @staticmethod
+    def _headers(etag: str, versions: dict) -> Dict[str, str]:
+        headers = {"ETag": etag, "Cache-Control": CACHE_CONTROL}
+        updated = [updated_at for _, updated_at in versions.values() if updated_at is not None]
+        if updated:
+            # entity_versions.updated_atはUTCで保存している前提
+            headers["Last-Modified"] = format_datetime(max(updated).replace(tzinfo=timezone.utc), usegmt=True)
+        return headers
+
+    def _count(self, name: str) -> None:
+        with self._lock:
+            self._stats[name] += 1
+
+    def stats(self) -> Dict[str, any]:
+        """
+        :return: 304を返した数，保存したHTMLを返した数，描画した数とHTMLのキャッシュの状態
+        """
+        with self._lock:
+            stats = dict(self._stats)
+        stats["pages"] = self.pages.stats()
+        return stats
@@ -0,0 +1,356 @@
+"""
+/matching のおすすめユーザ
+ユーザを好きなクラブ，リーグ，国ごとのバケツに分けてメモリに持ち，
+同じバケツにいるユーザだけを見るので，ユーザ全体を見に行かない
+バケツの中は新しい順に並べておき，共通点の組み合わせ(点数)ごとに並び順のまま読むので，
+リクエストのたびに数えたり並べ直したりしない
+"""
+import threading
+import time
+from bisect import bisect_left, bisect_right, insort
+from typing import Awaitable, Callable, Dict, Iterator, List, Optional, Set, Tuple
+
+from app.models.pagination import DEFAULT_PAGE_SIZE, NEXT, PREV, Page, clamp_page_size, decode_cursor, \
+    encode_cursor
+
+# 共通点の重み．クラブが同じなら，リーグと国が両方同じユーザより上に来る
+CLUB_WEIGHT = 4
+LEAGUE_WEIGHT = 2
+NATION_WEIGHT = 1
+
+# (点数, 登録日時の文字列, ユーザ名)．この大きい順に並べる
+Key = Tuple[int, str, str]
+
+# フォロー済みのユーザを除くために，候補をこの回数まで問い合わせる
+# 候補がほとんどフォロー済みでも，１リクエストのSQLはこの回数で止めて，続きは次のページにする
+MAX_EXCLUDE_LOOKUPS = 5
+
+# プロフィールを設定していない場合の値．これ同士は共通点として数えない
+UNSET = (None, "", "未登録")
+
+
+class Fan(object):
+    """
+    インデックスに載せるユーザ１人分
+    """
+
+    __slots__ = ("username", "nickname", "created_at", "club", "league", "nation")
+
+    def __init__(self, username: str, nickname: str, created_at: any,
+                 club: Optional[str], league: Optional[str], nation: Optional[str]):
+        self.username = username
+        self.nickname = nickname
+        self.created_at = created_at
+        self.club = club
+        self.league = league
+        self.nation = nation
+
+    @classmethod
+    def from_profile(cls, row: Dict[str, any]) -> "Fan":
+        """
+        :param row: find_profile_by_user_idの結果
+        """
+        return cls(row["username"], row["nickname"], row["created_at"],
+                   row["your_club"], row["your_league"], row["your_nation"])
+
+    def order_key(self) -> Tuple[str, str]:
+        return str(self.created_at), self.username
+
+
+class Bucket(object):
+    """
+    同じクラブ(リーグ，国)のユーザ
+    members: ユーザ名のset
+    order: (登録日時の文字列, ユーザ名)を古い順に並べたリスト
+    """
+
+    __slots__ = ("members", "order")
+
+    def __init__(self):
+        self.members: Set[str] = set()
+        self.order: List[Tuple[str, str]] = []
+
+    def add(self, fan: Fan, keep_sorted: bool) -> None:
+        self.members.add(fan.username)
+        if keep_sorted:
+            insort(self.order, fan.order_key())
+        else:
+            self.order.append(fan.order_key())
+
+    def remove(self, fan: Fan) -> None:
+        self.members.discard(fan.username)
+        key = fan.order_key()
+        index = bisect_left(self.order, key)
+        if index < len(self.order) and self.order[index] == key:
+            del self.order[index]
+
+
+class MatchingIndex(object):
+    """
+    modelにはiter_fans/find_profile_by_user_idを持つAuthModel(同期版)を渡す
+    他のworkerでのプロフィールの変更は，ttl秒ごとの作り直しで反映される
+    """
+
+    def __init__(self, ttl: float):
+        """
+        :param ttl: 作り直すまでの秒数．0なら再起動するまで作り直さない
+        """
+        self.ttl = ttl
+        self._fans: Optional[Dict[str, Fan]] = None
+        self._clubs: Dict[str, Bucket] = {}
+        self._leagues: Dict[str, Bucket] = {}
+        self._nations: Dict[str, Bucket] = {}
+        self._built_at = 0.0
+        self._lock = threading.Lock()
+        self._build_lock = threading.Lock()
+        self._stats = {"builds": 0, "updates": 0, "queries": 0, "query_time_total": 0.0, "query_time_max": 0.0,
+                       "scanned": 0, "exclude_lookups": 0}
+
+    def _buckets(self):
+        return ((self._clubs, "club", CLUB_WEIGHT), (self._leagues, "league", LEAGUE_WEIGHT),
+                (self._nations, "nation", NATION_WEIGHT))
+
+    def _stale(self) -> bool:
+        return self._fans is None or bool(self.ttl and time.monotonic() - self._built_at >= self.ttl)
+
+    def ensure(self, model) -> None:
+        """
+        まだ作っていないか，ttl秒経っていれば作り直す
+        :param model: AuthModel(同期版)
+        """
+        if not self._stale():
+            return
+        with self._build_lock:
+            if not self._stale():
+                return
+            # 全ユーザの行を一度にリストにしないよう，読みながら新しいバケツに入れていき，最後に入れ替える
+            index = MatchingIndex(self.ttl)
+            index._fans = {}
+            for row in model.iter_fans():
+                index._add(Fan(*row), keep_sorted=False)
+            for buckets, _, _ in index._buckets():
+                for bucket in buckets.values():
+                    bucket.order.sort()
+            with self._lock:
+                self._fans = index._fans
+                self._clubs, self._leagues, self._nations = index._clubs, index._leagues, index._nations
+                self._built_at = time.monotonic()
+                self._stats["builds"] += 1
+
+    def _add(self, fan: Fan, keep_sorted: bool = True) -> None:
+        self._fans[fan.username] = fan
+        for buckets, field, _ in self._buckets():
+            value = getattr(fan, field)
+            if value not in UNSET:
+                buckets.setdefault(value, Bucket()).add(fan, keep_sorted)
+
+    def _remove(self, username: str) -> None:
+        fan = self._fans.pop(username, None)
+        if fan is None:
+            return
+        for buckets, field, _ in self._buckets():
+            bucket = buckets.get(getattr(fan, field))
+            if bucket is not None:
+                bucket.remove(fan)
+                if not bucket.members:
+                    del buckets[getattr(fan, field)]
+
+    def refresh_user(self, model, username: str) -> None:
+        """
+        １人分だけ読み直してバケツを入れ替える．プロフィールを変更した時に呼ぶ
+        まだ作っていない場合は何もしない
+        :param model: AuthModel
+        :param username: 変更したユーザ
+        """
+        if self._fans is None:
+            return
+        row = model.find_profile_by_user_id(username)
+        with self._lock:
+            self._remove(username)
+            if row:
+                self._add(Fan.from_profile(row))
+            self._stats["updates"] += 1
+
+    def _levels(self, user: Dict[str, any]) -> List[Tuple[int, Bucket, List[Bucket], List[Bucket]]]:
+        # 共通点の組み合わせごとに(点数, 読むバケツ, 入っているべきバケツ, 入っていてはいけないバケツ)を点数の高い順に返す
+        # 重みは4, 2, 1なので，組み合わせが違えば点数も違う
+        present = []
+        for buckets, field, weight in self._buckets():
+            value = user["your_" + field]
+            bucket = buckets.get(value) if value not in UNSET else None
+            if bucket is not None:
+                present.append((weight, bucket))
+        levels = []
+        for mask in range(1, 1 << len(present)):
+            included = [present[i] for i in range(len(present)) if mask & (1 << i)]
+            excluded = [bucket for i, (_, bucket) in enumerate(present) if not mask & (1 << i)]
+            score = sum(weight for weight, _ in included)
+            # 一番小さいバケツを並び順に読み，他のバケツはsetで確かめる
+            driver = min((bucket for _, bucket in included), key=lambda bucket: len(bucket.order))
+            levels.append((score, driver, [bucket for _, bucket in included], excluded))
+        levels.sort(key=lambda level: level[0], reverse=True)
+        return levels
+
+    def _scan(self, user: Dict[str, any], position: Optional[Key], direction: Optional[str]) -> Iterator[Key]:
+        # positionより後ろ(PREVなら前)を，大きい順(PREVなら小さい順)に返す．呼び出し側で_lockを取っておく
+        levels = self._levels(user)
+        if direction == PREV:
+            levels.reverse()
+        for score, driver, included, excluded in levels:
+            order = driver.order
+            if position is None:
+                indexes = range(len(order) - 1, -1, -1)
+            elif direction == PREV:
+                if score < position[0]:
+                    continue
+                start = bisect_right(order, position[1:]) if score == position[0] else 0
+                indexes = range(start, len(order))
+            else:
+                if score > position[0]:
+                    continue
+                end = bisect_left(order, position[1:]) if score == position[0] else len(order)
+                indexes = range(end - 1, -1, -1)
+            for index in indexes:
+                created_at, username = order[index]
+                if username == user["username"]:
+                    continue
+                if all(username in bucket.members for bucket in included) \
+                        and not any(username in bucket.members for bucket in excluded):
+                    yield score, created_at, username
+
+    def _collect(self, user: Dict[str, any], position: Optional[Key], direction: Optional[str],
+                 count: int) -> List[Tuple[Key, Fan]]:
+        # positionの続きをcount件．refresh_userと重ならないよう，１回分ずつ_lockの中で読む
+        keys = []
+        with self._lock:
+            for key in self._scan(user, position, direction):
+                keys.append((key, self._fans[key[2]]))
+                if len(keys) == count:
+                    break
+            self._stats["scanned"] += len(keys)
+        return keys
+
+    def suggestions(self, model, user: Dict[str, any],
+                    exclude: Optional[Callable[[List[str]], Set[str]]] = None,
+                    cursor: Optional[str] = None, limit: int = DEFAULT_PAGE_SIZE) -> Page:
+        """
+        共通点の多い順(同じなら新しいユーザから)におすすめのユーザを返す
+        :param model: AuthModel
+        :param user: ログイン中のユーザのプロフィール
+        :param exclude: 候補のユーザ名のリストを受け取り，除外するもの(フォロー済みのユーザなど)のsetを返す関数
+        :param cursor: 前回のPageのnext_cursorかprev_cursor．Noneなら最初のページ
+        :param limit: 1ページの件数
+        :return: Page(username, nickname, created_at, club, league, nation, score を持つ辞書)
+        """
+        self.ensure(model)
+        pager = _Pager(self, user, cursor, limit, exclude is not None)
+        while True:
+            usernames = pager.next_batch()
+            if usernames is None:
+                return pager.page()
+            pager.accept(exclude(usernames) if usernames else set())
+
+    async def suggestions_async(self, user: Dict[str, any],
+                                exclude: Optional[Callable[[List[str]], Awaitable[Set[str]]]] = None,
+                                cursor: Optional[str] = None, limit: int = DEFAULT_PAGE_SIZE) -> Page:
+        """
+        suggestionsと同じ．excludeはawaitableを返す関数にする
+        インデックスは先にensureで作っておく(AsyncAuthModel.fan_suggestions)
+        """
+        pager = _Pager(self, user, cursor, limit, exclude is not None)
+        while True:
+            usernames = pager.next_batch()
+            if usernames is None:
+                return pager.page()
+            pager.accept(await exclude(usernames) if usernames else set())
+
+    def _record_query(self, elapsed: float, lookups: int) -> None:
+        with self._lock:
+            self._stats["queries"] += 1
+            self._stats["query_time_total"] += elapsed
+            self._stats["query_time_max"] = max(self._stats["query_time_max"], elapsed)
+            self._stats["exclude_lookups"] += lookups
+
+    def stats(self) -> Dict[str, float]:
+        """
+        :return: ユーザ数，バケツの数，おすすめの計算にかかった時間(秒)など
+        """
+        with self._lock:
+            stats = dict(self._stats)
+            stats["fans"] = len(self._fans) if self._fans is not None else 0
+            stats["clubs"] = len(self._clubs)
+            stats["leagues"] = len(self._leagues)
+            stats["nations"] = len(self._nations)
+        stats["query_time_avg"] = stats["query_time_total"] / stats["queries"] if stats["queries"] else 0.0
+        return stats
+
+
+class _Pager(object):
+    """
+    suggestionsの１ページ分を集める
+    next_batchで候補を読み，除外するユーザをacceptに渡すことを，limit + 1件集まるまで繰り返す
+    """
+
+    def __init__(self, index: MatchingIndex, user: Dict[str, any], cursor: Optional[str], limit: int,
+                 excluding: bool):
+        self.index = index
+        self.user = user
+        self.limit = clamp_page_size(limit)
+        self.excluding = excluding
+        direction, values = decode_cursor(cursor)
+        self.position: Optional[Key] = None
+        if values is not None and len(values) == 3 and isinstance(values[0], int) \
+                and isinstance(values[1], str) and isinstance(values[2], str):
+            self.position = tuple(values)
+        self.direction = direction if self.position is not None else None
+        self.rows: List[Tuple[Key, Fan]] = []
+        self.lookups = 0
+        # 除外の問い合わせの上限で止めた時の，最後に見た候補
+        self.capped_at: Optional[Key] = None
+        self._batch: List[Tuple[Key, Fan]] = []
+        self._started = time.perf_counter()
+
+    def next_batch(self) -> Optional[List[str]]:
+        """
+        :return: 除外するか確かめる候補のユーザ名．集め終わったらNone
+        """
+        wanted = self.limit + 1 - len(self.rows)
+        if wanted <= 0:
+            return None
+        if self.excluding and self.lookups >= MAX_EXCLUDE_LOOKUPS:
+            self.capped_at = self.position
+            return None
+        self._batch = self.index._collect(self.user, self.position, self.direction, wanted)
+        if not self._batch:
+            return None
+        self.position = self._batch[-1][0]
+        if not self.excluding:
+            return []
+        self.lookups += 1
+        return [key[2] for key, _ in self._batch]
+
+    def accept(self, excluded: Set[str]) -> None:
+        self.rows.extend((key, fan) for key, fan in self._batch if key[2] not in excluded)
+
+    def page(self) -> Page:
+        has_more = len(self.rows) > self.limit
+        rows = self.rows[:self.limit]
+        items = [{"username": fan.username, "nickname": fan.nickname, "created_at": fan.created_at,
+                  "club": fan.club, "league": fan.league, "nation": fan.nation, "score": key[0]}
+                 for key, fan in rows]
+        # 上限で止めた場合は，最後に見た候補の続きから次のページを始める
+        boundary = rows[-1][0] if has_more else self.capped_at
+        next_cursor = prev_cursor = None
+        if self.direction == PREV:
+            items.reverse()
+            if rows:
+                next_cursor = encode_cursor(NEXT, list(rows[0][0]))
+            if boundary is not None:
+                prev_cursor = encode_cursor(PREV, list(boundary))
+        else:
+            if boundary is not None:
+                next_cursor = encode_cursor(NEXT, list(boundary))
+            if self.direction == NEXT and rows:
+                prev_cursor = encode_cursor(PREV, list(rows[0][0]))
+        self.index._record_query(time.perf_counter() - self._started, self.lookups)
+        return Page(items, next_cursor, prev_cursor)
@@ -0,0 +1,195 @@
+"""
+リクエストとSQLの計測
+    ルートごとのレイテンシのヒストグラム
+    １リクエストあたりのSQLの数とDBの時間(N+1になったページを見つける)
+    正規化したSQLごとの回数と時間，遅いSQLのログ
+集計はworkerごとで，/metrics(ローカルからのみ)で確認する
+"""
+import contextvars
+import logging
+import re
+import threading
+import time
+from typing import Dict, List, Optional
+
+from app.configs import Config
+
+logger = logging.getLogger(__name__)
+
+# レイテンシのヒストグラムの境界(ms)．最後のバケツはそれより遅いもの全て
+LATENCY_BUCKETS = (5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000)
+
+_STRING = re.compile(r"'(?:[^'\\]|\\.)*'|\"(?:[^\"\\]|\\.)*\"")
+_NUMBER = re.compile(r"\b\d+(?:\.\d+)?\b")
+_VALUES = re.compile(r"\(\s*\?(?:\s*,\s*\?)*\s*\)(?:\s*,\s*\(\s*\?(?:\s*,\s*\?)*\s*\))+")
+_IN_LIST = re.compile(r"\bIN\s*\(\s*\?(?:\s*,\s*\?)+\s*\)", re.IGNORECASE)
+_SPACES = re.compile(r"\s+")
+
+
+def normalize_sql(sql: str) -> str:
+    """
+    値や件数だけが違うSQLを同じものとして集計するために，値を ? にまとめる
+    :param sql: SQL文(%sのままでも，値を埋め込んだものでもよい)
+    :return: 正規化したSQL
+    """
+    sql = sql.replace("%s", "?")
+    sql = _STRING.sub("?", sql)
+    sql = _NUMBER.sub("?", sql)
+    sql = _VALUES.sub("(...), ...", sql)
+    sql = _IN_LIST.sub("IN (...)", sql)
+    return _SPACES.sub(" ", sql).strip()
+
+
+class RequestStats(object):
+    """
+    １リクエストの中で実行したSQLの数と時間
+    """
+
+    __slots__ = ("queries", "db_time")
+
+    def __init__(self):
+        self.queries = 0
+        self.db_time = 0.0
+
+
+# 処理中のリクエストのRequestStats．同期ハンドラのスレッドやストリーミングにもコピーされる
+_current = contextvars.ContextVar("request_stats", default=None)
+
+
+class Metrics(object):
+    def __init__(self, slow_query_threshold: float, top_queries: int, query_warn_count: int):
+        """
+        :param slow_query_threshold: これ以上かかったSQLをログに出す(秒)．0ならログに出さない
+        :param top_queries: 遅い順に返すSQLの数
+        :param query_warn_count: １リクエストでこれより多くSQLを実行したらログに出す．0ならログに出さない
+        """
+        self.slow_query_threshold = slow_query_threshold
+        self.top_queries = top_queries
+        self.query_warn_count = query_warn_count
+        self._lock = threading.Lock()
+        self._routes: Dict[str, Dict[str, any]] = {}
+        self._queries: Dict[str, Dict[str, float]] = {}
+
+    def record_query(self, sql: str, elapsed: float) -> None:
+        """
+        AbstractModel/AsyncAbstractModelの_executeから呼ばれる
+        :param sql: 実行したSQL文
+        :param elapsed: かかった秒数
+        """
+        request = _current.get()
+        if request is not None:
+            request.queries += 1
+            request.db_time += elapsed
+        normalized = normalize_sql(sql)
+        with self._lock:
+            stats = self._queries.get(normalized)
+            if stats is None:
+                stats = self._queries[normalized] = {"count": 0, "total": 0.0, "max": 0.0}
+            stats["count"] += 1
+            stats["total"] += elapsed
+            stats["max"] = max(stats["max"], elapsed)
+        if self.slow_query_threshold and elapsed >= self.slow_query_threshold:
+            logger.warning("slow query %.1fms: %s", elapsed * 1000, normalized)
+
+    def begin_request(self) -> contextvars.Token:
+        return _current.set(RequestStats())
+
+    def end_request(self, token: contextvars.Token, route: str, elapsed: float) -> None:
+        request = _current.get()
+        _current.reset(token)
+        bucket = len(LATENCY_BUCKETS)
+        for index, bound in enumerate(LATENCY_BUCKETS):
+            if elapsed * 1000 <= bound:
+                bucket = index
+                break
+        with self._lock:
+            stats = self._routes.get(route)
+            if stats is None:
+                stats = self._routes[route] = {"count": 0, "total": 0.0, "max": 0.0, "queries": 0,
+                                               "queries_max": 0, "db_time": 0.0,
+                                               "buckets": [0] * (len(LATENCY_BUCKETS) + 1)}
+            stats["count"] += 1
+            stats["total"] += elapsed
+            stats["max"] = max(stats["max"], elapsed)
+            stats["buckets"][bucket] += 1
+            stats["queries"] += request.queries
+            stats["queries_max"] = max(stats["queries_max"], request.queries)
+            stats["db_time"] += request.db_time
+        if self.query_warn_count and request.queries > self.query_warn_count:
+            logger.warning("%s ran %d queries (%.1fms in DB)", route, request.queries, request.db_time * 1000)
+
+    @staticmethod
+    def _percentile(buckets: List[int], count: int, ratio: float) -> Optional[int]:
+        # ヒストグラムから求めるので，値はそのバケツの上限(ms)．最後のバケツならNone(上限なし)
+        rank = ratio * count
+        seen = 0
+        for index, number in enumerate(buckets):
+            seen += number
+            if seen >= rank:
+                return LATENCY_BUCKETS[index] if index < len(LATENCY_BUCKETS) else None
+        return None
+
+    def stats(self) -> Dict[str, any]:
+        """
+        :return: ルートごとのレイテンシ(ms)とSQLの数，合計時間の長い順のSQL
+        """
+        with self._lock:
+            routes = {route: dict(stats, buckets=list(stats["buckets"])) for route, stats in self._routes.items()}
+            queries = [dict(stats, sql=sql) for sql, stats in self._queries.items()]
+        result = {}
+        for route, stats in routes.items():
+            count = stats["count"]
+            result[route] = {
+                "count": count,
+                "avg_ms": stats["total"] / count * 1000,
+                "max_ms": stats["max"] * 1000,
+                "p50_ms": self._percentile(stats["buckets"], count, 0.50),
+                "p95_ms": self._percentile(stats["buckets"], count, 0.95),
+                "p99_ms": self._percentile(stats["buckets"], count, 0.99),
+                "histogram": dict(zip([str(bound) for bound in LATENCY_BUCKETS] + ["inf"], stats["buckets"])),
+                "queries_avg": stats["queries"] / count,
+                "queries_max": stats["queries_max"],
+                "db_avg_ms": stats["db_time"] / count * 1000,
+            }
+        queries.sort(key=lambda stats: stats["total"], reverse=True)
+        slowest = [{"sql": stats["sql"], "count": stats["count"], "total_ms": stats["total"] * 1000,
+                    "avg_ms": stats["total"] / stats["count"] * 1000, "max_ms": stats["max"] * 1000}
+                   for stats in queries[:self.top_queries]]
+        return {"routes": result, "queries": slowest}
+
+
+class MetricsMiddleware(object):
+    """
+    リクエストの開始からレスポンスを送り終わるまでを計測するASGIミドルウェア
+    ストリーミングのレスポンスも，最後まで送った時点で記録する
+
+    app.add_middleware(MetricsMiddleware, metrics=metrics)
+    """
+
+    def __init__(self, app, metrics: "Metrics"):
+        self.app = app
+        self.metrics = metrics
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        token = self.metrics.begin_request()
+        started = time.perf_counter()
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            self.metrics.end_request(token, self._route(scope), time.perf_counter() - started)
+
+    @staticmethod
+    def _route(scope) -> str:
+        # パスパラメータを含むURLはルートの定義(/article/{article_id})にまとめる
+        route = scope.get("route")
+        path = getattr(route, "path", None)
+        if path is None:
+            endpoint = scope.get("endpoint")
+            path = getattr(endpoint, "__name__", None) or "(unmatched)"
+        return "%s %s" % (scope["method"], path)
+
+
+metrics = Metrics(Config.slow_query_threshold, Config.metrics_top_queries, Config.metrics_query_warn_count)
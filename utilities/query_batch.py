@@ -0,0 +1,104 @@
+"""
+１つのページを表示するために必要な，互いに独立したクエリを並行実行するユーティリティ
+非同期モデルはSQLごとにプールから別の接続を借りるので，gatherすればそのまま並行に実行される
+"""
+import asyncio
+import logging
+import threading
+from time import perf_counter
+from typing import Awaitable, Dict
+
+logger = logging.getLogger(__name__)
+
+# ハンドラ名 -> {"batches", "sequential", "concurrent"}
+_timings: Dict[str, Dict[str, float]] = {}
+_timings_lock = threading.Lock()
+
+
+class QueryBatch(object):
+    """
+    並行実行するクエリをまとめるクラス
+    各クエリの所要時間の合計(逐次実行した場合の目安)と，実際にかかった時間を記録する
+
+    batch = QueryBatch("user_detail_page")
+    batch.add("user", auth_model.find_profile_by_user_id(user_name))
+    batch.add("articles", article_model.fetch_article_by_username(username))
+    results = await batch.run()
+    """
+
+    def __init__(self, name: str):
+        """
+        :param name: 集計に使う名前．ハンドラ名を想定
+        """
+        self.name = name
+        self._calls: Dict[str, Awaitable] = {}
+        self.timings: Dict[str, float] = {}
+        self.elapsed = 0.0
+
+    def add(self, key: str, awaitable: Awaitable) -> None:
+        """
+        実行するクエリを追加する
+        :param key: 結果を取り出すときのキー
+        :param awaitable: モデルのメソッドの戻り値(まだawaitしていないもの)
+        """
+        self._calls[key] = awaitable
+
+    async def _timed(self, key: str, awaitable: Awaitable):
+        started = perf_counter()
+        try:
+            return await awaitable
+        finally:
+            self.timings[key] = perf_counter() - started
+
+    async def run(self) -> Dict[str, any]:
+        """
+        追加したクエリを全て並行に実行する
+        :return: キー -> 結果 の辞書
+        """
+        keys = list(self._calls)
+        started = perf_counter()
+        results = await asyncio.gather(*(self._timed(key, self._calls[key]) for key in keys))
+        self.elapsed = perf_counter() - started
+        self._calls = {}
+        sequential = sum(self.timings.values())
+        _record(self.name, sequential, self.elapsed)
+        logger.debug("%s: %d queries, sequential %.1fms -> concurrent %.1fms",
+                     self.name, len(keys), sequential * 1000, self.elapsed * 1000)
+        return dict(zip(keys, results))
+
+
+async def gather_queries(name: str, **calls: Awaitable) -> Dict[str, any]:
+    """
+    QueryBatchをキーワード引数で簡単に使うための関数
+    :param name: 集計に使う名前．ハンドラ名を想定
+    :param calls: キー=モデルのメソッドの戻り値
+    :return: キー -> 結果 の辞書
+    """
+    batch = QueryBatch(name)
+    for key, awaitable in calls.items():
+        batch.add(key, awaitable)
+    return await batch.run()
+
+
+def _record(name: str, sequential: float, concurrent: float) -> None:
+    with _timings_lock:
+        timing = _timings.setdefault(name, {"batches": 0, "sequential": 0.0, "concurrent": 0.0})
+        timing["batches"] += 1
+        timing["sequential"] += sequential
+        timing["concurrent"] += concurrent
+
+
+def timing_stats() -> Dict[str, Dict[str, float]]:
+    """
+    ハンドラごとの，逐次実行した場合と並行実行した場合の平均所要時間(ms)を返す
+    :return: ハンドラ名 -> 統計
+    """
+    with _timings_lock:
+        return {
+            name: {
+                "batches": timing["batches"],
+                "sequential_avg_ms": timing["sequential"] / timing["batches"] * 1000,
+                "concurrent_avg_ms": timing["concurrent"] / timing["batches"] * 1000,
+            }
+            for name, timing in _timings.items()
+        }
@@ -0,0 +1,124 @@
+"""
+クラブ，リーグ，国の一覧(参照データ)
+ほとんど変わらないので起動時に読み込み，ttl秒経つかreloadするまで同じものを使い回す
+読み込んだデータは変更できない形にして，全てのリクエストから共有する
+"""
+import threading
+import time
+from types import MappingProxyType
+from typing import Dict, Iterator, List, Mapping, NamedTuple, Optional, Sequence
+
+
+class ReferenceTable(object):
+    """
+    読み込んだ１つのテーブル
+    行は読み取り専用の辞書で，テンプレートからは今まで通り club["clubs"] のように参照できる
+    """
+
+    __slots__ = ("rows", "_indexes")
+
+    def __init__(self, rows: List[Dict[str, any]], keys: Sequence[str]):
+        """
+        :param rows: テーブルの全ての行
+        :param keys: 検索に使う列．テーブルにない列は無視する
+        """
+        self.rows = tuple(MappingProxyType(dict(row)) for row in rows)
+        self._indexes = {}
+        for key in keys:
+            if self.rows and key in self.rows[0]:
+                self._indexes[key] = MappingProxyType({row[key]: row for row in self.rows})
+
+    def get(self, key: str, value: any) -> Optional[Mapping[str, any]]:
+        """
+        :param key: 検索する列
+        :param value: 値
+        :return: 見つかった行．なければNone
+        """
+        index = self._indexes.get(key)
+        if index is None:
+            return None
+        return index.get(value)
+
+    def __iter__(self) -> Iterator[Mapping[str, any]]:
+        return iter(self.rows)
+
+    def __len__(self) -> int:
+        return len(self.rows)
+
+
+class ReferenceData(NamedTuple):
+    """
+    ある時点で読み込んだ参照データ．入れ替える時は丸ごと新しいものにする
+    clubs: name(clubs列)で引く
+    leagues: 値(english_name列)で引く．表示名はleagues列
+    nations: name(nations列)で引く
+    """
+    clubs: ReferenceTable
+    leagues: ReferenceTable
+    nations: ReferenceTable
+    loaded_at: float
+
+    def is_club(self, name: Optional[str]) -> bool:
+        return self.clubs.get("clubs", name) is not None
+
+    def is_league(self, english_name: Optional[str]) -> bool:
+        return self.leagues.get("english_name", english_name) is not None
+
+    def is_nation(self, name: Optional[str]) -> bool:
+        return self.nations.get("nations", name) is not None
+
+
+class ReferenceRegistry(object):
+    """
+    参照データを持ち，期限が切れたら読み直す
+    modelにはclubs_list/leagues_list/nations_listを持つAuthModel(同期版)を渡す
+    """
+
+    def __init__(self, ttl: float):
+        """
+        :param ttl: 読み直すまでの秒数．0なら明示的にreloadするまで読み直さない
+        """
+        self.ttl = ttl
+        self._data: Optional[ReferenceData] = None
+        self._lock = threading.Lock()
+        self._stats = {"loads": 0, "hits": 0}
+
+    def get(self, model) -> ReferenceData:
+        """
+        :param model: AuthModel
+        :return: 読み込み済みの参照データ．まだないか期限切れなら読み込む
+        """
+        data = self._data
+        if data is None or (self.ttl and time.monotonic() - data.loaded_at >= self.ttl):
+            with self._lock:
+                # 待っている間に他のスレッドが読み込んでいればそれを使う
+                if self._data is data:
+                    self.reload(model)
+                data = self._data
+        else:
+            self._stats["hits"] += 1
+        return data
+
+    def reload(self, model) -> ReferenceData:
+        """
+        MySQLから読み直す．クラブなどを追加した時に呼ぶ
+        :param model: AuthModel
+        :return: 新しい参照データ
+        """
+        data = ReferenceData(
+            clubs=ReferenceTable(model.clubs_list(), ("id", "clubs")),
+            leagues=ReferenceTable(model.leagues_list(), ("id", "english_name", "leagues")),
+            nations=ReferenceTable(model.nations_list(), ("id", "nations")),
+            loaded_at=time.monotonic()
+        )
+        self._data = data
+        self._stats["loads"] += 1
+        return data
+
+    def stats(self) -> Dict[str, int]:
+        stats = dict(self._stats)
+        data = self._data
+        stats["clubs"] = len(data.clubs) if data else 0
+        stats["leagues"] = len(data.leagues) if data else 0
+        stats["nations"] = len(data.nations) if data else 0
+        return stats
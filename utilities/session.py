@@ -7,25 +7,28 @@ https://github.com/tiangolo/fastapi/issues/754#issuecomment-585386650
 """
 from typing import Dict, Hashable
 from uuid import uuid4
-from cachelib.file import FileSystemCache
 
 from app.configs import Config
+from app.utilities.session_store import SessionSweeper, create_session_store
 
 
 class Session(object):
     """
     セッション管理をするクラス
-    cachelibの機能を使ってファイルによってセッションを管理する
+    セッションの保存先はConfig.session_backendで選ぶ(utilities/session_store.py)
     セッション自体は１つの辞書っぽいもので，一番上のキーが各セッションのIDになるえ
     Flask Sessionの実装を参考に作成した
     https://github.com/fengsp/flask-session/blob/a88f07e7260ae582b0744de42e77c4625e6884ea/flask_session/sessions.py
 
-    TODO: セッション情報を削除する機能を追加
+    期限切れのセッションはstart_sweeperで起動するスレッドが少しずつ削除する
     """
 
     def __init__(self, config: Config):
-        self.cache = FileSystemCache(config.session_cache_dir)
+        self.store = create_session_store(config)
         self.session_lifetime = config.session_lifetime
+        self.sweep_interval = config.session_sweep_interval
+        self.sweep_batch_size = config.session_sweep_batch_size
+        self._sweeper = None
 
     def get(self, session_id: str) -> Dict[str, Hashable]:
         """
@@ -35,7 +38,7 @@ class Session(object):
         """
         if not session_id:
             return {}
-        return self._load_session_from_file(session_id)
+        return self._load_session(session_id)
 
     def set(self, key: str, value: Hashable, session_id: str = None) -> str:
         """
@@ -47,7 +50,10 @@ class Session(object):
         if not session_id:
             # セッションを新規作成
             session_id = self._generate_session_id()
-        session_obj = self._load_session_from_file(session_id) or {}
+        session_obj = dict(self._load_session(session_id) or {})
+        if key in session_obj and session_obj[key] == value:
+            # 変更がなければ書き込まない
+            return session_id
         session_obj.update({key: value})
         self._save_session(session_id, session_obj)
         return session_id
@@ -58,18 +64,37 @@ class Session(object):
         :param session_id: 削除するセッションのID
         :return: None
         """
-        self.cache.delete(session_id)
+        self.store.delete(session_id)
 
-    def _load_session_from_file(self, session_id) -> Dict[str, Hashable]:
+    def start_sweeper(self) -> None:
+        """
+        期限切れセッションを削除するバックグラウンドスレッドを起動する
+        """
+        if self._sweeper is None:
+            self._sweeper = SessionSweeper(self.store, self.sweep_interval, self.sweep_batch_size)
+            self._sweeper.start()
+
+    def stop_sweeper(self) -> None:
+        if self._sweeper is not None:
+            self._sweeper.stop()
+            self._sweeper = None
+
+    def stats(self) -> Dict[str, int]:
+        """
+        :return: 有効なセッション数(live)，期限切れで削除した数(expired)，上限超過で捨てた数(evicted)
+        """
+        return self.store.stats()
+
+    def _load_session(self, session_id) -> Dict[str, Hashable]:
         """
         与えられたセッションIDの情報を取得する
         :param session_id: セッションID
         :return dict: セッション情報
         """
-        return self.cache.get(session_id)
+        return self.store.get(session_id)
 
     def _save_session(self, session_id: str, obj: Hashable) -> None:
-        self.cache.set(session_id, obj, timeout=self.session_lifetime)
+        self.store.set(session_id, obj, timeout=self.session_lifetime)
 
     def _generate_session_id(self) -> str:
         return uuid4().hex
@@ -0,0 +1,310 @@
+"""
+セッションの保存先
+Sessionクラスはここにあるストアのどれか１つを使う．どれを使うかはConfig.session_backendで選ぶ
+    memory: プロセス内のLRU．一番速いが，uvicornのworkerが複数あると共有されない
+    sqlite: ローカルのsqliteファイル．同じマシンの複数のworkerで共有できる
+    file:   cachelibのFileSystemCache(以前の実装)
+"""
+import logging
+import os
+import pickle
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from itertools import islice
+from typing import Dict, Hashable, Optional, Tuple
+
+from cachelib.file import FileSystemCache
+
+from app.configs import Config
+
+logger = logging.getLogger(__name__)
+
+# sqliteで最後に使われた時刻(last_access)を読み込み時に書き直す間隔(秒)．読み込みのたびに書き込まないようにする
+SQLITE_TOUCH_INTERVAL = 60
+
+
+class SessionStore(object):
+    """
+    セッションストアの共通インターフェース
+    """
+
+    def get(self, session_id: str) -> Optional[Dict[str, Hashable]]:
+        """
+        セッション情報を取得する．存在しないか期限切れの場合はNone
+        :param session_id: セッションID
+        """
+        raise NotImplementedError
+
+    def set(self, session_id: str, obj: Dict[str, Hashable], timeout: int) -> None:
+        """
+        セッション情報を保存する
+        :param session_id: セッションID
+        :param obj: セッション情報
+        :param timeout: 有効期限(秒)
+        """
+        raise NotImplementedError
+
+    def delete(self, session_id: str) -> None:
+        """
+        セッション情報を削除する
+        :param session_id: セッションID
+        """
+        raise NotImplementedError
+
+    def sweep(self, batch_size: int) -> int:
+        """
+        期限切れのセッションを最大batch_size件削除し，上限を超えた分を古いものから捨てる
+        リクエストを止めないよう，１回で全件は見ない
+        :param batch_size: １回に削除する最大件数
+        :return: 削除した件数
+        """
+        raise NotImplementedError
+
+    def stats(self) -> Dict[str, int]:
+        """
+        :return: 有効なセッション数(live)，期限切れで削除した数(expired)，上限超過で捨てた数(evicted)
+        """
+        raise NotImplementedError
+
+
+class MemorySessionStore(SessionStore):
+    """
+    プロセス内の辞書にセッションを持つストア
+    最後に使われた順に並べておき，上限を超えたら古いものから捨てる
+    """
+
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        # セッションID -> (有効期限, セッション情報)
+        self._data: "OrderedDict[str, Tuple[float, Dict[str, Hashable]]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._expired = 0
+        self._evicted = 0
+
+    def get(self, session_id: str) -> Optional[Dict[str, Hashable]]:
+        with self._lock:
+            entry = self._data.get(session_id)
+            if entry is None:
+                return None
+            expires_at, obj = entry
+            if expires_at < time.time():
+                del self._data[session_id]
+                self._expired += 1
+                return None
+            self._data.move_to_end(session_id)
+            return obj
+
+    def set(self, session_id: str, obj: Dict[str, Hashable], timeout: int) -> None:
+        with self._lock:
+            self._data[session_id] = (time.time() + timeout, obj)
+            self._data.move_to_end(session_id)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+                self._evicted += 1
+
+    def delete(self, session_id: str) -> None:
+        with self._lock:
+            self._data.pop(session_id, None)
+
+    def sweep(self, batch_size: int) -> int:
+        # 最近使われていないものほど先頭にあり，期限切れの可能性が高いので先頭から見る
+        now = time.time()
+        with self._lock:
+            expired = [session_id for session_id, (expires_at, _) in islice(self._data.items(), batch_size)
+                       if expires_at < now]
+            for session_id in expired:
+                del self._data[session_id]
+            self._expired += len(expired)
+        return len(expired)
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {"live": len(self._data), "expired": self._expired, "evicted": self._evicted}
+
+
+class SqliteSessionStore(SessionStore):
+    """
+    sqliteのファイルにセッションを持つストア
+    ファイルを共有するので，同じマシン上の複数のworkerから同じセッションが見える
+    sqliteの接続はスレッドをまたいで使えないので，スレッドごとに接続を持つ
+    新しいセッションを保存して上限を超えたら，最後に使われた(last_access)のが古いものから捨てる
+    last_accessはSQLITE_TOUCH_INTERVAL秒より古くなった時だけ読み込み時に書き直すので，LRUの精度はその程度になる
+    """
+
+    def __init__(self, path: str, max_entries: int):
+        self.path = path
+        self.max_entries = max_entries
+        self._expired = 0
+        self._evicted = 0
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._local = threading.local()
+        with self._connection() as connection:
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS sessions ("
+                "id TEXT PRIMARY KEY, data BLOB NOT NULL, expires_at REAL NOT NULL, "
+                "last_access REAL NOT NULL DEFAULT 0)"
+            )
+            columns = {row[1] for row in connection.execute("PRAGMA table_info(sessions)")}
+            if "last_access" not in columns:
+                # last_accessがなかった頃のファイル
+                connection.execute("ALTER TABLE sessions ADD COLUMN last_access REAL NOT NULL DEFAULT 0")
+            connection.execute("CREATE INDEX IF NOT EXISTS sessions_expires_at ON sessions(expires_at)")
+            connection.execute("CREATE INDEX IF NOT EXISTS sessions_last_access ON sessions(last_access)")
+
+    def _connection(self) -> sqlite3.Connection:
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=5)
+            # 読み込みと書き込みが互いにブロックしないようにWALにする
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self._local.connection = connection
+        return connection
+
+    def get(self, session_id: str) -> Optional[Dict[str, Hashable]]:
+        now = time.time()
+        row = self._connection().execute(
+            "SELECT data, last_access FROM sessions WHERE id = ? AND expires_at >= ?", (session_id, now)
+        ).fetchone()
+        if row is None:
+            return None
+        if row[1] < now - SQLITE_TOUCH_INTERVAL:
+            with self._connection() as connection:
+                connection.execute("UPDATE sessions SET last_access = ? WHERE id = ?", (now, session_id))
+        return pickle.loads(row[0])
+
+    def set(self, session_id: str, obj: Dict[str, Hashable], timeout: int) -> None:
+        now = time.time()
+        data = pickle.dumps(obj, pickle.HIGHEST_PROTOCOL)
+        with self._connection() as connection:
+            updated = connection.execute(
+                "UPDATE sessions SET data = ?, expires_at = ?, last_access = ? WHERE id = ?",
+                (data, now + timeout, now, session_id)
+            ).rowcount
+            if updated:
+                return
+            connection.execute(
+                "INSERT OR REPLACE INTO sessions(id, data, expires_at, last_access) VALUES (?, ?, ?, ?)",
+                (session_id, data, now + timeout, now)
+            )
+            # 件数が増えるのは新しいセッションの時だけなので，ここで上限を守る
+            overflow = connection.execute("SELECT COUNT(*) FROM sessions").fetchone()[0] - self.max_entries
+            if overflow > 0:
+                self._evicted += self._evict(connection, overflow)
+
+    @staticmethod
+    def _evict(connection: sqlite3.Connection, count: int) -> int:
+        return connection.execute(
+            "DELETE FROM sessions WHERE id IN (SELECT id FROM sessions ORDER BY last_access LIMIT ?)", (count,)
+        ).rowcount
+
+    def delete(self, session_id: str) -> None:
+        with self._connection() as connection:
+            connection.execute("DELETE FROM sessions WHERE id = ?", (session_id,))
+
+    def sweep(self, batch_size: int) -> int:
+        with self._connection() as connection:
+            expired = connection.execute(
+                "DELETE FROM sessions WHERE id IN "
+                "(SELECT id FROM sessions WHERE expires_at < ? ORDER BY expires_at LIMIT ?)",
+                (time.time(), batch_size)
+            ).rowcount
+            # 上限はsetで守っているが，上限を下げて起動した場合などはここで少しずつ減らす
+            overflow = connection.execute("SELECT COUNT(*) FROM sessions").fetchone()[0] - self.max_entries
+            evicted = 0
+            if overflow > 0:
+                evicted = self._evict(connection, min(overflow, batch_size))
+        self._expired += expired
+        self._evicted += evicted
+        return expired + evicted
+
+    def stats(self) -> Dict[str, int]:
+        live = self._connection().execute(
+            "SELECT COUNT(*) FROM sessions WHERE expires_at >= ?", (time.time(),)
+        ).fetchone()[0]
+        return {"live": live, "expired": self._expired, "evicted": self._evicted}
+
+
+class FileSystemSessionStore(SessionStore):
+    """
+    cachelibのFileSystemCacheを使うストア
+    ファイル数の上限(threshold)を超えた時の削除と期限切れのファイルの削除はcachelibに任せる
+    ディレクトリを数えると遅くなるので，件数はこのworkerで作った数と削除した数から数える
+    """
+
+    def __init__(self, cache_dir: str, max_entries: int):
+        self.cache_dir = cache_dir
+        self.cache = FileSystemCache(cache_dir, threshold=max_entries)
+        self._lock = threading.Lock()
+        self._created = 0
+        self._deleted = 0
+
+    def get(self, session_id: str) -> Optional[Dict[str, Hashable]]:
+        return self.cache.get(session_id)
+
+    def set(self, session_id: str, obj: Dict[str, Hashable], timeout: int) -> None:
+        created = not self.cache.has(session_id)
+        self.cache.set(session_id, obj, timeout=timeout)
+        if created:
+            with self._lock:
+                self._created += 1
+
+    def delete(self, session_id: str) -> None:
+        if self.cache.has(session_id) and self.cache.delete(session_id):
+            with self._lock:
+                self._deleted += 1
+
+    def sweep(self, batch_size: int) -> int:
+        # 期限切れのファイルはcachelibが書き込み時にまとめて削除する
+        return 0
+
+    def stats(self) -> Dict[str, int]:
+        # 期限切れや上限超過でcachelibが消した数は分からないので，liveは多めになる
+        with self._lock:
+            return {"live": self._created - self._deleted, "expired": 0, "evicted": 0,
+                    "created": self._created, "deleted": self._deleted}
+
+
+class SessionSweeper(threading.Thread):
+    """
+    期限切れのセッションを少しずつ削除するバックグラウンドスレッド
+    """
+
+    def __init__(self, store: SessionStore, interval: float, batch_size: int):
+        super().__init__(name="session-sweeper", daemon=True)
+        self.store = store
+        self.interval = interval
+        self.batch_size = batch_size
+        self._stopped = threading.Event()
+
+    def run(self) -> None:
+        while not self._stopped.wait(self.interval):
+            try:
+                # まだ残っていそうなら間を空けずに続ける
+                while self.store.sweep(self.batch_size) >= self.batch_size and not self._stopped.is_set():
+                    pass
+            except Exception:
+                logger.exception("failed to sweep sessions")
+
+    def stop(self) -> None:
+        self._stopped.set()
+
+
+def create_session_store(config: Config) -> SessionStore:
+    """
+    設定に応じたセッションストアを作る
+    :param config: アプリケーションの設定
+    :return: セッションストア
+    """
+    if config.session_backend == "memory":
+        return MemorySessionStore(config.session_max_entries)
+    if config.session_backend == "sqlite":
+        return SqliteSessionStore(os.path.join(config.session_cache_dir, "sessions.sqlite3"),
+                                  config.session_max_entries)
+    if config.session_backend == "file":
+        return FileSystemSessionStore(config.session_cache_dir, config.session_max_entries)
+    raise ValueError("unknown session backend: %s" % config.session_backend)
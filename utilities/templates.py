@@ -0,0 +1,116 @@
+"""
+Jinja2のテンプレート
+起動時に全てのテンプレートをコンパイルしておき，最初のリクエストでコンパイルを待たないようにする
+コンパイル結果はバイトコードキャッシュとしてディスクにも保存するので，次に起動するworkerはそれを読むだけで済む
+"""
+import logging
+import os
+import threading
+import time
+from typing import Dict, Iterator, Optional
+
+from fastapi.responses import StreamingResponse
+from fastapi.templating import Jinja2Templates
+from jinja2 import FileSystemBytecodeCache, Template
+from jinja2.utils import LRUCache
+
+logger = logging.getLogger(__name__)
+
+# ストリーミングで送る時に，この文字数ごとにまとめて送る
+STREAM_CHUNK_SIZE = 4096
+
+
+class AppTemplates(Jinja2Templates):
+    """
+    Jinja2Templatesにプリコンパイルとレンダリング時間の計測を加えたもの
+    TemplateResponseの使い方はJinja2Templatesと同じ
+    """
+
+    def __init__(self, directory: str, bytecode_cache_dir: Optional[str] = None):
+        """
+        :param directory: テンプレートのディレクトリ
+        :param bytecode_cache_dir: バイトコードキャッシュの保存先．Noneならディスクには保存しない
+        """
+        super().__init__(directory=directory)
+        if bytecode_cache_dir:
+            os.makedirs(bytecode_cache_dir, exist_ok=True)
+            self.env.bytecode_cache = FileSystemBytecodeCache(bytecode_cache_dir)
+        self._lock = threading.Lock()
+        self._renders: Dict[str, Dict[str, float]] = {}
+        self._prewarm = {"templates": 0, "seconds": 0.0}
+        # テンプレートの最終更新時刻．HTTPのETagに含め，デプロイでテンプレートが変わったらETagも変わるようにする
+        self.version = "0"
+
+    def prewarm(self) -> Dict[str, float]:
+        """
+        全てのテンプレートを読み込んでコンパイルする．起動時に呼ぶ
+        :return: 読み込んだテンプレートの数とかかった秒数
+        """
+        started = time.perf_counter()
+        names = self.env.list_templates(extensions=["html"])
+        # 全てのテンプレートがJinjaのキャッシュから追い出されないようにする(上限なしの場合はdictになっている)
+        if isinstance(self.env.cache, LRUCache) and self.env.cache.capacity < len(names) * 2:
+            self.env.cache = LRUCache(len(names) * 2)
+        mtime = 0.0
+        for name in names:
+            template = self.env.get_template(name)
+            if template.filename:
+                mtime = max(mtime, os.path.getmtime(template.filename))
+        self.version = "%x" % int(mtime)
+        self._prewarm = {"templates": len(names), "seconds": time.perf_counter() - started}
+        logger.info("prewarmed %d templates in %.1fms", len(names), self._prewarm["seconds"] * 1000)
+        return dict(self._prewarm)
+
+    def TemplateResponse(self, *args, **kwargs):
+        started = time.perf_counter()
+        response = super().TemplateResponse(*args, **kwargs)
+        self._record(response.template.name, time.perf_counter() - started)
+        return response
+
+    def StreamingTemplateResponse(self, name: str, context: dict, status_code: int = 200,
+                                  headers: Optional[Dict[str, str]] = None) -> StreamingResponse:
+        """
+        TemplateResponseと同じ引数で，テンプレートを少しずつ描画しながら送る
+        ヘッダーと一覧より前の部分はすぐに届き，一覧の行は描画した分だけメモリに載る
+        contextにはリストの代わりにジェネレータやPageStreamを渡せる
+        ただし送っている間もMySQLの接続を借りたままになるので，iter_rowsのジェネレータは渡さない(stream_pageを使う)
+        """
+        if "request" not in context:
+            raise ValueError('context must include a "request" key')
+        template = self.get_template(name)
+        return StreamingResponse(self._generate(template, context), status_code=status_code,
+                                 headers=headers, media_type="text/html")
+
+    def _generate(self, template: Template, context: dict) -> Iterator[str]:
+        started = time.perf_counter()
+        try:
+            # generateは細かい断片を返すので，ある程度まとめてから送る
+            chunk, size = [], 0
+            for piece in template.generate(context):
+                chunk.append(piece)
+                size += len(piece)
+                if size >= STREAM_CHUNK_SIZE:
+                    yield "".join(chunk)
+                    chunk, size = [], 0
+            if chunk:
+                yield "".join(chunk)
+        finally:
+            self._record(template.name, time.perf_counter() - started)
+
+    def _record(self, name: str, elapsed: float) -> None:
+        with self._lock:
+            stats = self._renders.get(name)
+            if stats is None:
+                stats = self._renders[name] = {"count": 0, "total": 0.0, "max": 0.0}
+            stats["count"] += 1
+            stats["total"] += elapsed
+            stats["max"] = max(stats["max"], elapsed)
+
+    def stats(self) -> Dict[str, any]:
+        """
+        :return: 起動時のプリコンパイルの結果と，テンプレートごとのレンダリング回数・時間(秒)
+        """
+        with self._lock:
+            renders = {name: dict(stats, avg=stats["total"] / stats["count"])
+                       for name, stats in self._renders.items()}
+        return {"prewarm": dict(self._prewarm), "renders": renders}
@@ -0,0 +1,358 @@
+"""
+コメントとフォローの書き込みをまとめる(write-behind)
+リクエストではキューに積むだけで戻り，バックグラウンドのスレッドがbatch_size件溜まるか
+max_delay秒経つごとに，種類ごとに１つのトランザクション(複数行INSERT)で書き込む
+
+    書き込みの遅れは最大max_delay秒
+    DBに繋がらない間(OperationalError/InterfaceError)は，間隔を倍にしながら(最大max_backoff秒)書けるまで再試行する
+    重複などで書けない行があった場合は１行ずつ書き直し，書けない行だけをspool_dirのdead letterのファイルに残す
+    書き込んだユーザ自身は，次のページを表示する前にwait_forで自分の分が書き込まれるのを待つ(read-your-writes)
+    停止時(shutdown)には残りを全て書き込む．書き込めなかった分はspool_dirに保存し，次に起動したworkerが書き込む
+    溜まった件数がmax_pendingに達したら，書き込むユーザのリクエストの中で書き込む(バックプレッシャー)
+
+Config.write_behind_enabled がFalseなら使われず，各モデルは今まで通り１件ずつ書き込む
+"""
+import glob
+import json
+import logging
+import os
+import threading
+import time
+from typing import Callable, Dict, List, Optional, Tuple
+
+import pymysql
+
+from app.configs import Config
+from app.errors import ConnectionPoolExhausted, WriteBehindQueueFull
+
+logger = logging.getLogger(__name__)
+
+# 種類ごとのまとめて書き込む関数．rowsを１つのトランザクションで書き込む
+Writer = Callable[[List[tuple]], None]
+
+# DBに繋がらないなど，時間を置けば書ける失敗．これ以外の失敗は行そのものが書けないものとして扱う
+TRANSIENT_ERRORS = (pymysql.err.OperationalError, pymysql.err.InterfaceError, ConnectionPoolExhausted)
+
+DEAD_LETTER_FILE = "dead_letters.jsonl"
+SPOOL_PATTERN = "pending-*.jsonl"
+
+
+class WriteBehindQueue(object):
+    """
+    種類(kind)ごとに書き込む行を溜めるキュー
+    モデルはaddでwriter(自分のまとめて書き込むメソッド)と行を渡す
+
+    write_behind.add("comments", self.insert_comments, user_name, (user_name, article_id, body))
+
+    前回の停止時に残った行を起動時に書き込めるように，startの前にregisterで種類ごとのwriterを登録しておく
+    """
+
+    def __init__(self, enabled: bool, batch_size: int, max_delay: float, max_pending: int, max_backoff: float,
+                 spool_dir: str):
+        """
+        :param enabled: Falseならモデルはaddを呼ばずに直接書き込む
+        :param batch_size: この件数溜まったらすぐに書き込む
+        :param max_delay: 積んでから書き込むまでの最大の秒数
+        :param max_pending: 溜めておける上限
+        :param max_backoff: DBに繋がらない時に再試行する間隔の上限(秒)
+        :param spool_dir: 書けなかった行(dead letter)と，停止時に書き込めなかった行を保存するディレクトリ
+        """
+        self.enabled = enabled
+        self.batch_size = batch_size
+        self.max_delay = max_delay
+        self.max_pending = max_pending
+        self.max_backoff = max_backoff
+        self.spool_dir = spool_dir
+        self._lock = threading.Lock()
+        self._wakeup = threading.Condition(self._lock)
+        # 書き込みは１度に１つ．wait_forはこのロックを取れた時点で前の書き込みの完了が分かる
+        self._flush_lock = threading.Lock()
+        # kind -> (ユーザ名, 行)のリスト
+        self._pending: Dict[str, List[Tuple[str, tuple]]] = {}
+        self._writers: Dict[str, Writer] = {}
+        # kind -> 続けて失敗した回数と最後のエラー
+        self._failures: Dict[str, int] = {}
+        self._last_errors: Dict[str, str] = {}
+        # 続けて失敗したflushの回数と，次に再試行する時刻(time.monotonic)
+        self._retries = 0
+        self._retry_at = 0.0
+        # ユーザ名 -> まだ書き込んでいない件数
+        self._users: Dict[str, int] = {}
+        self._count = 0
+        self._oldest: Optional[float] = None
+        self._thread: Optional[threading.Thread] = None
+        self._stopped = False
+        self._stats = {"queued": 0, "written": 0, "batches": 0, "failed": 0, "inline_flushes": 0,
+                       "read_your_writes_flushes": 0, "max_lag_ms": 0.0, "dead": 0, "spooled": 0, "restored": 0}
+
+    def register(self, kind: str, writer: Writer) -> None:
+        """
+        種類ごとのwriterを登録する．起動時に前回の残りを書き込むのに使う
+        """
+        with self._lock:
+            self._writers[kind] = writer
+
+    def start(self) -> None:
+        if not self.enabled or self._thread is not None:
+            return
+        self._restore()
+        self._stopped = False
+        self._thread = threading.Thread(target=self._run, name="write-behind", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        """
+        スレッドを止めて，残りを全て書き込む．書き込めなかった分はspool_dirに保存する
+        """
+        if self._thread is not None:
+            with self._lock:
+                self._stopped = True
+                self._wakeup.notify()
+            self._thread.join()
+            self._thread = None
+        if not self.flush():
+            self._spool()
+
+    def add(self, kind: str, writer: Writer, user_name: str, row: tuple) -> None:
+        """
+        書き込む行を積む．上限に達している場合は先に溜まった分を書き込む(書き込めなければ例外)
+        :param kind: 種類．同じ種類の行はwriterでまとめて書き込む
+        :param writer: rowsを１つのトランザクションで書き込む関数
+        :param user_name: 書き込んだユーザ(read-your-writesのため)
+        :param row: writerに渡す行
+        """
+        if self._count >= self.max_pending:
+            self._stats["inline_flushes"] += 1
+            if not self.flush() and self._count >= self.max_pending:
+                raise WriteBehindQueueFull("%d rows are waiting to be written" % self._count)
+        with self._lock:
+            self._writers.setdefault(kind, writer)
+            self._queue(kind, user_name, row)
+        if self._thread is None:
+            # スレッドが動いていない(起動前やテスト用のスクリプト)なら，その場で書き込む
+            self.flush()
+
+    def _queue(self, kind: str, user_name: str, row: tuple) -> None:
+        # self._lockを取って呼ぶ
+        self._pending.setdefault(kind, []).append((user_name, row))
+        self._users[user_name] = self._users.get(user_name, 0) + 1
+        self._count += 1
+        self._stats["queued"] += 1
+        if self._oldest is None:
+            # 空だったキューに積んだら，max_delay後に書き込むようにスレッドを起こす
+            self._oldest = time.monotonic()
+            self._wakeup.notify()
+        elif self._count >= self.batch_size:
+            self._wakeup.notify()
+
+    def wait_for(self, user_name: Optional[str]) -> None:
+        """
+        user_nameの書き込みが残っていれば，書き込みが終わるまで待つ
+        ログイン中のユーザのページを表示する前に呼ぶ
+        DBに繋がらずに再試行を待っている間は，リクエストごとに書き込もうとはしない
+        """
+        if user_name is None or user_name not in self._users:
+            return
+        if time.monotonic() < self._retry_at:
+            return
+        self._stats["read_your_writes_flushes"] += 1
+        self.flush()
+
+    def _run(self) -> None:
+        while True:
+            with self._lock:
+                while not self._stopped:
+                    if self._oldest is None:
+                        self._wakeup.wait()
+                        continue
+                    due = self._oldest + self.max_delay if self._count < self.batch_size else 0.0
+                    # 失敗した後は，batch_size件溜まっていても再試行の時刻まで待つ
+                    remaining = max(due, self._retry_at) - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._wakeup.wait(remaining)
+                if self._stopped:
+                    return
+            self.flush()
+
+    def flush(self) -> bool:
+        """
+        溜まった行を全て書き込む
+        :return: 全て書き込めたかどうか(DBに繋がらずに書けなかった行はキューに戻す)
+        """
+        with self._flush_lock:
+            with self._lock:
+                batches, self._pending = self._pending, {}
+                oldest, self._oldest = self._oldest, None
+            if not batches:
+                return True
+            if oldest is not None:
+                self._stats["max_lag_ms"] = max(self._stats["max_lag_ms"], (time.monotonic() - oldest) * 1000)
+            retry: Dict[str, List[Tuple[str, tuple]]] = {}
+            for kind, entries in batches.items():
+                writer = self._writers[kind]
+                try:
+                    writer([row for _, row in entries])
+                except TRANSIENT_ERRORS as e:
+                    self._failed(kind, e)
+                    logger.warning("failed to write %d %s, will retry: %r", len(entries), kind, e)
+                    retry[kind] = entries
+                    continue
+                except Exception as e:
+                    # どれかの行が書けない(重複やデータの誤りなど)．１行ずつ書き直して，書けない行だけを残す
+                    self._failed(kind, e)
+                    logger.exception("failed to write %d %s, writing them one by one", len(entries), kind)
+                    left = self._write_each(kind, writer, entries)
+                    if left:
+                        retry[kind] = left
+                    continue
+                self._written(kind, entries)
+            with self._lock:
+                for kind, entries in retry.items():
+                    # 後から積まれた行より前に戻して，順番を保つ
+                    self._pending[kind] = entries + self._pending.get(kind, [])
+                if retry:
+                    self._oldest = oldest if self._oldest is None else min(oldest, self._oldest)
+                    self._retries += 1
+                    self._retry_at = time.monotonic() + min(self.max_delay * 2 ** (self._retries - 1),
+                                                            self.max_backoff)
+                else:
+                    self._retries = 0
+                    self._retry_at = 0.0
+            return not retry
+
+    def _write_each(self, kind: str, writer: Writer, entries: List[Tuple[str, tuple]]) -> List[Tuple[str, tuple]]:
+        """
+        １行ずつ書き込み，書けない行はdead letterにする
+        :return: DBに繋がらなくなって書き込めなかった行(キューに戻す)
+        """
+        for index, entry in enumerate(entries):
+            try:
+                writer([entry[1]])
+            except TRANSIENT_ERRORS as e:
+                self._failed(kind, e)
+                return entries[index:]
+            except Exception as e:
+                try:
+                    self._dead_letter(kind, entry, e)
+                except OSError:
+                    # 残せなかった行は捨てずにキューに戻す
+                    logger.exception("failed to save a dead letter of %s", kind)
+                    return entries[index:]
+                self._done([entry])
+                continue
+            self._written(kind, [entry])
+        return []
+
+    def _failed(self, kind: str, error: Exception) -> None:
+        self._stats["failed"] += 1
+        self._failures[kind] = self._failures.get(kind, 0) + 1
+        self._last_errors[kind] = repr(error)
+
+    def _written(self, kind: str, entries: List[Tuple[str, tuple]]) -> None:
+        self._failures.pop(kind, None)
+        self._stats["written"] += len(entries)
+        self._stats["batches"] += 1
+        self._done(entries)
+
+    def _dead_letter(self, kind: str, entry: Tuple[str, tuple], error: Exception) -> None:
+        """
+        書けない行をdead letterのファイルに追記する．中身を確かめて直してから書き込み直せるように残す
+        """
+        user_name, row = entry
+        logger.error("giving up writing a row of %s: %r", kind, error)
+        record = {"kind": kind, "user": user_name, "row": row, "error": repr(error), "at": time.time()}
+        os.makedirs(self.spool_dir, exist_ok=True)
+        with open(os.path.join(self.spool_dir, DEAD_LETTER_FILE), "a", encoding="utf-8") as f:
+            f.write(json.dumps(record, ensure_ascii=False, default=str) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        self._stats["dead"] += 1
+
+    def _done(self, entries: List[Tuple[str, tuple]]) -> None:
+        # 書き込んだ(かdead letterにした)行をキューの件数とユーザごとの件数から外す
+        with self._lock:
+            self._count -= len(entries)
+            for user_name, _ in entries:
+                left = self._users[user_name] - 1
+                if left:
+                    self._users[user_name] = left
+                else:
+                    del self._users[user_name]
+
+    def _spool(self) -> None:
+        """
+        停止時に書き込めなかった行をファイルに保存する．一時ファイルに書いてから名前を変えるので，途中で止まっても半端なファイルは読まれない
+        """
+        with self._lock:
+            batches, self._pending = self._pending, {}
+            self._oldest = None
+        count = sum(len(entries) for entries in batches.values())
+        if not count:
+            return
+        os.makedirs(self.spool_dir, exist_ok=True)
+        path = os.path.join(self.spool_dir, "pending-%d-%d.jsonl" % (os.getpid(), time.time_ns()))
+        with open(path + ".tmp", "w", encoding="utf-8") as f:
+            for kind, entries in batches.items():
+                for user_name, row in entries:
+                    f.write(json.dumps({"kind": kind, "user": user_name, "row": row},
+                                       ensure_ascii=False, default=str) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(path + ".tmp", path)
+        self._stats["spooled"] += count
+        logger.warning("saved %d unwritten rows to %s", count, path)
+        for entries in batches.values():
+            self._done(entries)
+
+    def _restore(self) -> None:
+        """
+        前回の停止時に保存された行をキューに戻す
+        同じspool_dirを使う他のworkerと取り合わないように，名前を変えられたものだけを読む
+        """
+        for path in sorted(glob.glob(os.path.join(self.spool_dir, SPOOL_PATTERN))):
+            claimed = "%s.%d" % (path, os.getpid())
+            try:
+                os.rename(path, claimed)
+            except OSError:
+                continue
+            with open(claimed, encoding="utf-8") as f:
+                records = [json.loads(line) for line in f if line.strip()]
+            for record in records:
+                entry = (record["user"], tuple(record["row"]))
+                if record["kind"] not in self._writers:
+                    # 書き込み先が分からないものは，消さずにdead letterに移す
+                    self._dead_letter(record["kind"], entry, LookupError("no writer is registered"))
+                    continue
+                with self._lock:
+                    self._queue(record["kind"], entry[0], entry[1])
+            self._stats["restored"] += len(records)
+            os.remove(claimed)
+            logger.info("restored %d rows from %s", len(records), path)
+
+    def dead_letters(self) -> List[Dict[str, any]]:
+        """
+        :return: dead letterのファイルに残した行({kind, user, row, error, at})
+        """
+        path = os.path.join(self.spool_dir, DEAD_LETTER_FILE)
+        if not os.path.exists(path):
+            return []
+        with open(path, encoding="utf-8") as f:
+            return [json.loads(line) for line in f if line.strip()]
+
+    def stats(self) -> Dict[str, any]:
+        with self._lock:
+            stats = dict(self._stats)
+            stats["pending"] = self._count
+            stats["pending_users"] = len(self._users)
+            stats["failing"] = {kind: {"failures": failures, "last_error": self._last_errors.get(kind)}
+                                for kind, failures in self._failures.items()}
+            stats["retry_in"] = max(self._retry_at - time.monotonic(), 0.0)
+        stats["enabled"] = self.enabled
+        stats["rows_per_batch"] = stats["written"] / stats["batches"] if stats["batches"] else 0.0
+        return stats
+
+
+write_behind = WriteBehindQueue(Config.write_behind_enabled, Config.write_behind_batch_size,
+                                Config.write_behind_max_delay, Config.write_behind_max_pending,
+                                Config.write_behind_max_backoff, Config.write_behind_spool_dir)
@@ -1,23 +1,41 @@
 from multiprocessing import context
-from typing import List, Optional
-from fastapi import FastAPI, Request, Form, Cookie, WebSocket, WebSocketDisconnect 
-from fastapi.responses import RedirectResponse
-from fastapi.templating import Jinja2Templates
+from typing import Optional
+from fastapi import FastAPI, Request, Form, Cookie, Depends, WebSocket, WebSocketDisconnect 
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse, RedirectResponse
 from starlette.status import HTTP_302_FOUND
 from fastapi.staticfiles import StaticFiles
 from app.configs import Config
 from app.utilities.session import Session
-from app.models.auth import AuthModel
-from app.models.articles import ArticleModel
+from app.models.auth import AuthModel, AsyncAuthModel, matching_index, profile_cache, reference_registry
+from app.models.articles import ArticleModel, AsyncArticleModel, recent_articles
+from app.models.async_abstract import async_pool_stats, close_async_pools
+from app.models.chat import AsyncChatModel
+from app.models.discussion import DiscussionModel, AsyncDiscussionModel
+from app.models.follow import FollowGraphModel, AsyncFollowGraphModel, make_follow_id
+from app.models.search import SearchModel
 from app.models.picture import PictureModel
+from app.models.pool import get_pool
+from app.utilities.chat import ChatHub
 from app.utilities.check_login import check_login
+from app.utilities.current_user import CurrentUser
+from app.utilities.http_cache import HttpCache
+from app.utilities.metrics import MetricsMiddleware, metrics
+from app.utilities.query_batch import gather_queries, timing_stats
+from app.utilities.templates import AppTemplates
+from app.utilities.write_behind import write_behind
 from fastapi.middleware.cors import CORSMiddleware
 
 app = FastAPI()
 app.mount("/app/static", StaticFiles(directory="app/static"), name="static")
-templates = Jinja2Templates(directory="/app/templates")
 config = Config()
+templates = AppTemplates("/app/templates", config.template_cache_dir)
 session = Session(config)
+current_user = CurrentUser(session, config)
+http_cache = HttpCache(config, templates)
+# 記事・ディスカッションの検索フォームのsearch_by -> SearchModelのfield
+SEARCH_FIELDS = {"titles": "title", "words": "body", "users": "user"}
+chat_hub = ChatHub(config)
 
 app.add_middleware(
     CORSMiddleware,
@@ -26,15 +44,61 @@ app.add_middleware(
     allow_methods=['*'],
     allow_headers=['*'],
 )
-
-active_ws_connections: List[WebSocket] = []
-
-@app.websocket("/chaaaaaat")
-async def chat(websocket: WebSocket, nickname: Optional[str] = None):
+app.add_middleware(MetricsMiddleware, metrics=metrics)
+
+
+@app.on_event("startup")
+async def startup():
+    templates.prewarm()
+    session.start_sweeper()
+    # プロフィールの選択肢は最初のリクエストを待たずに読み込んでおく
+    AuthModel(config).reference_data()
+    await chat_hub.start()
+    # 前回の停止時に書き込めずに残した行も書き込めるように，種類ごとの書き込み先を登録してから始める
+    write_behind.register("comments", ArticleModel(config).insert_comments)
+    write_behind.register("discuss_comments", AuthModel(config).insert_discussion_comments)
+    write_behind.register("discuss_comment_comments", AuthModel(config).insert_discussion_comment_comments)
+    write_behind.register("follow", FollowGraphModel(config).insert_follows)
+    write_behind.register("followpub", FollowGraphModel(config).insert_pub_follows)
+    write_behind.start()
+
+
+@app.on_event("shutdown")
+async def shutdown():
+    session.stop_sweeper()
+    await chat_hub.stop()
+    # 溜まっているコメントやフォローを書き込んでから終了する
+    write_behind.stop()
+    await close_async_pools()
+
+
+@app.get("/metrics")
+def show_metrics(request: Request):
+    # 集計にはSQLやユーザ数が含まれるので，同じマシンからしか見られないようにする
+    if request.client is None or request.client.host not in ("127.0.0.1", "::1"):
+        return JSONResponse({"detail": "Not Found"}, status_code=404)
+    return JSONResponse(jsonable_encoder({
+        "requests": metrics.stats(),
+        "pool": get_pool(config).stats(),
+        "async_pools": async_pool_stats(),
+        "sessions": session.stats(),
+        "chat": chat_hub.stats(),
+        "query_batch": timing_stats(),
+        "templates": templates.stats(),
+        "http_cache": http_cache.stats(),
+        "profile_cache": profile_cache.stats(),
+        "article_feed": recent_articles.stats(),
+        "matching": matching_index.stats(),
+        "reference": reference_registry.stats(),
+        "write_behind": write_behind.stats(),
+    }))
+
+
+async def serve_chat(websocket: WebSocket, room: str, nickname: Optional[str]):
     # 接続を受け取る
     await websocket.accept()
-    # 接続中のclientを保持
-    active_ws_connections.append(websocket)
+    # 接続中のclientをルームに追加
+    connection = await chat_hub.join(room, websocket)
 
     # クエリーの中のnicknameを取得
     # ない場合はunknown_{ipアドレス}にする
@@ -48,14 +112,41 @@ async def chat(websocket: WebSocket, nickname: Optional[str] = None):
             data = await websocket.receive_json()
             # 受け取ったメッセージにnicknameを付与
             data['nickname'] = nickname
-            # 全てのclientに送信
+            # 同じルームの全てのclientに送信
             # 形は{ "nickname": "nickname",　"message": "contents" }
-            for connection in active_ws_connections:
-                await connection.send_json(data)
+            await chat_hub.broadcast(room, data)
     except WebSocketDisconnect:
         # 接続を切断された場合WebSocketDisconnectと言うエラーを吐くので
-        # それを捕捉して接続リストから該当のもの削除する
-        active_ws_connections.remove(websocket)
+        # それを捕捉してルームから該当のもの削除する
+        pass
+    finally:
+        await chat_hub.leave(room, connection)
+
+
+@app.websocket("/community/{pub_id}/chat")
+async def pub_chat(websocket: WebSocket, pub_id: str, nickname: Optional[str] = None):
+    await serve_chat(websocket, pub_id, nickname)
+
+
+@app.get("/community/{pub_id}/chat/history")
+@check_login
+async def pub_chat_history(pub_id: str, before: Optional[int] = None, limit: int = 50, session_id=Cookie(default=None)):
+    """
+    チャットの履歴を古い方へ遡って取得する
+    :param before: このidより古いメッセージを取得する(前回のnext_cursor)
+    :param limit: 取得する件数(最大100)
+    :return: {"messages": 新しい順のメッセージ, "next_cursor": 次に遡る時のbefore}
+    """
+    chat_model = AsyncChatModel(config)
+    messages = await chat_model.fetch_history(pub_id, before, min(max(limit, 1), 100))
+    next_cursor = messages[-1]["id"] if messages else None
+    return {"messages": jsonable_encoder(messages), "next_cursor": next_cursor}
+
+
+@app.websocket("/chaaaaaat")
+async def chat(websocket: WebSocket, nickname: Optional[str] = None):
+    # Pubに属さない共通のルーム
+    await serve_chat(websocket, "", nickname)
 
 
 
@@ -113,7 +204,7 @@ def login(request: Request, username: Optional[str] = Form(None), password: Opti
 
 
 @app.post("/register")
-def create_user(username: Optional[str] = Form(None), password: Optional[str] = Form(None)):
+def create_user(request: Request, username: Optional[str] = Form(None), password: Optional[str] = Form(None)):
     """
     ユーザ登録をおこなう
     フォームから入力を受け取る時は，`username=Form(None)`のように書くことで受け取れる
@@ -123,9 +214,10 @@ def create_user(username: Optional[str] = Form(None), password: Optional[str] =
     :return: 登録が完了したら/blogへリダイレクト
     """
     auth_model = AuthModel(config)
-    auth_model.create_user(username, password)
-    user = auth_model.find_user_by_name_and_password(username, password)
-    auth_model.add_profile_info(username)
+    # ユーザとプロフィールの作成は１つのトランザクションで行う
+    user = auth_model.register(username, password)
+    if user is None:
+        return templates.TemplateResponse("register.html", {"request": request, "error": "このユーザ名は既に使われています"})
     response = RedirectResponse(url="/articles", status_code=HTTP_302_FOUND)
     session_id = session.set("user", user)
     response.set_cookie("session_id", session_id)
@@ -134,10 +226,7 @@ def create_user(username: Optional[str] = Form(None), password: Optional[str] =
 @app.get("/FooTTownTop")
 # check_loginデコレータをつけるとログインしていないユーザをリダイレクトできる
 @check_login
-def top(request: Request, session_id=Cookie(default=None)):
-    user_name = session.get(session_id).get("user").get("username")
-    auth_model = AuthModel(config)
-    user = auth_model.find_profile_by_user_id(user_name)
+def top(request: Request, user=Depends(current_user), session_id=Cookie(default=None)):
     return templates.TemplateResponse("top.html", {
         "request": request,
         "user": user,
@@ -145,34 +234,35 @@ def top(request: Request, session_id=Cookie(default=None)):
 
 @app.get("/profile_update")
 @check_login
-def profile_update_page(request: Request, session_id=Cookie(default=None)):
-    user_name = session.get(session_id).get("user").get("username")
-    auth_model = AuthModel(config)
-    user = auth_model.find_profile_by_user_id(user_name)
-    clubs = auth_model.clubs_list()
-    leagues = auth_model.leagues_list()
-    nations = auth_model.nations_list()
+def profile_update_page(request: Request, user=Depends(current_user), session_id=Cookie(default=None)):
+    reference = AuthModel(config).reference_data()
     return templates.TemplateResponse("profile.html", {
         "request": request, 
         "user": user,
-        "clubs": clubs,
-        "leagues": leagues,
-        "nations": nations
+        "clubs": reference.clubs,
+        "leagues": reference.leagues,
+        "nations": reference.nations
     })
 
 @app.post("/profile_update")
 @check_login
-def profile_update(nickname: Optional[str] = Form("未登録"), twitter: Optional[str] = Form("未登録"), instagram: Optional[str] = Form("未登録"), socialmedia: Optional[str] = Form("未登録"), yourclub: Optional[str] = Form(None), yourleague: Optional[str] = Form(None), yournation: Optional[str] = Form(None), profile: Optional[str] = Form(None), session_id=Cookie(default=None)):
-    print(twitter)
+def profile_update(nickname: Optional[str] = Form("未登録"), twitter: Optional[str] = Form("未登録"), instagram: Optional[str] = Form("未登録"), socialmedia: Optional[str] = Form("未登録"), yourclub: Optional[str] = Form(None), yourleague: Optional[str] = Form(None), yournation: Optional[str] = Form(None), profile: Optional[str] = Form(None), user=Depends(current_user), session_id=Cookie(default=None)):
     nullables = [nickname, twitter, instagram, socialmedia, profile]
     index = 0
     while index < len(nullables):
         if nullables[index] == "":
             nullables[index] = "未登録"
         index = index + 1
-    print(nullables[1])
-    user_name = session.get(session_id).get("user").get("username")
+    user_name = user["username"]
     auth_model = AuthModel(config) # auth.pyを使うために必要
+    # 一覧にない値が送られてきた場合は今の値のままにする
+    reference = auth_model.reference_data()
+    if not reference.is_club(yourclub):
+        yourclub = user["your_club"]
+    if not reference.is_league(yourleague):
+        yourleague = user["your_league"]
+    if not reference.is_nation(yournation):
+        yournation = user["your_nation"]
     auth_model.profile_update(nickname, yourclub, yourleague, yournation, profile, nullables[1], instagram, socialmedia, user_name) # auth.pyの中にある関数を使うために必要
     return RedirectResponse("/user/%s" % (user_name), status_code=HTTP_302_FOUND)
 
@@ -188,75 +278,66 @@ def profile_pic_update(profile_pic: Optional[str] = Form(None), session_id=Cooki
 @app.get("/matching")
 # check_loginデコレータをつけるとログインしていないユーザをリダイレクトできる
 @check_login
-def user_finden(request: Request, session_id=Cookie(default=None)):
-    user_name = session.get(session_id).get("user").get("username")
-    auth_model = AuthModel(config)
-    user = auth_model.find_profile_by_user_id(user_name)
-    your_club = user["your_club"]
-    your_league = user["your_league"]
-    your_nation = user["your_nation"]
-    auth_model = AuthModel(config)
-    users = auth_model.fetch_all_fans()
-    followers = auth_model.get_followers(user_name)
-    followings = auth_model.get_followings(user_name)
-    [clubfan, leaguefan, nationfan] = auth_model.fetch_fans(your_club, your_league, your_nation)
-    return templates.TemplateResponse("matching.html", {
+async def user_finden(request: Request, cursor: Optional[str] = None, user=Depends(current_user), session_id=Cookie(default=None)):
+    user_name = user["username"]
+    auth_model = AsyncAuthModel(config)
+    follow_model = AsyncFollowGraphModel(config)
+    results = await gather_queries(
+        "user_finden",
+        # フォロー済みのユーザは，おすすめの候補の分だけ確かめる
+        suggestions=auth_model.fan_suggestions(
+            user, lambda usernames: follow_model.following_among(user_name, usernames), cursor),
+        followers=follow_model.followers_page(user_name),
+        followings=follow_model.followings_page(user_name),
+    )
+    suggestions = results["suggestions"]
+    return templates.StreamingTemplateResponse("matching.html", {
         "request": request,
-        "users": users,
         "user": user,
-        "clubfan": clubfan,
-        "leaguefan": leaguefan,
-        "nationfan": nationfan,
-        "followers": followers,
-        "followings": followings
+        "suggestions": suggestions.items,
+        "next_cursor": suggestions.next_cursor,
+        "prev_cursor": suggestions.prev_cursor,
+        "followers": results["followers"].items,
+        "followings": results["followings"].items
     })
 
 
 @app.get("/articles")
 # check_loginデコレータをつけるとログインしていないユーザをリダイレクトできる
 @check_login
-def articles_index(request: Request, session_id=Cookie(default=None)):
-    user_name = session.get(session_id).get("user").get("username")
-    auth_model = AuthModel(config)
-    user = auth_model.find_profile_by_user_id(user_name)
+def articles_index(request: Request, cursor: Optional[str] = None, user=Depends(current_user), session_id=Cookie(default=None)):
     article_model = ArticleModel(config)
-    articles = article_model.fetch_recent_articles()
-    return templates.TemplateResponse("article-index.html", {
+    articles = article_model.fetch_recent_articles_cached(cursor)
+    return templates.StreamingTemplateResponse("article-index.html", {
         "request": request,
-        "articles": articles,
+        "articles": articles.items,
+        "next_cursor": articles.next_cursor,
+        "prev_cursor": articles.prev_cursor,
         "user": user,
     })
 
 @app.post("/articles")
 # check_loginデコレータをつけるとログインしていないユーザをリダイレクトできる
 @check_login
-def articles_finden(request: Request, keyword: Optional[str] = Form(None), search_by: Optional[str] = Form(None), session_id=Cookie(default=None)):
+def articles_finden(request: Request, keyword: Optional[str] = Form(None), search_by: Optional[str] = Form(None), cursor: Optional[str] = Form(None), user=Depends(current_user), session_id=Cookie(default=None)):
     # if keyword == "":
     #     return templates.TemplateResponse("article-index.html", {
     # })
-    user_name = session.get(session_id).get("user").get("username")
-    auth_model = AuthModel(config)
-    user = auth_model.find_profile_by_user_id(user_name)
-    article_model = ArticleModel(config)
-    if search_by == "titles":
-        articles = article_model.find_article_by_title(keyword)
-    elif search_by == "words":
-        articles = article_model.find_article_by_keyword(keyword)
-    elif search_by == "users":
-        articles = article_model.find_article_by_username(keyword)
-    return templates.TemplateResponse("article-index.html", {
+    search_model = SearchModel(config)
+    result = search_model.search("article", SEARCH_FIELDS.get(search_by, "title"), keyword, cursor=cursor,
+                                 stream=True)
+    return templates.StreamingTemplateResponse("article-index.html", {
         "request": request,
-        "articles": articles,
+        "articles": result,
+        "page": result,
+        "page_form": {"action": "/articles", "fields": {"keyword": keyword or "", "search_by": search_by or ""}},
         "user": user,
     })
 
 
 @app.get("/article/create")
 @check_login
-def create_article_page(request: Request, session_id=Cookie(default=None)):
-    user_name = session.get(session_id).get("user").get("username")
-    auth_model = AuthModel(config)
-    user = auth_model.find_profile_by_user_id(user_name)
+def create_article_page(request: Request, user=Depends(current_user), session_id=Cookie(default=None)):
     return templates.TemplateResponse("create-article.html", {"request": request, "user": user})
 
 
@@ -271,28 +352,25 @@ def post_article(title: Optional[str] = Form(None), body: Optional[str] = Form(N
 
 @app.get("/article/{article_id}")
 @check_login
-def article_detail_page(request: Request, article_id: int, session_id=Cookie(default=None)):
+@http_cache.conditional(article="article_id")
+def article_detail_page(request: Request, article_id: int, cursor: Optional[str] = None, user=Depends(current_user), session_id=Cookie(default=None)):
     article_model = ArticleModel(config)
     article = article_model.fetch_article_by_id(article_id)
-    comments = article_model.fetch_comment_by_id(article_id)
-    user_name = session.get(session_id).get("user").get("username")
-    auth_model = AuthModel(config)
-    user = auth_model.find_profile_by_user_id(user_name)
+    comments = article_model.fetch_comment_page(article_id, cursor)
     return templates.TemplateResponse("article-detail.html", {
         "request": request,
         "article": article,
-        "comments": comments,
+        "comments": comments.items,
+        "next_cursor": comments.next_cursor,
+        "prev_cursor": comments.prev_cursor,
         "user": user
     })
 
 @app.get("/article/{article_id}/comment")
 @check_login
-def comment_page(request: Request, article_id: int, session_id=Cookie(default=None)):
+def comment_page(request: Request, article_id: int, user=Depends(current_user), session_id=Cookie(default=None)):
     article_model = ArticleModel(config)
     article = article_model.fetch_article_by_id(article_id)
-    user_name = session.get(session_id).get("user").get("username")
-    auth_model = AuthModel(config)
-    user = auth_model.find_profile_by_user_id(user_name)
     return templates.TemplateResponse("comment.html", {
         "request": request,
         "article": article,
@@ -311,17 +389,16 @@ def post_comment(body: Optional[str] = Form(None), article_id: int = Form(None),
 
 @app.get("/article/{article_id}/edit")
 @check_login
-def edit_article_page(request: Request, article_id: int, session_id=Cookie(default=None)):
+def edit_article_page(request: Request, article_id: int, user=Depends(current_user), session_id=Cookie(default=None)):
     article_model = ArticleModel(config)
     article = article_model.fetch_article_by_id(article_id)
-    user_name = session.get(session_id).get("user").get("username")
-    auth_model = AuthModel(config)
-    user = auth_model.find_profile_by_user_id(user_name)
-    articles = article_model.fetch_recent_articles()
+    user_name = user["username"]
     if article["username"] != user_name:
+        articles = article_model.fetch_recent_articles_cached()
         return templates.TemplateResponse("article-index.html", {
             "request": request,
-            "articles": articles,
+            "articles": articles.items,
+            "next_cursor": articles.next_cursor,
             "user": user,
         })
     else:
@@ -362,10 +439,7 @@ def logout(session_id=Cookie(default=None)):
 
 @app.get("/community")
 @check_login
-def find_community(request: Request, session_id=Cookie(default=None)):
-    user_name = session.get(session_id).get("user").get("username")
-    auth_model = AuthModel(config)
-    user = auth_model.find_profile_by_user_id(user_name)
+def find_community(request: Request, user=Depends(current_user), session_id=Cookie(default=None)):
     return templates.TemplateResponse("community.html", {"request": request, "user": user})
 
 
@@ -375,51 +449,32 @@ def find_community(request: Request, session_id=Cookie(default=None)):
 @app.post("/community")
 # check_loginデコレータをつけるとログインしていないユーザをリダイレクトできる
 @check_login
-def pubs_finden(request: Request, findenAus: Optional[str] = Form(None), keyword: Optional[str] = Form(None), search_from: Optional[str] = Form(None), session_id=Cookie(default=None)):
-    user_name = session.get(session_id).get("user").get("username")
-    auth_model = AuthModel(config)
-    user = auth_model.find_profile_by_user_id(user_name)
+def pubs_finden(request: Request, findenAus: Optional[str] = Form(None), keyword: Optional[str] = Form(None), search_from: Optional[str] = Form(None), cursor: Optional[str] = Form(None), user=Depends(current_user), session_id=Cookie(default=None)):
+    search_model = SearchModel(config)
     if search_from == "Rooms":
-        [search_list, status] = auth_model.find_rooms_by_keyword(keyword)
-        if keyword is None:
-            keyword = ""
-        return templates.TemplateResponse("community.html", {
-        "keyword": keyword,
-        "request": request,
-        "search_list": search_list,
-        "user": user,
-        "status": status
-        })
-    elif search_from == "Pubs":
-        [search_list, status] = auth_model.find_pubs_by_keyword(keyword, findenAus)
-        if keyword is None:
-            keyword = ""
-        return templates.TemplateResponse("community.html", {
-        "keyword": keyword,
-        "request": request,
-        "search_list": search_list,
-        "user": user,
-        "status": status
-        })
+        kind, field = "room", "comment"
     elif search_from == "Users":
-        [search_list, status] = auth_model.find_users_by_keyword(keyword, findenAus)
-        if keyword is None:
-            keyword = ""
-        return templates.TemplateResponse("community.html", {
-        "keyword": keyword,
-        "request": request,
-        "search_list": search_list,
-        "user": user,
-        "status": status
-        })
+        kind, field = "user", findenAus or "id"
+    else:
+        kind, field = "pub", findenAus or "id"
+    result = search_model.search(kind, field, keyword, cursor=cursor, stream=True)
+    if keyword is None:
+        keyword = ""
+    return templates.StreamingTemplateResponse("community.html", {
+    "keyword": keyword,
+    "request": request,
+    "search_list": result,
+    "page": result,
+    "page_form": {"action": "/community",
+                  "fields": {"keyword": keyword, "findenAus": findenAus or "", "search_from": search_from or ""}},
+    "user": user,
+    "status": kind
+    })
 
 
 @app.get("/new_community")
 @check_login
-def create_community(request: Request, session_id=Cookie(default=None)):
-    user_name = session.get(session_id).get("user").get("username")
-    auth_model = AuthModel(config)
-    user = auth_model.find_profile_by_user_id(user_name)
+def create_community(request: Request, user=Depends(current_user), session_id=Cookie(default=None)):
     return templates.TemplateResponse("create-community.html", {"request": request, "user": user})
 
 @app.post("/new_community")
@@ -435,10 +490,9 @@ def create_pub(community_name: Optional[str] = Form(None), community_comment: Op
 @app.get("/your_community")
 # check_loginデコレータをつけるとログインしていないユーザをリダイレクトできる
 @check_login
-def show_community_list(request: Request, session_id=Cookie(default=None)):
-    user_name = session.get(session_id).get("user").get("username")
+def show_community_list(request: Request, user=Depends(current_user), session_id=Cookie(default=None)):
+    user_name = user["username"]
     auth_model = AuthModel(config)
-    user = auth_model.find_profile_by_user_id(user_name)
     your_community = auth_model.find_your_following_community(user_name)
     return templates.TemplateResponse("your-community.html", {
         "request": request,
@@ -451,48 +505,45 @@ def show_community_list(request: Request, session_id=Cookie(default=None)):
 @app.get("/community/{pub_id}")
 # check_loginデコレータをつけるとログインしていないユーザをリダイレクトできる
 @check_login
-def pub_detail_page(request: Request, pub_id: Optional[str], session_id=Cookie(default=None)):
-    user_name = session.get(session_id).get("user").get("username")
+@http_cache.conditional(pub="pub_id")
+def pub_detail_page(request: Request, pub_id: Optional[str], user=Depends(current_user), session_id=Cookie(default=None)):
+    user_name = user["username"]
     auth_model = AuthModel(config)
-    user = auth_model.find_profile_by_user_id(user_name)
+    follow_model = FollowGraphModel(config)
     pub = auth_model.find_pub_by_id(pub_id)
-    followers = auth_model.get_pub_followers(pub_id)
-    print(followers)
-    follow_id = user_name + "--" + pub_id
-    follow_or_not = auth_model.detect_pub_follow(follow_id)
+    follower_count = follow_model.pub_follower_count(pub_id)
+    follow_or_not = follow_model.is_following_pub(user_name, pub_id)
     return templates.TemplateResponse("pub-home.html", {
         "request": request,
         "user": user,
         "pub": pub,
-        "follower": followers,
+        "follower_count": follower_count,
         "follow_or_not": follow_or_not
     })
 
 @app.get("/community/{pub_id}/discuss")
 # check_loginデコレータをつけるとログインしていないユーザをリダイレクトできる
 @check_login
-def go_pub_discussion(request: Request, pub_id: Optional[str], session_id=Cookie(default=None)):
-    user_name = session.get(session_id).get("user").get("username")
+def go_pub_discussion(request: Request, pub_id: Optional[str], cursor: Optional[str] = None, user=Depends(current_user), session_id=Cookie(default=None)):
     auth_model = AuthModel(config)
-    user = auth_model.find_profile_by_user_id(user_name)
     pub = auth_model.find_pub_by_id(pub_id)
-    members = auth_model.pub_member_by_id(pub_id)
-    topics = auth_model.find_discussion_by_pub_id(pub_id)
-    return templates.TemplateResponse("pub-discuss.html", {
+    members = auth_model.pub_member_page(pub_id)
+    # ディスカッションは読み終えてから，描画しながら送る
+    topics = auth_model.find_discussion_page_by_pub_id(pub_id, cursor, stream=True)
+    return templates.StreamingTemplateResponse("pub-discuss.html", {
         "user": user,
         "request": request,
         "pub": pub,
-        "members": members,
-        "topics": topics
+        "members": members.items,
+        "topics": topics,
+        "page": topics
     })
 
 @app.get("/community/{pub_id}/newdiscussion")
 # check_loginデコレータをつけるとログインしていないユーザをリダイレクトできる
 @check_login
-def create_new_discussion(request: Request, pub_id: Optional[str], session_id=Cookie(default=None)):
-    user_name = session.get(session_id).get("user").get("username")
+def create_new_discussion(request: Request, pub_id: Optional[str], user=Depends(current_user), session_id=Cookie(default=None)):
     auth_model = AuthModel(config)
-    user = auth_model.find_profile_by_user_id(user_name)
     pub = auth_model.find_pub_by_id(pub_id)
     return templates.TemplateResponse("discuss.html", {
         "user": user,
@@ -511,52 +562,48 @@ def create_discussion(pub_id: Optional[str] = Form(None), status: Optional[str]
 @app.post("/search_discussion")
 # check_loginデコレータをつけるとログインしていないユーザをリダイレクトできる
 @check_login
-def discussion_finden(request: Request, keyword: Optional[str] = Form(None), search_by: Optional[str] = Form(None), pub_id: Optional[str] = Form(None), session_id=Cookie(default=None)):
-    user_name = session.get(session_id).get("user").get("username")
+def discussion_finden(request: Request, keyword: Optional[str] = Form(None), search_by: Optional[str] = Form(None), pub_id: Optional[str] = Form(None), cursor: Optional[str] = Form(None), user=Depends(current_user), session_id=Cookie(default=None)):
     auth_model = AuthModel(config)
-    user = auth_model.find_profile_by_user_id(user_name)
     pub = auth_model.find_pub_by_id(pub_id)
-    if search_by == "titles":
-        topics = auth_model.find_discussion_by_title(pub_id, keyword)
-    elif search_by == "words":
-        topics = auth_model.find_discussion_by_keyword(pub_id, keyword)
-    elif search_by == "users":
-        topics = auth_model.find_discussion_by_username(pub_id, keyword)
-    return templates.TemplateResponse("pub-discuss.html", {
+    search_model = SearchModel(config)
+    result = search_model.search("discussion", SEARCH_FIELDS.get(search_by, "title"), keyword,
+                                 cursor=cursor, scope=pub_id, stream=True)
+    return templates.StreamingTemplateResponse("pub-discuss.html", {
         "user": user,
         "request": request,
         "pub": pub,
-        "topics": topics
+        "topics": result,
+        "page": result,
+        "page_form": {"action": "/search_discussion",
+                      "fields": {"keyword": keyword or "", "search_by": search_by or "", "pub_id": pub_id}}
     })
 
 @app.get("/community/discussion/{id}")
 # check_loginデコレータをつけるとログインしていないユーザをリダイレクトできる
 @check_login
-def discussion_detail_page(request: Request, id: int, session_id=Cookie(default=None)):
-    user_name = session.get(session_id).get("user").get("username")
-    auth_model = AuthModel(config)
-    user = auth_model.find_profile_by_user_id(user_name)
-    topic = auth_model.find_discussion_by_id(id)
-    comments = auth_model.fetch_discussion_commnets_by_id(id)
-    comment_comments = auth_model.fetch_discussion_commnet_comments_by_id(id)
-    pub = auth_model.find_pub_by_id(topic["pub_id"])
-    members = auth_model.pub_member_by_id(topic["pub_id"])
+async def discussion_detail_page(request: Request, id: int, user=Depends(current_user), session_id=Cookie(default=None)):
+    auth_model = AsyncAuthModel(config)
+    thread = await AsyncDiscussionModel(config).load_thread(id)
+    topic = thread.topic
+    # pubとメンバーはtopicのpub_idが分かってから取得する
+    pub_results = await gather_queries(
+        "discussion_detail_page.pub",
+        pub=auth_model.find_pub_by_id(topic["pub_id"]),
+        members=auth_model.pub_member_page(topic["pub_id"]),
+    )
     return templates.TemplateResponse("discussion-detail.html", {
         "request": request,
         "user": user,
         "topic": topic,
-        "comments": comments,
-        "comment_comments": comment_comments,
-        "members": members,
-        "pub": pub
+        "comments": thread.comments,
+        "members": pub_results["members"].items,
+        "pub": pub_results["pub"]
     })
 
 @app.get("/discussioncomment/{id}")
 @check_login
-def post_discuss_comment(request: Request, id: int, session_id=Cookie(default=None)):
-    user_name = session.get(session_id).get("user").get("username")
+def post_discuss_comment(request: Request, id: int, user=Depends(current_user), session_id=Cookie(default=None)):
     auth_model = AuthModel(config)
-    user = auth_model.find_profile_by_user_id(user_name)
     topic = auth_model.find_discussion_by_id(id)
     return templates.TemplateResponse("discuss-comment.html", {
         "request": request,
@@ -575,22 +622,19 @@ def post_comment(body: Optional[str] = Form(None), topic_id: int = Form(None), s
 
 @app.get("/community/discussion/{discussion_id}/edit")
 @check_login
-def edit_discussion_page(request: Request, discussion_id: int, session_id=Cookie(default=None)):
+def edit_discussion_page(request: Request, discussion_id: int, user=Depends(current_user), session_id=Cookie(default=None)):
     auth_model = AuthModel(config)
-    discussion = auth_model.find_discussion_by_id(discussion_id)
-    user_name = session.get(session_id).get("user").get("username")
-    user = auth_model.find_profile_by_user_id(user_name)
-    comments = auth_model.fetch_discussion_commnets_by_id(discussion_id)
-    comment_comments = auth_model.fetch_discussion_commnet_comments_by_id(discussion_id)
-    pub = auth_model.find_pub_by_id(discussion["pub_id"])
-    members = auth_model.pub_member_by_id(discussion["pub_id"])
+    thread = DiscussionModel(config).load_thread(discussion_id)
+    discussion = thread.topic
+    user_name = user["username"]
     if discussion["username"] != user_name:
+        pub = auth_model.find_pub_by_id(discussion["pub_id"])
+        members = auth_model.pub_member_page(discussion["pub_id"]).items
         return templates.TemplateResponse("discussion-detail.html", {
             "request": request,
             "user": user,
             "topic": discussion,
-            "comments": comments,
-            "comment_comments": comment_comments,
+            "comments": thread.comments,
             "members": members,
             "pub": pub
         })
@@ -611,25 +655,22 @@ def finish_editting_discussion_page(status: Optional[str] = Form(None), title: O
 
 @app.get("/discussioncomment/{discussion_comment_id}/edit")
 @check_login
-def edit_discussioncomment_page(request: Request, discussion_comment_id: int, session_id=Cookie(default=None)):
+def edit_discussioncomment_page(request: Request, discussion_comment_id: int, user=Depends(current_user), session_id=Cookie(default=None)):
     auth_model = AuthModel(config)
     discussion_comment = auth_model.find_discussion_comment_by_id(discussion_comment_id)
-    user_name = session.get(session_id).get("user").get("username")
-    user = auth_model.find_profile_by_user_id(user_name)
-    topic = auth_model.find_discussion_by_id(discussion_comment["message_id"])
-    comments = auth_model.fetch_discussion_commnets_by_id(discussion_comment["message_id"])
-    comment_comments = auth_model.fetch_discussion_commnet_comments_by_id(discussion_comment["message_id"])
-    pub = auth_model.find_pub_by_id(topic["pub_id"])
-    members = auth_model.pub_member_by_id(topic["pub_id"])
+    user_name = user["username"]
 
 
     if discussion_comment["username"] != user_name:
+        thread = DiscussionModel(config).load_thread(discussion_comment["message_id"])
+        topic = thread.topic
+        pub = auth_model.find_pub_by_id(topic["pub_id"])
+        members = auth_model.pub_member_page(topic["pub_id"]).items
         return templates.TemplateResponse("discussion-detail.html", {
             "request": request,
             "user": user,
             "topic": topic,
-            "comments": comments,
-            "comment_comments": comment_comments,
+            "comments": thread.comments,
             "members": members,
             "pub": pub
         })
@@ -651,10 +692,8 @@ def finish_editting_discussioncomment_page(context: Optional[str] = Form(None),
 
 @app.get("/discussioncomment/{comment_id}/comment")
 @check_login
-def post_discussion_comment_comment_page(request: Request, comment_id: int, session_id=Cookie(default=None)):
-    user_name = session.get(session_id).get("user").get("username")
+def post_discussion_comment_comment_page(request: Request, comment_id: int, user=Depends(current_user), session_id=Cookie(default=None)):
     auth_model = AuthModel(config)
-    user = auth_model.find_profile_by_user_id(user_name)
     topic = auth_model.find_discussion_comment_by_id(comment_id)
     return templates.TemplateResponse("discuss-comment-comment.html", {
         "request": request,
@@ -676,29 +715,29 @@ def post_comment(body: Optional[str] = Form(None), message_id: int = Form(None),
 @app.get("/user/{username}")
 # check_loginデコレータをつけるとログインしていないユーザをリダイレクトできる
 @check_login
-def user_detail_page(request: Request, username: Optional[str], session_id=Cookie(default=None)):
-    user_name = session.get(session_id).get("user").get("username")
-    auth_model = AuthModel(config)
-    user = auth_model.find_profile_by_user_id(user_name)
-    article_model = ArticleModel(config)
-    other_user = auth_model.find_other_users_by_username(username)
-    articles = article_model.fetch_article_by_username(username)
-    created_by = username
-    pubs = auth_model.find_pub_by_created_by(created_by)
-    followings = auth_model.get_followings(username)
-    followers = auth_model.get_followers(username)
-    follow_id = user_name + "--" + username
-    evil_follow_id = username + "--" + user_name
-    follow_or_not = auth_model.detect_follow(follow_id)
-    evil_follow_or_not = auth_model.detect_follow(evil_follow_id)
+@http_cache.conditional(user="username")
+async def user_detail_page(request: Request, username: Optional[str], user=Depends(current_user), session_id=Cookie(default=None)):
+    user_name = user["username"]
+    auth_model = AsyncAuthModel(config)
+    article_model = AsyncArticleModel(config)
+    follow_model = AsyncFollowGraphModel(config)
+    results = await gather_queries(
+        "user_detail_page",
+        other_user=auth_model.find_other_users_by_username(username),
+        articles=article_model.fetch_article_by_username(username),
+        pubs=auth_model.find_pub_by_created_by(username),
+        counts=follow_model.user_counts(username),
+        relation=follow_model.relation(user_name, username),
+    )
+    follow_or_not, evil_follow_or_not = results["relation"]
     return templates.TemplateResponse("user-home.html", {
         "request": request,
         "user": user,
-        "other_user": other_user,
-        "articles": articles,
-        "pubs": pubs,
-        "following": followings,
-        "follower": followers,
+        "other_user": results["other_user"],
+        "articles": results["articles"],
+        "pubs": results["pubs"],
+        "following_count": results["counts"]["followings"],
+        "follower_count": results["counts"]["followers"],
         "follow_or_not": follow_or_not,
         "evil_follow_or_not": evil_follow_or_not
     })
@@ -707,34 +746,32 @@ def user_detail_page(request: Request, username: Optional[str], session_id=Cooki
 @check_login
 def follow_user(username: Optional[str] = Form(None), session_id=Cookie(default=None)):
     user_name = session.get(session_id).get("user").get("username")
-    follow_id = user_name + "--" + username
-    auth_model = AuthModel(config)
-    auth_model.follow_user(username, user_name, follow_id)
+    follow_model = FollowGraphModel(config)
+    follow_model.follow_user(username, user_name, make_follow_id(user_name, username))
     return RedirectResponse("/user/%s" % (username), status_code=HTTP_302_FOUND)
 
 @app.post("/unfollow")
 @check_login
 def unfollow_user(username: Optional[str] = Form(None), session_id=Cookie(default=None)):
     user_name = session.get(session_id).get("user").get("username")
-    auth_model = AuthModel(config)
-    auth_model.unfollow_user(username, user_name)
+    follow_model = FollowGraphModel(config)
+    follow_model.unfollow_user(username, user_name)
     return RedirectResponse("/user/%s" % (username), status_code=HTTP_302_FOUND)
 
 @app.post("/followpub")
 @check_login
 def follow_user(pub_id: Optional[str] = Form(None), session_id=Cookie(default=None)):
     user_name = session.get(session_id).get("user").get("username")
-    follow_id = user_name + "--" + pub_id
-    auth_model = AuthModel(config)
-    auth_model.follow_pub(pub_id, user_name, follow_id)
+    follow_model = FollowGraphModel(config)
+    follow_model.follow_pub(pub_id, user_name, make_follow_id(user_name, pub_id))
     return RedirectResponse("/community/%s" % (pub_id), status_code=HTTP_302_FOUND)
 
 @app.post("/unfollowpub")
 @check_login
 def unfollow_user(pub_id: Optional[str] = Form(None), session_id=Cookie(default=None)):
     user_name = session.get(session_id).get("user").get("username")
-    auth_model = AuthModel(config)
-    auth_model.unfollow_pub(pub_id, user_name)
+    follow_model = FollowGraphModel(config)
+    follow_model.unfollow_pub(pub_id, user_name)
     return RedirectResponse("/community/%s" % (pub_id), status_code=HTTP_302_FOUND)
 
 